@@ -1,12 +1,60 @@
-from .lib.agents import *
-from .lib.authentication import *
-from .lib.cpa_test import *
-from .lib.eval import *
-from .lib.pdf2chroma import *
-from .lib.util import *
-from .lib.logger import get_logger
+from importlib import import_module
+
 from .main import main
 
+# the submodules are imported on the first access of their names (PEP 562),
+# so e.g. the evaluation does not load openai, llama_cpp or tiktoken
+_LAZY_ATTRS = {
+    "check_openai_api_key": "authentication",
+    "openai_auth": "authentication",
+    "mk_chromadb": "pdf2chroma",
+    "CpaTest": "cpa_test",
+    "GPTAgent": "agents",
+    "LlamaAgent": "agents",
+    "RagAgent": "agents",
+    "LlamaPool": "llama_pool",
+    "ResponseCache": "cache",
+    "CacheMissError": "cache",
+    "EmbeddingCache": "embedding_cache",
+    "Scheduler": "scheduler",
+    "RateLimiter": "rate_limit",
+    "VectorIndex": "vector_index",
+    "HashingEmbedding": "vector_index",
+    "benchmark_retrieval": "vector_index",
+    "output_metrics": "eval",
+    "output_comparison": "compare",
+    "run_benchmark": "benchmark",
+    "MockOpenAIServer": "benchmark",
+    "TelemetrySink": "telemetry",
+    "print_telemetry_summary": "telemetry",
+    "run_sweep": "sweep",
+    "run_worker": "sweep",
+    "merge_results": "sweep",
+    "build_dedup_index": "dedup",
+    "output_dedup_report": "dedup",
+    "get_logger": "logger",
+}
+
+# searched in this order for the other public names of the submodules
+_SUBMODULES = ["agents", "authentication", "benchmark", "cache", "chunker", "compare", "cpa_test", "dedup", "embedding_cache",
+               "eval", "llama_pool", "pdf2chroma", "plan", "rate_limit", "scheduler", "sweep", "telemetry", "util", "vector_index"]
+
+def __getattr__(name:str):
+    if name in _LAZY_ATTRS:
+        module_names = [_LAZY_ATTRS[name]]
+    else:
+        module_names = [] if name.startswith("_") else _SUBMODULES
+    for module_name in module_names:
+        module = import_module(f".lib.{module_name}", __name__)
+        if hasattr(module, name):
+            value = getattr(module, name)
+            globals()[name] = value
+            return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRS))
+
 __all__=[
     "main",
     "check_openai_api_key",
@@ -15,6 +63,25 @@ __all__=[
     "CpaTest",
     "GPTAgent",
     "LlamaAgent",
+    "RagAgent",
+    "LlamaPool",
+    "ResponseCache",
+    "CacheMissError",
+    "EmbeddingCache",
+    "Scheduler",
+    "RateLimiter",
+    "VectorIndex",
+    "HashingEmbedding",
+    "benchmark_retrieval",
     "output_metrics",
+    "output_comparison",
+    "run_benchmark",
+    "MockOpenAIServer",
+    "TelemetrySink",
+    "print_telemetry_summary",
+    "run_sweep",
+    "run_worker",
+    "merge_results",
+    "build_dedup_index",
+    "output_dedup_report",
 ]
-
@@ -1,99 +1,299 @@
 from logging import getLogger
 logger = getLogger(__name__)
 
+import time
+import asyncio
+
+import numpy as np
 import openai
-from llama_cpp import Llama
 from pydantic import BaseModel
 
-from .pdf2chroma import load_chromadb
+from .llama_pool import LlamaPool
+from .plan import TOKENS_PER_MESSAGE, TOKENS_PER_REPLY
+from .rate_limit import RateLimiter, call_with_retry
+from .util import ANSWER_LABELS, STATEMENT_LABELS, calc_tokens_tiktoken, get_encoding
+
+# constraints of the answers. "label" is one statement answered by True or False,
+# and "batch" is the answers of the 4 statements in the JSON of gen_batch_question.
+CONSTRAINTS = ("label", "batch")
+BATCH_MAX_TOKENS = 64 # {"ア": "True", "イ": "False", "ウ": "True", "エ": "False"} with some margin
+# GBNF grammars of llama_cpp which only accept the answers
+LABEL_GRAMMAR = "root ::= " + " | ".join(f'"{label}"' for label in ANSWER_LABELS)
+BATCH_GRAMMAR = ('root ::= "{" ' + ' "," '.join(f'ws "\\"{s}\\":" ws label' for s in STATEMENT_LABELS) + ' ws "}"\n'
+                 + "label ::= " + " | ".join(f'"\\"{label}\\""' for label in ANSWER_LABELS) + "\n"
+                 + 'ws ::= " "?')
+
+class Completion(BaseModel):
+  content:str
+  prompt_tokens:int=0
+  completion_tokens:int=0
+  cached:bool=False
+  retries:int=0
+  confidence:float | None=None # probability of the label in the scoring mode. None when the answer is generated
 
 class BaseAgent(BaseModel):
-  agent_type:str
+  agent_type:str=None
   system_prompt:str=None
   agent:object=None
   main_model_name:str=None
+  temperature:float=0
+  seed:int=0
+  cache:object=None
 
-  def run(self, query:str)->str:
+  async def _run(self, query:str, system_prompt:str, constraint:str=None)->Completion:
     raise NotImplementedError
 
+  async def complete(self, query:str, system_prompt:str=None, constraint:str=None)->Completion:
+    """complete function
+
+    Generate the answer of the query.
+
+    Args:
+        query(str): query text
+        system_prompt(str): system prompt. the system prompt of the agent if None.
+        constraint(str): "label" limits the answer to True or False and "batch" to the JSON of the 4 labels.
+            The answer is not constrained if None.
+
+    Returns:
+        Completion: answer and its usage
+    """
+    if constraint is not None and constraint not in CONSTRAINTS:
+      raise ValueError(f"unknown constraint {constraint}. it must be one of {CONSTRAINTS}.")
+    system_prompt = self.system_prompt if system_prompt is None else system_prompt
+    if self.cache is None:
+      return await self._run(query, system_prompt, constraint)
+    # the key of an unconstrained request is unchanged, so the former entries still hit
+    params = {} if constraint is None else {"constraint": constraint}
+    key = self.cache.make_key(self.main_model_name, system_prompt, query, self.temperature, self.seed, **params)
+    payload = self.cache.get(key)
+    if payload is not None:
+      return Completion(**payload, cached=True)
+    completion = await self._run(query, system_prompt, constraint)
+    self.cache.put(key, completion.model_dump(exclude={"cached", "retries"}))
+    return completion
+
+  async def score(self, queries:list, system_prompt:str=None)->list:
+    raise NotImplementedError(f"The {self.agent_type} agent does not support the scoring mode.")
+
+  async def run(self, query:str, system_prompt:str=None, constraint:str=None)->str:
+    completion = await self.complete(query, system_prompt, constraint)
+    return completion.content
+
+  def close(self)->None:
+    pass
+
 
 class GPTAgent(BaseAgent):
+  limiter:object=None
+  max_retries:int=6
 
-  def __init__(self, main_model_name:str, system_prompt:str):
+  def __init__(self, main_model_name:str, system_prompt:str, cache=None, limiter:RateLimiter=None, max_retries:int=6):
     super().__init__()
     self.agent_type="gpt"
     self.main_model_name = main_model_name
     self.system_prompt = system_prompt
+    self.cache = cache
+    self.limiter = limiter
+    self.max_retries = max_retries
 
-  async def run(self, query:str)->str:
+  def _decoding_params(self, constraint:str)->dict:
+    if constraint == "label":
+      tokens = [get_encoding(self.main_model_name).encode(label) for label in ANSWER_LABELS]
+      if all(len(t) == 1 for t in tokens):
+        # only the label tokens can be sampled, and the answer ends after the label
+        return {"max_tokens": 1, "logit_bias": {str(t[0]): 100 for t in tokens}}
+      return {"max_tokens": max(len(t) for t in tokens)}
+    if constraint == "batch":
+      return {"max_tokens": BATCH_MAX_TOKENS}
+    return {}
+
+  async def _request(self, messages:list, estimated_tokens:int, params:dict)->dict:
+    if self.limiter is not None:
+      await self.limiter.acquire(estimated_tokens)
     response = await openai.ChatCompletion.acreate(
       model=self.main_model_name,
-      messages=[
-            {"role": "system", "content": self.system_prompt},
-            {"role": "user", "content": query}
-        ],
-      temperature=0,
-      seed=0
+      messages=messages,
+      temperature=self.temperature,
+      seed=self.seed,
+      **params
       )
-    return response['choices'][0]['message']['content']
+    if self.limiter is not None:
+      self.limiter.reconcile(estimated_tokens, response['usage']['total_tokens'])
+    return response
+
+  async def _run(self, query:str, system_prompt:str, constraint:str=None)->Completion:
+    messages = [
+      {"role": "system", "content": system_prompt},
+      {"role": "user", "content": query}
+    ]
+    estimated_tokens = 0
+    if self.limiter is not None and self.limiter.TPM is not None:
+      estimated_tokens = sum(calc_tokens_tiktoken([system_prompt, query], self.main_model_name)) + 2 * TOKENS_PER_MESSAGE + TOKENS_PER_REPLY
+    # each retry is a new request, so it waits for the limiter again
+    response, retries = await call_with_retry(self._request, messages, estimated_tokens, self._decoding_params(constraint),
+                                              max_retries=self.max_retries)
+    return Completion(content=response['choices'][0]['message']['content'],
+                      prompt_tokens=response['usage']['prompt_tokens'],
+                      completion_tokens=response['usage']['completion_tokens'],
+                      retries=retries)
 
 class LlamaAgent(BaseAgent):
-  def __init__(self, model_path:str, main_model_name:str, system_prompt:str):
+  def __init__(self, model_path:str, main_model_name:str, system_prompt:str, cache=None, n_instances:int=1, n_threads:int=None, prefix_cache_states:int=0, n_ctx:int=512):
     super().__init__()
     self.agent_type="llama"
+    self.main_model_name = main_model_name
     self.system_prompt = system_prompt
-    self.agent = Llama(
-              model_path=model_path + "/" + main_model_name + '/ggml-model-Q4_K_M-v2.gguf',
+    self.cache = cache
+    self.agent = LlamaPool(
+              model_file=model_path + "/" + main_model_name + '/ggml-model-Q4_K_M-v2.gguf',
+              n_instances=n_instances,
+              n_threads=n_threads,
+              prefix_cache_states=prefix_cache_states,
+              n_ctx=n_ctx,
               chat_format = "llama-2",
               seed=0,
-              verbose=False
     )
 
-  async def run(self, query:str)->str:
-    response = self.agent.create_chat_completion(
+  async def _run(self, query:str, system_prompt:str, constraint:str=None)->Completion:
+    params = {}
+    if constraint == "label": # the grammar ends the answer right after the label
+      params = {"grammar": LABEL_GRAMMAR, "max_tokens": 8}
+    elif constraint == "batch":
+      params = {"grammar": BATCH_GRAMMAR, "max_tokens": BATCH_MAX_TOKENS}
+    response = await self.agent.create_chat_completion(
       messages=[
-        {"role": "system", "content": self.system_prompt},
+        {"role": "system", "content": system_prompt},
         {"role": "user", "content": query}
       ],
-      seed=0,
-      temperature=0
+      seed=self.seed,
+      temperature=self.temperature,
+      **params
     )
-    return response['choices'][0]['message']['content']
+    return Completion(content=response['choices'][0]['message']['content'],
+                      prompt_tokens=response['usage']['prompt_tokens'],
+                      completion_tokens=response['usage']['completion_tokens'])
 
-class GPTRagAgent(BaseAgent):
-  def __init__(self, main_model_name:str, sub_model_name:str, system_prompt:str, max_tokens:int, rag_path):
-    super().__init__()
-    self.agent_type="gpt"
-    from langchain.agents import initialize_agent
-    from langchain.agents import AgentType
-    from langchain.chat_models import ChatOpenAI
+  async def score(self, queries:list, system_prompt:str=None)->list:
+    """score function
 
-    DeprecationWarning("This class is deprecated. Use GPTAgent instead.")
-    self.system_prompt = system_prompt
-    tools = load_chromadb(rag_path,
-                          sub_model_name,
-                          max_tokens=max_tokens)
-
-    #main agent
-    llm = ChatOpenAI(
-        temperature=0,
-        model= main_model_name,
-        max_tokens=max_tokens
-    )
+    Label the queries without decoding. Each prompt is evaluated once, and the label whose first token has
+    the higher log-probability as the continuation is returned with its probability normalized over the labels.
+    The queries which are not cached are scored together in one worker.
+
+    Args:
+        queries(list): query texts (e.g. the 4 statements of a question)
+        system_prompt(str): system prompt. the system prompt of the agent if None.
 
-    self.agent = initialize_agent(
-        agent=AgentType.OPENAI_FUNCTIONS,
-        tools=tools,
-        llm=llm,
-        verbose=False,
-        max_tokens=max_tokens
+    Returns:
+        list: Completion of each query, whose content is "True" or "False" and confidence is the probability of it
+    """
+    system_prompt = self.system_prompt if system_prompt is None else system_prompt
+    res = [None] * len(queries)
+    keys = [None] * len(queries)
+    if self.cache is not None:
+      for n, query in enumerate(queries):
+        keys[n] = self.cache.make_key(self.main_model_name, system_prompt, query, self.temperature, self.seed, mode="score")
+        payload = self.cache.get(keys[n])
+        if payload is not None:
+          res[n] = Completion(**payload, cached=True)
+    todo = [n for n in range(len(queries)) if res[n] is None]
+    if not todo:
+      return res
+    scored = await self.agent.score_labels(
+      [[{"role": "system", "content": system_prompt}, {"role": "user", "content": queries[n]}] for n in todo],
+      ANSWER_LABELS,
     )
+    for n, sc in zip(todo, scored):
+      logprobs = np.array([sc["logprobs"][label] for label in ANSWER_LABELS])
+      probs = np.exp(logprobs - logprobs.max())
+      probs /= probs.sum()
+      best = int(np.argmax(probs))
+      res[n] = Completion(content=ANSWER_LABELS[best], confidence=float(probs[best]),
+                          prompt_tokens=sc["prompt_tokens"], completion_tokens=0)
+      if self.cache is not None:
+        self.cache.put(keys[n], res[n].model_dump(exclude={"cached", "retries"}))
+    return res
 
-  def run(self, query:str)->str:
-    return self.agent.run({"input": self.system_prompt + query})
+  def close(self)->None:
+    self.agent.close()
 
-class LlamaRagAgent(BaseAgent):
-  def __init__(self, *args, **kwargs):
+class RagAgent(BaseAgent):
+  """RagAgent
+
+  This class is an asynchronous retrieve-then-answer agent on top of GPTAgent or LlamaAgent.
+  The reference chunks are retrieved once per retrieval query (the question stem and its statements),
+  and the concurrent requests of the same question wait for the same retrieval.
+  The chunks are put before the query, so the prompts of a question share the prefix.
+  Then one completion is generated per statement by the wrapped agent, whose cache keys contain the chunks.
+
+  Attributes:
+      generator(BaseAgent): agent which generates the answer
+      retriever(callable): function which returns the reference text of a query
+      retrievals(dict): retrieval (future) of each retrieval query
+      latency(dict): seconds of every retrieval and generation
+  """
+  generator:object=None
+  retriever:object=None
+  retrievals:dict=None
+  latency:dict=None
+
+  def __init__(self, generator:BaseAgent, retriever):
     super().__init__()
-    self.agent_type="llama"
-    pass
\ No newline at end of file
+    self.agent_type = generator.agent_type
+    self.main_model_name = generator.main_model_name
+    self.system_prompt = generator.system_prompt
+    self.generator = generator
+    self.retriever = retriever
+    self.retrievals = {}
+    self.latency = {"retrieval": [], "generation": []}
+
+  async def _retrieve(self, retrieval_query:str)->str:
+    started_at = time.perf_counter()
+    # the retriever may embed the query through the network, so it runs out of the event loop
+    context = await asyncio.get_running_loop().run_in_executor(None, self.retriever, retrieval_query)
+    self.latency["retrieval"].append(time.perf_counter() - started_at)
+    return context
+
+  async def retrieve(self, retrieval_query:str)->str:
+    if retrieval_query not in self.retrievals:
+      self.retrievals[retrieval_query] = asyncio.ensure_future(self._retrieve(retrieval_query))
+    try:
+      # shielded, so a cancelled statement does not cancel the retrieval shared with the others
+      return await asyncio.shield(self.retrievals[retrieval_query])
+    except Exception:
+      self.retrievals.pop(retrieval_query, None) # retry on the next request
+      raise
+
+  async def complete(self, query:str, system_prompt:str=None, retrieval_query:str=None, constraint:str=None)->Completion:
+    context = await self.retrieve(query if retrieval_query is None else retrieval_query)
+    started_at = time.perf_counter()
+    completion = await self.generator.complete(f"参考資料:\n{context}\n\n{query}", system_prompt, constraint)
+    if not completion.cached:
+      self.latency["generation"].append(time.perf_counter() - started_at)
+    return completion
+
+  async def score(self, queries:list, system_prompt:str=None, retrieval_query:str=None)->list:
+    context = await self.retrieve(queries[0] if retrieval_query is None else retrieval_query)
+    started_at = time.perf_counter()
+    completions = await self.generator.score([f"参考資料:\n{context}\n\n{query}" for query in queries], system_prompt)
+    if not all(c.cached for c in completions):
+      self.latency["generation"].append(time.perf_counter() - started_at)
+    return completions
+
+  def latency_stats(self)->dict:
+    """latency_stats function
+
+    Count, mean and p50/p95 seconds of the retrieval and the generation.
+    """
+    stats = {}
+    for step, sec_ls in self.latency.items():
+      stats[step] = {"count": len(sec_ls)}
+      if sec_ls:
+        stats[step].update({"mean": float(np.mean(sec_ls)),
+                            "p50": float(np.percentile(sec_ls, 50)),
+                            "p95": float(np.percentile(sec_ls, 95))})
+    return stats
+
+  def close(self)->None:
+    self.retrievals = {}
+    self.generator.close()
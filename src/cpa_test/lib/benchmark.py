@@ -0,0 +1,244 @@
+from logging import getLogger
+logger = getLogger(__name__)
+
+import os
+import json
+import time
+import random
+import asyncio
+import hashlib
+import tempfile
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import openai
+
+from .cpa_test import CpaTest
+from .eval import output_metrics
+from .util import load_prompts
+
+class MockOpenAIServer:
+    """MockOpenAIServer
+
+    This class is a local stand-in for the chat completions endpoint of OpenAI, served by http.server in a thread.
+    The latency of a response follows a log-normal distribution, and the server errors (500)
+    and the rate limits (429 with Retry-After) are injected at the given rates.
+    The answer is "True" or "False" decided by the hash of the query, so the runs are reproducible.
+
+    Attributes:
+        LATENCY_MS(float): median latency in milliseconds
+        LATENCY_SIGMA(float): sigma of the log-normal latency. 0 means a constant latency.
+        ERROR_RATE(float): rate of the server errors
+        RATE_LIMIT_RATE(float): rate of the rate limit errors
+        RETRY_AFTER(float): seconds of Retry-After of the rate limit errors
+        url(str): base url of the API (e.g. http://127.0.0.1:8000/v1)
+        counts(dict): number of the responses by status code
+    """
+    def __init__(self,
+                 latency_ms:float=200, # median latency in milliseconds
+                 latency_sigma:float=0.5, # sigma of the log-normal latency
+                 error_rate:float=0.0, # rate of the server errors
+                 rate_limit_rate:float=0.0, # rate of the rate limit errors
+                 retry_after:float=0.1, # seconds of Retry-After of the rate limit errors
+                 seed:int=0, # seed of the latency and the errors
+                 port:int=0, # port of the server. a free port is used if 0.
+                 ):
+        self.LATENCY_MS = latency_ms
+        self.LATENCY_SIGMA = latency_sigma
+        self.ERROR_RATE = error_rate
+        self.RATE_LIMIT_RATE = rate_limit_rate
+        self.RETRY_AFTER = retry_after
+        self.counts = {}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}/v1"
+
+    def _sample(self)->tuple:
+        with self._lock:
+            latency = self.LATENCY_MS / 1000 * self._rng.lognormvariate(0, self.LATENCY_SIGMA) if self.LATENCY_SIGMA > 0 else self.LATENCY_MS / 1000
+            r = self._rng.random()
+        if r < self.RATE_LIMIT_RATE:
+            return latency, 429
+        if r < self.RATE_LIMIT_RATE + self.ERROR_RATE:
+            return latency, 500
+        return latency, 200
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status:int, body:dict, headers:dict={}):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                latency, status = server._sample()
+                time.sleep(latency)
+                with server._lock:
+                    server.counts[status] = server.counts.get(status, 0) + 1
+                if status == 429:
+                    return self._send(429, {"error": {"message": "Rate limit reached (mock).", "type": "requests", "code": "rate_limit_exceeded"}},
+                                      {"Retry-After": str(server.RETRY_AFTER)})
+                if status == 500:
+                    return self._send(500, {"error": {"message": "The server had an error (mock).", "type": "server_error"}})
+                query = request["messages"][-1]["content"]
+                content = "True" if hashlib.md5(query.encode("utf-8")).digest()[0] % 2 else "False"
+                prompt_tokens = sum(len(m["content"]) for m in request["messages"])
+                self._send(200, {
+                    "id": "chatcmpl-mock",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request.get("model"),
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 1, "total_tokens": prompt_tokens + 1},
+                })
+        return Handler
+
+    def start(self)->"MockOpenAIServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self)->None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.close()
+
+class _RequestTimer:
+    """_RequestTimer
+
+    Measure the latency of every request of openai.ChatCompletion.acreate from the client side while it is active.
+    """
+    def __init__(self):
+        self.latency = []
+        self._acreate = None
+
+    def __enter__(self):
+        self._acreate = openai.ChatCompletion.acreate
+        acreate = self._acreate
+        timer = self
+
+        async def timed_acreate(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return await acreate(*args, **kwargs)
+            finally:
+                timer.latency.append(time.perf_counter() - started_at)
+        openai.ChatCompletion.acreate = timed_acreate
+        return self
+
+    def __exit__(self, *args):
+        openai.ChatCompletion.acreate = self._acreate
+
+def _percentiles(sec_ls:list)->dict:
+    if not sec_ls:
+        return {"latency_ms_p50": None, "latency_ms_p95": None, "latency_ms_p99": None}
+    p50, p95, p99 = np.percentile(np.asarray(sec_ls) * 1000, [50, 95, 99])
+    return {"latency_ms_p50": float(p50), "latency_ms_p95": float(p95), "latency_ms_p99": float(p99)}
+
+def run_benchmark(data_path:str="./data",
+                  subject_ls:list=("audit", "co_act"),
+                  model_name:str="gpt-4o-2024-05-13",
+                  concurrency:int=16,
+                  max_retries:int=6,
+                  output_path:str="./result/benchmark",
+                  **server_config,
+                  )->dict:
+    """run_benchmark function
+
+    This function runs CpaTest.inference over every supported year of the subjects against MockOpenAIServer,
+    and measures the throughput of the whole harness without spending the API budget.
+    The results are written to a temporary folder, and the time of load_prompts and output_metrics is measured as well.
+    The report is dumped to output_path as JSON.
+
+    Args:
+        data_path(str): path to the folder where the cpa data is stored
+        subject_ls(list): subjects (like audit, co_act,...)
+        model_name(str): model name sent to the server
+        concurrency(int): maximum number of in-flight requests
+        max_retries(int): maximum number of retries of a request
+        output_path(str): folder of the report. The report is not dumped if None.
+        server_config: arguments of MockOpenAIServer (latency_ms, latency_sigma, error_rate, rate_limit_rate, retry_after, seed)
+
+    Returns:
+        dict: config, and statements, requests, requests per second, p50/p95/p99 latency,
+            errors and wall time per subject and in total
+    """
+    report = {"config": {"model_name": model_name, "concurrency": concurrency, "max_retries": max_retries, **server_config},
+              "subjects": {}}
+    api_base, api_key = openai.api_base, openai.api_key
+    all_latency, total_wall, total_statements = [], 0.0, 0
+    try:
+        with MockOpenAIServer(**server_config) as server, tempfile.TemporaryDirectory() as tmp_dir:
+            openai.api_base, openai.api_key = server.url, "mock"
+            for subject in subject_ls:
+                result_path = f"{tmp_dir}/{subject}"
+                for d in ["csv", "summary"]:
+                    os.makedirs(f"{result_path}/{d}")
+                cpa = CpaTest(data_path=data_path, result_path=result_path,
+                              concurrency={model_name: concurrency}, max_retries=max_retries)
+                started_at = time.perf_counter()
+                df_prompt = load_prompts(data_path, subject, cpa.PRE_QUESTION, cpa.POST_QUESTION)
+                load_sec = time.perf_counter() - started_at
+                supported = df_prompt.groupby("year", sort=False)["supported"].all()
+                year_ls = list(supported[supported].index)
+                counts_before = dict(server.counts)
+                with _RequestTimer() as timer:
+                    started_at = time.perf_counter()
+                    asyncio.run(cpa.inference(subject, year_ls, model_name, False))
+                    infer_sec = time.perf_counter() - started_at
+                started_at = time.perf_counter()
+                df_eval = output_metrics(result_path, subject, year_ls, [model_name], False)
+                metrics_sec = time.perf_counter() - started_at
+                counts = {str(k): v - counts_before.get(k, 0) for k, v in server.counts.items()}
+                n_statements = int((df_prompt["year"].isin(year_ls)).sum())
+                wall = load_sec + infer_sec + metrics_sec
+                report["subjects"][subject] = {
+                    "years": len(year_ls),
+                    "statements": n_statements,
+                    "requests": len(timer.latency),
+                    "responses": counts,
+                    "dropped_statements": n_statements - int(df_eval["support"].sum()), # failed or invalid
+                    "requests_per_sec": len(timer.latency) / infer_sec,
+                    **_percentiles(timer.latency),
+                    "load_prompts_sec": load_sec,
+                    "inference_sec": infer_sec,
+                    "output_metrics_sec": metrics_sec,
+                    "wall_sec": wall,
+                }
+                all_latency.extend(timer.latency)
+                total_wall += wall
+                total_statements += n_statements
+                logger.info(f"benchmark {subject}: {report['subjects'][subject]}")
+    finally:
+        openai.api_base, openai.api_key = api_base, api_key
+    report["total"] = {"statements": total_statements, "requests": len(all_latency),
+                       "requests_per_sec": len(all_latency) / sum(s["inference_sec"] for s in report["subjects"].values()),
+                       **_percentiles(all_latency), "wall_sec": total_wall}
+    if output_path is not None:
+        os.makedirs(output_path, exist_ok=True)
+        file_name = f"{output_path}/bench_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+        with open(file_name, "w", encoding="UTF-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        logger.info(f"dumped the benchmark to {file_name}.")
+    return report
@@ -0,0 +1,137 @@
+from logging import getLogger
+logger = getLogger(__name__)
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+
+class CacheMissError(KeyError):
+  """CacheMissError
+
+  Raised when a response is not found in the cache in the replay mode.
+  """
+
+class ResponseCache:
+  """ResponseCache
+
+  This class is a content-addressed response cache stored in SQLite.
+  The key is the hash of the whole request, so the same request always hits the same entry.
+
+  Attributes:
+      PATH(str): path to the SQLite file
+      MAX_BYTES(int): maximum size of the stored responses. The least recently used ones are evicted beyond it.
+      REPLAY(bool): read-only mode which raises CacheMissError on a miss instead of calling the API
+      TIMEOUT(float): seconds to wait for the lock of the file held by another process (e.g. the other sweep workers)
+      hits(int): number of hits
+      misses(int): number of misses
+  """
+  def __init__(self,
+               path:str="./cache/responses.sqlite", # path to the SQLite file
+               max_bytes:int=None, # maximum size of the stored responses
+               replay:bool=False, # read-only mode which fails on a miss
+               timeout:float=30.0, # seconds to wait for the lock held by another process
+               ):
+    self.PATH = path
+    self.MAX_BYTES = max_bytes
+    self.REPLAY = replay
+    self.TIMEOUT = timeout
+    self.hits = 0
+    self.misses = 0
+    if replay:
+      if not os.path.exists(path):
+        raise FileNotFoundError(f"No cache to replay. {path}")
+      self._conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=timeout)
+    else:
+      os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+      # the sweep workers write the same file at once, so a writer waits for the lock instead of failing
+      self._conn = sqlite3.connect(path, timeout=timeout)
+      self._conn.execute(f"PRAGMA busy_timeout={int(timeout * 1000)}")
+      self._conn.execute("PRAGMA journal_mode=WAL")
+      self._conn.execute("PRAGMA synchronous=NORMAL")
+      self._conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        accessed_at REAL NOT NULL
+      )""")
+      self._conn.execute("CREATE INDEX IF NOT EXISTS idx_accessed_at ON responses(accessed_at)")
+      self._conn.commit()
+    self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+  @staticmethod
+  def make_key(model_name:str, system_prompt:str, query:str, temperature:float, seed:int, **params)->str:
+    """make_key function
+
+    Hash the full request into the cache key.
+
+    Args:
+        model_name(str): model name
+        system_prompt(str): system prompt
+        query(str): query text
+        temperature(float): sampling temperature
+        seed(int): sampling seed
+        params: other request parameters which change the response
+
+    Returns:
+        key(str): sha256 hex digest
+    """
+    request = {"model": model_name,
+               "system_prompt": system_prompt,
+               "query": query,
+               "temperature": temperature,
+               "seed": seed,
+               **params}
+    return hashlib.sha256(json.dumps(request, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+  def get(self, key:str)->dict:
+    row = self._conn.execute("SELECT value FROM responses WHERE key=?", (key,)).fetchone()
+    if row is None:
+      self.misses += 1
+      if self.REPLAY:
+        raise CacheMissError(f"The response is not cached. {key}")
+      return None
+    self.hits += 1
+    if not self.REPLAY:
+      self._conn.execute("UPDATE responses SET accessed_at=? WHERE key=?", (time.time(), key))
+      self._conn.commit()
+    return json.loads(row[0])
+
+  def put(self, key:str, payload:dict)->None:
+    if self.REPLAY:
+      return None
+    value = json.dumps(payload, ensure_ascii=False)
+    size = len(key) + len(value.encode("utf-8"))
+    old = self._conn.execute("SELECT size FROM responses WHERE key=?", (key,)).fetchone()
+    self._conn.execute("INSERT OR REPLACE INTO responses(key, value, size, accessed_at) VALUES (?, ?, ?, ?)",
+                       (key, value, size, time.time()))
+    if self.MAX_BYTES is None:
+      self._size += size - (old[0] if old else 0)
+    else:
+      # the other processes sharing the file may have added or evicted responses
+      self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+      if self._size > self.MAX_BYTES:
+        self._evict()
+    self._conn.commit()
+
+  def _evict(self)->None:
+    evicted = 0
+    for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY accessed_at").fetchall():
+      if self._size <= self.MAX_BYTES:
+        break
+      self._conn.execute("DELETE FROM responses WHERE key=?", (key,))
+      self._size -= size
+      evicted += 1
+    logger.info(f"evicted {evicted} responses from the cache.")
+
+  def stats(self)->dict:
+    total = self.hits + self.misses
+    return {"hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "bytes": self._size,
+            }
+
+  def close(self)->None:
+    self._conn.close()
@@ -0,0 +1,185 @@
+from logging import getLogger
+logger = getLogger(__name__)
+
+import re
+import time
+import unicodedata
+
+CHUNKER_VERSION = "legal-3" # recorded in the manifest, so the index is rebuilt when the chunking is changed
+
+_NUM = r"[0-9０-９一二三四五六七八九十百千]+"
+# boundaries at the start of a line. the hard ones start a new chunk and the soft ones only a new unit.
+HEADING_PATTERN = re.compile(rf"^(?:第{_NUM}[編章節款目]|《)") # 第二節, 《Ⅱ 要求事項》
+CAPTION_PATTERN = re.compile(r"^（[^）]{1,40}）$") # caption of the next article, e.g. （株券喪失登録の請求）
+ARTICLE_PATTERN = re.compile(rf"^第{_NUM}条(?:の{_NUM})*") # 第二百二十三条, 第三百九条の二
+PARAGRAPH_PATTERN = re.compile(r"^([A-ZＡ-Ｚ]?[0-9０-９]{1,3})[\.．](?![0-9０-９])") # numbered paragraphs of the reports, e.g. １．, A3．
+ITEM_PATTERN = re.compile(r"^(?:[0-9０-９]{1,2}[\s　]|[一二三四五六七八九十]+[\s　]|[\(（][0-9０-９]{1,2}[\)）]|[イロハニホヘトチリヌ][\s　])") # 項, 号 and their items
+# page numbers and running headers, e.g. "- 2 -", "4", "監基報 230"
+NOISE_PATTERN = re.compile(r"^(?:[-－‐\s]*[0-9０-９]+[-－‐\s]*|\S{1,4}基報\s*[0-9０-９]+)$")
+SENTENCE_PATTERN = re.compile(r"(?<=。)")
+
+def _classify(line:str)->tuple:
+    """_classify function
+
+    Kind of the boundary which the line starts ("hard", "soft" or None) and the article identifier of the line.
+    """
+    m = ARTICLE_PATTERN.match(line)
+    if m:
+        return "hard", m.group()
+    m = PARAGRAPH_PATTERN.match(line)
+    if m:
+        return "hard", f"第{unicodedata.normalize('NFKC', m.group(1))}項"
+    if HEADING_PATTERN.match(line) or CAPTION_PATTERN.match(line):
+        return "hard", None
+    if ITEM_PATTERN.match(line):
+        return "soft", None
+    return None, None
+
+def _split_long(text:str, chunk_size:int)->list:
+    # split at "。" and cut the sentences longer than the chunk size
+    pieces = []
+    for sentence in SENTENCE_PATTERN.split(text):
+        pieces.extend(sentence[i:i + chunk_size] for i in range(0, len(sentence), chunk_size))
+    return [p for p in pieces if p]
+
+class _ChunkPacker:
+    """_ChunkPacker
+
+    Pack the units into chunks up to chunk_size.
+    A hard unit starts a new chunk unless the current chunk is shorter than min_chunk_size,
+    so short articles are packed together instead of being fragmented.
+    """
+    def __init__(self, chunk_size:int, chunk_overlap:int, min_chunk_size:int):
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.min_chunk_size = min_chunk_size
+        self.buf = []
+        self.length = 0
+        self.page = None
+        self.articles = []
+        self.tail = ""
+
+    def add(self, text:str, page:int, article:str, hard:bool)->list:
+        out = []
+        if self.buf and (hard and self.length >= self.min_chunk_size or self.length + 1 + len(text) > self.chunk_size):
+            out.append(self.flush())
+        if len(text) > self.chunk_size:
+            for piece in _split_long(text, self.chunk_size):
+                out.extend(self.add(piece, page, article, hard=False))
+            return out
+        if not self.buf:
+            self.page = page
+        if article is not None and article not in self.articles:
+            self.articles.append(article)
+        self.length += len(text) + (1 if self.buf else 0) # joined with a line break
+        self.buf.append(text)
+        return out
+
+    def flush(self)->tuple:
+        text = self.tail + "\n".join(self.buf)
+        if not self.articles:
+            article = None
+        elif len(self.articles) == 1:
+            article = self.articles[0]
+        else:
+            article = f"{self.articles[0]}～{self.articles[-1]}"
+        chunk = (text, {"page": self.page, "article": article})
+        self.tail = text[-self.chunk_overlap:] if self.chunk_overlap > 0 else ""
+        self.buf, self.length, self.articles = [], 0, []
+        return chunk
+
+def iter_chunks(pages, chunk_size:int=1000, chunk_overlap:int=0, min_chunk_size:int=None):
+    """iter_chunks function
+
+    Split the pages of a Japanese legal text into chunks in a streaming way.
+    The lines are grouped into units at the boundaries of 第…条, the numbered paragraphs of the reports (１．, A3．),
+    the headings, 項 and 号, and the units are packed into chunks up to chunk_size.
+    A unit longer than chunk_size is split at "。", or at the last line break (or at chunk_size in a line)
+    when it has no "。" like a table or a list.
+    Only the current unit and the current chunk are kept in memory, so the memory is bounded regardless of the number of pages.
+
+    Args:
+        pages(iterable): (page number, text) of each page
+        chunk_size(int): maximum number of characters of a chunk (except the overlap)
+        chunk_overlap(int): number of characters of the previous chunk put at the head of a chunk
+        min_chunk_size(int): a chunk shorter than it is not closed at a hard boundary. chunk_size // 4 if None.
+
+    Yields:
+        text(str): text of the chunk
+        metadata(dict): page where the chunk starts, and the article (or the range of the articles) in the chunk
+    """
+    packer = _ChunkPacker(chunk_size, chunk_overlap, chunk_size // 4 if min_chunk_size is None else min_chunk_size)
+    unit, unit_len, unit_page, unit_hard = [], 0, None, False
+    article = None
+    for page, text in pages:
+        for line in text.splitlines():
+            line = line.strip()
+            if not line or NOISE_PATTERN.match(line):
+                continue
+            kind, ident = _classify(line)
+            if kind is not None:
+                if unit:
+                    yield from packer.add("".join(unit), unit_page, article, unit_hard)
+                if kind == "hard": # a heading or a caption closes the article
+                    article = ident
+                unit, unit_len, unit_page, unit_hard = [], 0, page, kind == "hard"
+            elif not unit:
+                unit_page = page
+            unit.append(line)
+            unit_len += len(line)
+            while unit_len > chunk_size:
+                # keep only the last incomplete sentence of a long unit
+                text = "".join(unit)
+                sentences = SENTENCE_PATTERN.split(text)
+                done, rest = "".join(sentences[:-1]), sentences[-1]
+                if not done: # no "。" (e.g. a table or a list)
+                    if len(unit) > 1:
+                        done, rest = "".join(unit[:-1]), unit[-1]
+                    else:
+                        done, rest = text[:chunk_size], text[chunk_size:]
+                yield from packer.add(done, unit_page, article, unit_hard)
+                unit, unit_len, unit_hard = [rest] if rest else [], len(rest), False
+    if unit:
+        yield from packer.add("".join(unit), unit_page, article, unit_hard)
+    if packer.buf:
+        yield packer.flush()
+
+def iter_pdf_pages(pdf_file:str):
+    """iter_pdf_pages function
+
+    Extract the text of a PDF file page by page. The pages are parsed lazily by pypdf.
+
+    Yields:
+        page(int): page number starting from 0
+        text(str): text of the page
+    """
+    from pypdf import PdfReader
+
+    with open(pdf_file, "rb") as f:
+        for page, pdf_page in enumerate(PdfReader(f).pages):
+            yield page, pdf_page.extract_text() or ""
+
+def chunk_pdf(pdf_file:str, chunk_size:int=1000, chunk_overlap:int=0, min_chunk_size:int=None)->tuple:
+    """chunk_pdf function
+
+    Split a PDF file into chunks with iter_chunks and measure the throughput.
+
+    Args:
+        pdf_file(str): path to the PDF file
+        chunk_size(int): maximum number of characters of a chunk
+        chunk_overlap(int): number of characters of the previous chunk put at the head of a chunk
+        min_chunk_size(int): a chunk shorter than it is not closed at a hard boundary
+
+    Returns:
+        chunks(list): (text, metadata) of each chunk
+        stats(dict): number of pages and chunks, and seconds
+    """
+    started_at = time.perf_counter()
+    n_pages = 0
+    def _pages():
+        nonlocal n_pages
+        for page, text in iter_pdf_pages(pdf_file):
+            n_pages += 1
+            yield page, text
+    chunks = list(iter_chunks(_pages(), chunk_size, chunk_overlap, min_chunk_size))
+    return chunks, {"pages": n_pages, "chunks": len(chunks), "seconds": time.perf_counter() - started_at}
@@ -0,0 +1,180 @@
+from logging import getLogger
+logger = getLogger(__name__)
+
+from math import comb
+from itertools import combinations
+
+import numpy as np
+import pandas as pd
+
+from .eval import LABELS, load_results
+
+def _onehot_outcome(df_res:pd.DataFrame)->np.ndarray:
+    """_onehot_outcome
+
+    One-hot outcome of each statement in the order of TN, FP, FN, TP.
+    The rows which are not answered in True or False are all zero, i.e. removed as in get_metrics.
+    """
+    valid = df_res["result"].isin(LABELS).to_numpy()
+    code = 2 * (df_res["answer"].to_numpy() == "True") + (df_res["result"].to_numpy() == "True")
+    onehot = np.zeros((len(df_res), 4), dtype=np.float64)
+    onehot[np.flatnonzero(valid), code[valid]] = 1.0
+    return onehot
+
+def _metrics_from_counts(counts:np.ndarray)->tuple:
+    """_metrics_from_counts
+
+    Accuracy and f1-score from the counts of TN, FP, FN, TP in the last axis.
+    """
+    tn, fp, fn, tp = np.moveaxis(counts, -1, 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        acc = (tp + tn) / (tn + fp + fn + tp)
+        f1 = np.where(2 * tp + fp + fn > 0, 2 * tp / (2 * tp + fp + fn), 0.0)
+    return acc, f1
+
+def _resample_weights(n:int, n_boot:int, rng:np.random.Generator)->np.ndarray:
+    """_resample_weights
+
+    Draw n_boot resamples of n statements with replacement at once
+    and return how many times each statement is drawn in each resample as a (n_boot, n) matrix.
+    """
+    idx = rng.integers(0, n, size=(n_boot, n))
+    idx += np.arange(n_boot)[:, None] * n
+    return np.bincount(idx.ravel(), minlength=n_boot * n).reshape(n_boot, n).astype(np.float32)
+
+def mcnemar_exact(b:int, c:int)->float:
+    """mcnemar_exact
+
+    Two-sided exact McNemar test, i.e. binomial test of the discordant pairs.
+
+    Args:
+        b (int): number of statements only the first model answered correctly
+        c (int): number of statements only the second model answered correctly
+
+    Returns:
+        float: p-value
+    """
+    n = b + c
+    if n == 0:
+        return 1.0
+    tail = sum(comb(n, k) for k in range(min(b, c) + 1))
+    return min(1.0, 2 * tail / 2 ** n)
+
+def compare_models(df_res:pd.DataFrame,
+                   model_ls:list | set | tuple,
+                   n_boot:int=10000,
+                   alpha:float=0.05,
+                   seed:int=0,
+                   )->tuple:
+    """compare_models
+
+    This function computes bootstrap confidence intervals of accuracy and f1-score of each model,
+    and compares every pair of models on the same statements.
+    All the models share the same resamples (paired bootstrap), and every resample is drawn at once
+    as an index matrix, so the metrics of all the resamples and models are given by one matrix product.
+    The statements not answered in True or False (the invalid answers and the failed requests) are removed
+    as in get_metrics: from the metrics of the model, and from both models of a pair when either model is invalid,
+    so the difference of a pair and its exact McNemar test are computed on the same statements.
+
+    Args:
+        df_res (pd.DataFrame): long table of load_results for one group of statements
+        model_ls (list | set | tuple): models to compare
+        n_boot (int): number of resamples
+        alpha (float): significance level. the confidence level is 1 - alpha.
+        seed (int): seed of the resampling
+
+    Returns:
+        df_ci (pd.DataFrame): accuracy and f1-score with their confidence intervals, support and invalid per model
+        df_pair (pd.DataFrame): differences with their confidence intervals, McNemar test, support (statements valid for both)
+            and invalid_1 / invalid_2 (statements invalid for each model) per pair of models
+    """
+    model_ls = list(model_ls)
+    df_m = {m: df_res[df_res["model_name"] == m].reset_index(drop=True) for m in model_ls}
+    n = len(df_m[model_ls[0]])
+    for m in model_ls:
+        if len(df_m[m]) != n or not (df_m[m]["answer"].to_numpy() == df_m[model_ls[0]]["answer"].to_numpy()).all():
+            raise ValueError(f"The results of {m} are not aligned with {model_ls[0]}.")
+
+    onehot = {m: _onehot_outcome(df_m[m]) for m in model_ls} # (n, 4) each
+    valid = {m: onehot[m].any(axis=1) for m in model_ls}
+    pairs = list(combinations(model_ls, 2))
+    # the metrics of every model, and of both models of every pair on the statements valid for both
+    stacked = [onehot[m] for m in model_ls]
+    for m1, m2 in pairs:
+        both = (valid[m1] & valid[m2])[:, None]
+        stacked.extend([onehot[m1] * both, onehot[m2] * both])
+    stacked = np.concatenate(stacked, axis=1) # (n, 4 * (n_model + 2 * n_pair))
+    weights = _resample_weights(n, n_boot, np.random.default_rng(seed)) # (n_boot, n)
+    boot_counts = (weights @ stacked).reshape(n_boot, -1, 4)
+    counts = stacked.sum(axis=0).reshape(-1, 4)
+    acc, f1 = _metrics_from_counts(counts)
+    boot_acc, boot_f1 = _metrics_from_counts(boot_counts) # (n_boot, n_model + 2 * n_pair)
+    q = [100 * alpha / 2, 100 * (1 - alpha / 2)]
+    n_model = len(model_ls)
+    acc_ci = np.nanpercentile(boot_acc[:, :n_model], q, axis=0)
+    f1_ci = np.nanpercentile(boot_f1[:, :n_model], q, axis=0)
+    df_ci = pd.DataFrame({"model_name": model_ls,
+                          "accuracy": acc[:n_model], "accuracy_low": acc_ci[0], "accuracy_high": acc_ci[1],
+                          "f1-score": f1[:n_model], "f1-score_low": f1_ci[0], "f1-score_high": f1_ci[1],
+                          "support": counts[:n_model].sum(axis=1).astype(int),
+                          "invalid": [int((~valid[m]).sum()) for m in model_ls]})
+
+    correct = {m: (df_m[m]["result"] == df_m[m]["answer"]).to_numpy() for m in model_ls}
+    pair_ls = []
+    for k, (m1, m2) in enumerate(pairs):
+        i, j = n_model + 2 * k, n_model + 2 * k + 1
+        both = valid[m1] & valid[m2]
+        d_acc = np.nanpercentile(boot_acc[:, i] - boot_acc[:, j], q)
+        d_f1 = np.nanpercentile(boot_f1[:, i] - boot_f1[:, j], q)
+        b = int((correct[m1] & ~correct[m2] & both).sum())
+        c = int((~correct[m1] & correct[m2] & both).sum())
+        pair_ls.append({"model_1": m1, "model_2": m2,
+                        "accuracy_diff": acc[i] - acc[j], "accuracy_diff_low": d_acc[0], "accuracy_diff_high": d_acc[1],
+                        "f1-score_diff": f1[i] - f1[j], "f1-score_diff_low": d_f1[0], "f1-score_diff_high": d_f1[1],
+                        "only_1_correct": b, "only_2_correct": c, "mcnemar_p": mcnemar_exact(b, c),
+                        "support": int(both.sum()), "invalid_1": int((~valid[m1]).sum()), "invalid_2": int((~valid[m2]).sum())})
+    return df_ci, pd.DataFrame(pair_ls)
+
+def output_comparison(result_path:str,
+                      subject:str,
+                      year_set:list | set | tuple,
+                      model_ls:list | set | tuple,
+                      is_rag:bool,
+                      n_boot:int=10000,
+                      alpha:float=0.05,
+                      seed:int=0,
+                      )->tuple:
+    """output_comparison
+
+    This function compares the models per year and over all the years with compare_models,
+    and dumps the results to the result path.
+
+    Args:
+        result_path (str): path of result
+        subject (str): subject (like audit, co_act,...)
+        year_set (list | set | tuple): year set
+        model_ls (list | set | tuple): model lists included in the output
+        is_rag (bool): using RAG or not
+        n_boot (int): number of resamples
+        alpha (float): significance level
+        seed (int): seed of the resampling
+
+    Returns:
+        df_ci (pd.DataFrame): confidence intervals per year and model ("all" is over all the years)
+        df_pair (pd.DataFrame): comparisons per year and pair of models
+    """
+    df_res = load_results(result_path, [subject], year_set, model_ls, [is_rag])
+    # statements of the overall group are the ones of every year in the same order for all the models
+    groups = [(year, df_res[df_res["year"] == year]) for year in year_set] + [("all", df_res)]
+    ci_ls, pair_ls = [], []
+    for year, df_g in groups:
+        df_ci, df_pair = compare_models(df_g, model_ls, n_boot=n_boot, alpha=alpha, seed=seed)
+        ci_ls.append(df_ci.assign(year=year))
+        pair_ls.append(df_pair.assign(year=year))
+    df_ci = pd.concat(ci_ls, ignore_index=True)
+    df_pair = pd.concat(pair_ls, ignore_index=True)
+    df_ci = df_ci[["year", *df_ci.columns.drop("year")]]
+    df_pair = df_pair[["year", *df_pair.columns.drop("year")]]
+    df_ci.to_csv(f"{result_path}/summary/ci_{subject}_rag_{is_rag}.csv")
+    df_pair.to_csv(f"{result_path}/summary/pairs_{subject}_rag_{is_rag}.csv")
+    return df_ci, df_pair
@@ -1,12 +1,20 @@
 from logging import getLogger
 logger = getLogger(__name__)
 
+import time
 import asyncio
 import pandas  as pd
-from datetime import datetime
 
-from .agents import LlamaAgent, GPTAgent, GPTRagAgent, LlamaRagAgent
-from .util import gen_questions, calc_token_tiktoken, load_qdata
+from .agents import Completion, LlamaAgent, GPTAgent, RagAgent
+from .cache import ResponseCache, CacheMissError
+from .dedup import normalize_sentence
+from .journal import ResultJournal
+from .scheduler import Scheduler
+from .pdf2chroma import load_retriever
+from .plan import estimate_cost
+from .rate_limit import RateLimiter
+from .telemetry import TelemetrySink
+from .util import STATEMENT_LABELS, normalize_label, parse_batch_answer, calc_tokens_tiktoken, load_prompts
 
 class CpaTest:
   """CpaTest
@@ -15,26 +23,60 @@ class CpaTest:
 
   Attributes:
       DATA_PATH(str): path to the folder where the cpa data is stored
-      RAG_PATH(str): path to the folder where the chroma db is stored
+      RAG_PATH(str): path to the folder where the retrieval index (mk_chromadb) is stored
       RESULT_PATH(str): path to the folder where the result is stored
       SYSTEM_PROMPT(str): system prompt
       PRE_QUESTION(str): prompt which is given before the question
       POST_QUESTION(str): prompt which is given after the question
       MAX_TOKENS(int): maximum number of tokens one llm can provide
-      agent: agent which is used to generate questions and answers
-      df_cpa: dataframe which contains the cpa data
+      PROMPT_CACHE_PATH(str): path to the folder where the compiled prompt tables are cached
+      BATCH(bool): ask all the 4 statements of a question in one request or not
+      BATCH_SYSTEM_PROMPT(str): system prompt used in the batch mode
+      CONSTRAINED(bool): constrain the answers to the labels (logit bias and a token cap of GPT, a grammar of llama) or not
+      SCORING(bool): label the statements by the log-probabilities of True and False instead of generating (local models only)
+      DEDUP(bool): send the identical requests of a model once in a sweep and share the answer by every occurrence.
+          only the byte-identical requests are shared, which the response cache answers once as well,
+          so with the cache it only saves the concurrent duplicates of a sweep (sent together before either is cached).
+          the statements repeated under another stem or paraphrased (the near duplicates of build_dedup_index)
+          are different requests whose answers can differ, so they are still sent.
+      CONCURRENCY(dict): maximum number of in-flight requests keyed by model name
+      DEFAULT_CONCURRENCY(int): maximum number of in-flight requests of the other models
+      LLAMA_CONFIG(dict): n_instances and n_threads of the local models keyed by model name
+      MAX_LOCAL_MODELS(int): maximum number of the local models loaded at once in a sweep
+      RATE_LIMITS(dict): rpm and tpm of the GPT models keyed by model name, e.g. {"gpt-4o-2024-05-13": {"rpm": 500, "tpm": 30000}}
+      MAX_RETRIES(int): maximum number of retries of a GPT request on rate limits, timeouts and server errors
+      cache(ResponseCache): response cache shared by the agents. No cache is used if None.
+      telemetry(TelemetrySink): sink of the records of the requests. created on the first request if not given,
+          so plan does not create result_path/telemetry.
+      agents(dict): agents which are used to generate answers, keyed by model name
   """
   def __init__(self,
                data_path:str, # path to the folder where the cpa data is stored
                result_path:str, # path to the folder where the result is stored
-               rag_path:str=None, # path to the folder where the chroma db is stored
+               rag_path:str=None, # path to the folder where the retrieval index is stored
                system_prompt:str="########\n指示:\n与えた文章が正しいか誤っているか判別し、正しければ「〇」、誤っていたら「×」を出力しなさい。それ以外には何も含めないことを厳守してください。", # system prompt
                pre_question:str="################\n問題:\n", # prompt which is given before the question
                post_question:str="""回答:""", # prompt which is given after the question
                max_tokens:int=500, # maximum number of tokens
+               prompt_cache_path:str=None, # path to the folder where the compiled prompt tables are cached
+               batch:bool=False, # ask all the 4 statements of a question in one request
+               batch_system_prompt:str='与えた問題のア～エの各文章が正しいか誤っているか判別し、正しければ”True”、誤っていたら”False”を{"ア": "True", "イ": "False", "ウ": "True", "エ": "False"}のようなJSON形式で出力しなさい。それ以外には何も含めないことを厳守してください。', # system prompt used in the batch mode
+               constrained:bool=False, # constrain the answers to the labels
+               scoring:bool=False, # label the statements by the log-probabilities of the labels
+               dedup:bool=False, # send the same request of a model once in a sweep
+               concurrency:dict=None, # maximum number of in-flight requests keyed by model name
+               default_concurrency:int=8, # maximum number of in-flight requests of the other models
+               cache:ResponseCache=None, # response cache shared by the agents
+               llama_config:dict=None, # n_instances and n_threads of the local models keyed by model name
+               max_local_models:int=1, # maximum number of the local models loaded at once
+               rate_limits:dict=None, # rpm and tpm of the GPT models keyed by model name
+               max_retries:int=6, # maximum number of retries of a GPT request
+               telemetry:TelemetrySink=None, # sink of the records of the requests. written in result_path/telemetry if None.
                ):
     if rag_path is None:
       logger.warning("RAG path is not specified.")
+    if scoring and (batch or constrained):
+      raise ValueError("The scoring mode can not be combined with the batch or the constrained mode.")
     self.DATA_PATH = data_path
     self.RAG_PATH = rag_path
     self.RESULT_PATH = result_path
@@ -42,71 +84,423 @@ class CpaTest:
     self.PRE_QUESTION = pre_question
     self.POST_QUESTION = post_question
     self.MAX_TOKENS=max_tokens
+    self.PROMPT_CACHE_PATH = prompt_cache_path
+    self.BATCH = batch
+    self.BATCH_SYSTEM_PROMPT = batch_system_prompt
+    self.CONSTRAINED = constrained
+    self.SCORING = scoring
+    self.DEDUP = dedup
+    self.CONCURRENCY = dict(concurrency or {})
+    self.DEFAULT_CONCURRENCY = default_concurrency
+    self.cache = cache
+    self._telemetry = telemetry
+    self.LLAMA_CONFIG = dict(llama_config or {})
+    self.MAX_LOCAL_MODELS = max_local_models
+    self.RATE_LIMITS = dict(rate_limits or {})
+    self.MAX_RETRIES = max_retries
+    self.agents = {}
+    self.retriever = None
+    self._kept_agents = {} # agents kept open by a sweep with keep_agents, keyed by (model name, is_rag, model path)
 
-  def _set_agent(self, model_path, main_model_name, sub_model_name, is_rag)->None:
+  @property
+  def telemetry(self)->TelemetrySink:
+    if self._telemetry is None:
+      self._telemetry = TelemetrySink(f"{self.RESULT_PATH}/telemetry")
+    return self._telemetry
+
+  def _build_agent(self, model_path, main_model_name, sub_model_name, is_rag):
     if main_model_name.startswith("gpt"):
-      if not is_rag:
-        self.agent = GPTAgent(main_model_name, self.SYSTEM_PROMPT)
-      else:
-        self.agent = GPTRagAgent(main_model_name, sub_model_name, self.SYSTEM_PROMPT, self.MAX_TOKENS, self.RAG_PATH)
+      limiter = RateLimiter(**self.RATE_LIMITS[main_model_name]) if main_model_name in self.RATE_LIMITS else None
+      agent = GPTAgent(main_model_name, self.SYSTEM_PROMPT, cache=self.cache, limiter=limiter, max_retries=self.MAX_RETRIES)
     else:
-      if not is_rag:
-        self.agent = LlamaAgent(model_path, main_model_name, self.SYSTEM_PROMPT)
-      else:
-        self.agent = LlamaRagAgent(model_path, main_model_name, sub_model_name, self.MAX_TOKENS, self.RAG_PATH)
+      llama_config = self.LLAMA_CONFIG.get(main_model_name, {})
+      if is_rag: # the reference chunks do not fit in the default context
+        llama_config = {"n_ctx": 4096, **llama_config}
+      agent = LlamaAgent(model_path, main_model_name, self.SYSTEM_PROMPT, cache=self.cache, **llama_config)
+    if not is_rag:
+      return agent
+    if self.retriever is None: # the index is loaded once and shared by the models
+      self.retriever = load_retriever(self.RAG_PATH)
+    return RagAgent(agent, self.retriever)
+
+  def _set_agent(self, model_path, main_model_name, sub_model_name, is_rag)->None:
+    self.agent = self._build_agent(model_path, main_model_name, sub_model_name, is_rag)
+
+  def result_name(self, model_name:str)->str:
+    """result_name function
+
+    Name of the model in the result files. The batch mode is suffixed with "_batch", the constrained mode with "_constrained"
+    and the scoring mode with "_score", so that the modes can be compared in one summary by output_metrics.
+
+    Args:
+        model_name(str): model name
+
+    Returns:
+        name(str): model name used in the result files
+    """
+    name = model_name + "_batch" if self.BATCH else model_name
+    if self.SCORING:
+      return name + "_score"
+    return name + "_constrained" if self.CONSTRAINED else name
+
+  def _load_prompts(self, subject:str)->pd.DataFrame:
+    return load_prompts(self.DATA_PATH, subject, self.PRE_QUESTION, self.POST_QUESTION, cache_dir=self.PROMPT_CACHE_PATH)
+
+  def _gen_requests(self, df_year:pd.DataFrame):
+    """_gen_requests function
+
+    Generate the requests of the questions in the order of the data.
+
+    Args:
+        df_year(pd.DataFrame): prompt table of one year
+
+    Yields:
+        i(int): question index
+        q_items(list): (question index, statement index, query, answer) of the 4 statements
+        batch_query(str): query which contains all the 4 statements. None if not in the batch mode.
+        retrieval_query(str): query of the reference chunks which is shared by the 4 statements in RAG
+    """
+    if not df_year["supported"].all():
+      raise NotImplementedError(f"This year contains the question with 5 choices. {df_year['year'].iloc[0]}")
+    q_items = []
+    for i, j, prompt, batch_prompt, retrieval_query, a in zip(df_year["q_idx"], df_year["s_idx"], df_year["prompt"], df_year["batch_prompt"], df_year["retrieval_query"], df_year["answer"]):
+      q_items.append((i, j, prompt, a))
+      if len(q_items) == 4:
+        yield i, q_items, batch_prompt if self.BATCH else None, retrieval_query
+        q_items = []
 
   async def _infer(self,
-             df:pd.DataFrame,
+             agent,
+             scheduler:Scheduler,
+             df_prompt:pd.DataFrame,
              subject:str,
              year:str,
              model_name:str,
-             is_rag:bool
+             is_rag:bool,
+             shared:dict=None,
              )->None:
-    df_prod = df[df["key"] == year].reset_index(drop=True).copy()
-    if len(df_prod)==0:
+    df_year = df_prompt[df_prompt["year"] == year]
+    if len(df_year)==0:
       raise ValueError("No data. Please make sure you specified the right year.")
+    name = self.result_name(model_name)
+    logger.info(f"start the inference for model: subject:{subject}, model:{name}, year:{year}, rag:{is_rag}...")
+    q_no_dic = dict(zip(df_year["q_idx"].tolist(), df_year["q_no"].tolist()))
+
+    requests = list(self._gen_requests(df_year)) # a year which is not supported fails before its journal is opened
+    journal = ResultJournal(f"{self.RESULT_PATH}/journal/{subject}_{year}_{name}_rag_{str(is_rag)}.jsonl")
+    usage = {"prompt_tokens": 0, "completion_tokens": 0} # tokens which are actually spent
+
+    def _count(completion:Completion)->None:
+      if not completion.cached:
+        usage["prompt_tokens"] += completion.prompt_tokens
+        usage["completion_tokens"] += completion.completion_tokens
+
+    async def _request(i:int, statement:str, func, *args, **kwargs):
+      if shared is None:
+        return await _send(i, statement, func, *args, **kwargs)
+      # the same request of the model (e.g. a statement repeated in another year) is sent once,
+      # and the other occurrences wait for its answer. the shared answer is recorded as a cache hit.
+      key = (model_name, func.__name__, repr(args), repr(sorted(kwargs.items())))
+      if key not in shared:
+        shared[key] = asyncio.ensure_future(_send(i, statement, func, *args, **kwargs))
+        return await shared[key]
+      submitted = time.time()
+      completion = await asyncio.shield(shared[key])
+      end = time.time()
+      completions = [c.model_copy(update={"cached": True, "retries": 0})
+                     for c in (completion if isinstance(completion, list) else [completion])]
+      self.telemetry.emit({"subject": subject, "model": name, "year": year, "q_no": q_no_dic[i], "statement": statement, "rag": is_rag,
+                           "start": submitted, "end": end, "latency": end - submitted, "queue_wait": 0.0,
+                           "prompt_tokens": sum(c.prompt_tokens for c in completions),
+                           "completion_tokens": sum(c.completion_tokens for c in completions),
+                           "cache_hit": True, "retries": 0, "error": None})
+      return completions if isinstance(completion, list) else completions[0]
+
+    async def _send(i:int, statement:str, func, *args, **kwargs):
+      # one telemetry record per request. the queue wait is the time until the scheduler gives a slot.
+      timing = {"submitted": time.time()}
+      async def _timed():
+        timing["start"] = time.time()
+        return await func(*args, **kwargs)
+      record = {"subject": subject, "model": name, "year": year, "q_no": q_no_dic[i], "statement": statement, "rag": is_rag}
+      try:
+        completion = await scheduler.submit(model_name, _timed)
+      except Exception as e:
+        if "start" in timing:
+          end = time.time()
+          self.telemetry.emit({**record, "start": timing["start"], "end": end, "latency": end - timing["start"],
+                               "queue_wait": timing["start"] - timing["submitted"], "prompt_tokens": 0, "completion_tokens": 0,
+                               "cache_hit": False, "retries": getattr(e, "retries", 0), "error": type(e).__name__})
+        raise
+      end = time.time()
+      completions = completion if isinstance(completion, list) else [completion] # the scoring returns one per statement
+      self.telemetry.emit({**record, "start": timing["start"], "end": end, "latency": end - timing["start"],
+                           "queue_wait": timing["start"] - timing["submitted"],
+                           "prompt_tokens": sum(c.prompt_tokens for c in completions),
+                           "completion_tokens": sum(c.completion_tokens for c in completions),
+                           "cache_hit": all(c.cached for c in completions),
+                           "retries": max(c.retries for c in completions), "error": None})
+      return completion
+
+    async def _ask(i:int, j:int, query:str, a, **kwargs):
+      rec = journal.get(i, j, query)
+      if rec is not None: # already answered before the interruption
+        return rec["result"]
+      try:
+        completion = await _request(i, STATEMENT_LABELS[j], agent.complete, query, **kwargs, **label_kwargs)
+      except (NotImplementedError, CacheMissError) as e:
+        raise
+      except Exception as e: # failed after the retries. it is recorded as an error, not as an answer.
+        logger.exception(e)
+        return e
+      _count(completion)
+      result = completion.content
+      if self.CONSTRAINED:
+        # "True." or "〇" is recorded as "True". an answer without a label is kept as it is and removed by the metrics.
+        label = normalize_label(result)
+        result = result if label is None else label
+      journal.append(i, j, query, result, a)
+      return result
+
+    async def _ask_batch(i:int, q_items:list, batch_query:str, **kwargs)->list:
+      recs = [journal.get(i, j, query) for _, j, query, _ in q_items]
+      if all(rec is not None for rec in recs):
+        return [rec["result"] for rec in recs]
+      try:
+        completion = await _request(i, "all", agent.complete, batch_query, system_prompt=self.BATCH_SYSTEM_PROMPT, **kwargs, **batch_kwargs)
+      except (NotImplementedError, CacheMissError) as e:
+        raise
+      except Exception as e:
+        logger.exception(e)
+        return [e] * len(q_items)
+      _count(completion)
+      labels = parse_batch_answer(completion.content)
+      if labels is None: # fall back to one request per statement
+        logger.warning(f"malformed answer to q{i} of {subject} {year} by {model_name}. ask each statement instead.\n{completion.content}")
+        return await asyncio.gather(*[_ask(*item, **kwargs) for item in q_items])
+      for (_, j, query, a), label in zip(q_items, labels):
+        journal.append(i, j, query, label, a)
+      return labels
+
+    async def _score(i:int, q_items:list, **kwargs)->list:
+      # the 4 statements of a question are scored in one request, so their shared prefix is evaluated once
+      recs = [journal.get(i, j, query) for _, j, query, _ in q_items]
+      if all(rec is not None for rec in recs):
+        for (_, j, _, _), rec in zip(q_items, recs):
+          confidences[(i, j)] = rec.get("confidence")
+        return [rec["result"] for rec in recs]
+      try:
+        completions = await _request(i, "all", agent.score, [query for _, _, query, _ in q_items], **kwargs)
+      except (NotImplementedError, CacheMissError) as e:
+        raise
+      except Exception as e:
+        logger.exception(e)
+        return [e] * len(q_items)
+      for (_, j, query, a), completion in zip(q_items, completions):
+        _count(completion)
+        confidences[(i, j)] = completion.confidence
+        journal.append(i, j, query, completion.content, a, confidence=completion.confidence)
+      return [completion.content for completion in completions]
+
+    confidences = {} # confidence of each (question index, statement index) in the scoring mode
+    label_kwargs = {"constraint": "label"} if self.CONSTRAINED else {}
+    batch_kwargs = {"constraint": "batch"} if self.CONSTRAINED else {}
+    # every statement of the year is queued at once and drained by the scheduler
+    items = []
+    coro_ls = []
+    for i, q_items, batch_query, retrieval_query in requests:
+      items.extend(q_items)
+      # the 4 statements of a question share one retrieval in RAG
+      kwargs = {"retrieval_query": retrieval_query} if is_rag else {}
+      if self.BATCH:
+        coro_ls.append(_ask_batch(i, q_items, batch_query, **kwargs))
+      elif self.SCORING:
+        coro_ls.append(_score(i, q_items, **kwargs))
+      else:
+        coro_ls.extend(_ask(*item, **kwargs) for item in q_items)
+    task_ls = [asyncio.ensure_future(coro) for coro in coro_ls]
+    try:
+      results = await asyncio.gather(*task_ls)
+    except BaseException:
+      for task in task_ls:
+        task.cancel()
+      journal.close()
+      raise
+    if self.BATCH or self.SCORING:
+      results = [r for q_results in results for r in q_results]
+
     ls_res = []
     ls_ans = []
-    cum_token = 0
-    logger.info(f"start the inference for model: subject:{subject}, model:{model_name}, year:{year}, rag:{is_rag}...")
-    log_file = open(f"{self.RESULT_PATH}/log/{subject}_{year}_{model_name}_rag_{str(is_rag)}.txt", "w", encoding='UTF-8')
-    log_file.write(f"model:{model_name}\n")
-    log_file.write(f"year:{year}\n")
-    log_file.write(f"rag:{is_rag}\n")
-    log_file.write(f"count:{df_prod['question'].count()}\n")
-    log_file.write(f"{datetime.now().strftime('%Y年%m月%d日 %H:%M:%S')}\n")
-    for i, row in df_prod.iterrows():
-      logger.info(f"start question:{i}...")
-      q_dic = row.to_dict()
-      q_a = gen_questions(**q_dic)
-      log_file.write(f"q{i}\n")
-      for q, a in q_a:
-        query = self.PRE_QUESTION + q + self.POST_QUESTION
-        log_file.write(query)
-        try:
-          result = await self.agent.run(query)
-          ls_res.append(result)
-          ls_ans.append(a)
-        except NotImplementedError as e:
-          raise
-        except Exception as e:
-          logger.exception(e)
-          log_file.write(str(e))
-          ls_res.append(str(e))
-          ls_ans.append(a)
-          log_file.write("skipped due to an error.\n######\n######\n")
-          continue
-        if self.agent.agent_type == "llama":
-          token_num = 0
-          #token_num = self.agent.agent.tokenize(query)['input_ids'].shape[1]
+    ls_status = []
+    ls_conf = []
+    for (i, j, query, a), result in zip(items, results):
+      ls_ans.append(a)
+      ls_conf.append(confidences.get((i, j)))
+      if isinstance(result, Exception):
+        ls_res.append("")
+        ls_status.append(f"error:{type(result).__name__}")
+      else:
+        ls_res.append(result)
+        ls_status.append("ok")
+    n_error = sum(status != "ok" for status in ls_status)
+    if n_error:
+      logger.warning(f"{n_error} statements of {subject} {year} by {name} failed. they are recorded with the error status "
+                     "and asked again by the next run.")
+    df_out = pd.DataFrame([ls_res, ls_ans, ls_status], index=["result", "answer", "status"]).T
+    if self.SCORING:
+      df_out["confidence"] = ls_conf
+    df_out.to_csv(f"{self.RESULT_PATH}/csv/{subject}_{year}_{name}_rag_{str(is_rag)}.csv", index=False)
+    logger.info(f"tokens of {subject} {year} by {name}: prompt {usage['prompt_tokens']}, completion {usage['completion_tokens']}")
+    if n_error: # the next run resumes the answered statements from the journal and asks only the failed ones
+      journal.close()
+    else:
+      journal.remove() # the csv is complete, so the journal is not needed any more
+    logger.info(f"Finish the inference for model:subject:{subject}, model:{name}, year:{year}, rag:{is_rag}!")
+
+  async def sweep(self,
+            subject_ls:list | set | tuple,
+            year_ls:dict,
+            model_ls:list | set | tuple,
+            is_rag:bool,
+            sub_model_name:str=None,
+            llama_model_path:str=None,
+            keep_agents:bool=False,
+            )->None:
+    """sweep function
+
+    Run every (subject, model, year) combination on one event loop.
+    All statements are queued at once and the scheduler keeps the in-flight requests
+    of each model under CONCURRENCY, so the API models are queried side by side.
+    Local models are served by their own worker processes, which load the model on the first request.
+    At most MAX_LOCAL_MODELS of them run at once (one after another by default) beside the API models,
+    and each is released before the next one starts, so the weights of every local model are not in memory together.
+    The results are dumped to the same csv per (subject, year, model) as inference.
+    With keep_agents, the agents of the local models are left open after the sweep and reused by the next sweep
+    of the same models, so a local model is not loaded again (e.g. for every claim of run_worker).
+    The kept agents which the next sweep does not use are closed at its start, and the rest are closed by close.
+    The API agents are built for every sweep, since their rate limiters belong to the event loop of the sweep.
+
+    Args:
+        subject_ls(list | set | tuple): subjects (like audit, co_act,...)
+        year_ls(dict): years to be tested, keyed by subject
+        model_ls(list | set | tuple): main model names
+        is_rag(bool): using RAG or not
+        sub_model_name(str): not used. The retrieval of RagAgent does not call a model.
+        llama_model_path(str): path to the folder where the llama models are stored
+        keep_agents(bool): leave the local models open for the next sweep. A local model is still closed
+            when another local model of this sweep waits for its slot.
+    """
+    if is_rag is True and self.RAG_PATH is None:
+      raise ValueError("RAG path is not specified at the initialization of the class.")
+    kept = {k: self._kept_agents.pop(k) for k in [(m, is_rag, llama_model_path) for m in model_ls] if k in self._kept_agents}
+    self.close() # the kept agents which this sweep does not use
+    self.agents = {m: kept[(m, is_rag, llama_model_path)] if (m, is_rag, llama_model_path) in kept
+                   else self._build_agent(llama_model_path, m, sub_model_name, is_rag) for m in model_ls}
+    # a local model can not serve more requests at once than its loaded instances
+    generators = {m: a.generator if isinstance(a, RagAgent) else a for m, a in self.agents.items()}
+    concurrency = {m: a.agent.N_INSTANCES for m, a in generators.items() if isinstance(a, LlamaAgent)}
+    scheduler = Scheduler({**concurrency, **self.CONCURRENCY}, self.DEFAULT_CONCURRENCY)
+    shared = {} if self.DEDUP else None # answers of the requests keyed by model and request
+    df_dic = {subject: self._load_prompts(subject) for subject in subject_ls}
+
+    local_slots = asyncio.Semaphore(self.MAX_LOCAL_MODELS)
+    local_left = [m for m in model_ls if isinstance(generators[m], LlamaAgent)]
+
+    async def _run_model(main_model_name:str)->None:
+      if isinstance(generators[main_model_name], LlamaAgent):
+        async with local_slots: # the pool is closed before the slot is given to the next local model
+          await _run(main_model_name)
+      else:
+        await _run(main_model_name)
+
+    async def _run(main_model_name:str)->None:
+      agent = self.agents[main_model_name]
+      try:
+        await asyncio.gather(*[
+          self._infer(agent, scheduler, df_dic[subject], subject, year, main_model_name, is_rag, shared)
+          for subject in subject_ls for year in year_ls[subject]
+        ])
+      finally:
+        if main_model_name in local_left:
+          local_left.remove(main_model_name)
+        if keep_agents and isinstance(generators[main_model_name], LlamaAgent) and not local_left:
+          self._kept_agents[(main_model_name, is_rag, llama_model_path)] = agent
         else:
-          token_num = calc_token_tiktoken(query, model_name)
-        cum_token += token_num
-        log_file.write(f'{result}\n正解:{a}\n######\n######\n')
-    pd.DataFrame([ls_res, ls_ans], index=["result", "answer"]).T.to_csv(f"{self.RESULT_PATH}/csv/{subject}_{year}_{model_name}_rag_{str(is_rag)}.csv", index=False)
-    log_file.write("##########\nTotal Tokens(Main Model): " + str(cum_token))
-    log_file.close()
-    logger.info(f"Finish the inference for model:subject:{subject}, model:{model_name}, year:{year}, rag:{is_rag}!")
+          agent.close() # release the local model as soon as its work is done
+      if isinstance(agent, RagAgent):
+        stats = agent.latency_stats()
+        logger.info(f"{main_model_name} latency: " + ", ".join(
+          f"{step} {st['count']} calls (p50 {st.get('p50', 0):.3f}s, p95 {st.get('p95', 0):.3f}s)" for step, st in stats.items()))
+
+    try:
+      await asyncio.gather(*[_run_model(m) for m in model_ls])
+    finally:
+      self.telemetry.flush()
+    if shared is not None:
+      logger.info(f"dedup: {len(shared)} distinct requests are sent for the statements.")
+    if self.cache is not None:
+      logger.info(f"response cache: {self.cache.stats()}")
+
+  def close(self)->None:
+    """close function
+
+    Close the agents kept open by sweep with keep_agents (e.g. release the local models).
+    """
+    for agent in self._kept_agents.values():
+      agent.close()
+    self._kept_agents = {}
+
+  def plan(self,
+           subject_ls:list | set | tuple,
+           year_ls:dict,
+           model_ls:list | set | tuple,
+           )->pd.DataFrame:
+    """plan function
+
+    Build every request of the sweep without sending it and estimate the input tokens and the cost per model.
+    The output tokens are estimated by the tokens of a label ("True") or of a batch answer.
+    In the dedup mode, the identical requests are counted once, and the saved requests are given in the column "dedup_saved".
+    The statements repeated under another stem or in another batch are counted as they are still sent.
+
+    Args:
+        subject_ls(list | set | tuple): subjects (like audit, co_act,...)
+        year_ls(dict): years to be tested, keyed by subject
+        model_ls(list | set | tuple): main model names
+
+    Returns:
+        pd.DataFrame: requests, input_tokens, output_tokens, cost_usd (and dedup_saved) per subject and model
+    """
+    req_ls = []
+    sentence_ls = [] # (subject, normalized statement) of the planned statements
+    for subject in subject_ls:
+      df_prompt = self._load_prompts(subject)
+      for year in year_ls[subject]:
+        df_year = df_prompt[df_prompt["year"] == year]
+        sentence_ls.extend((subject, normalize_sentence(x)) for x in df_year["sentence"])
+        for _, q_items, batch_query, _ in self._gen_requests(df_year):
+          if self.BATCH:
+            req_ls.append((subject, self.BATCH_SYSTEM_PROMPT, batch_query, "batch"))
+          else:
+            req_ls.extend((subject, self.SYSTEM_PROMPT, query, "single") for _, _, query, _ in q_items)
+    df_req = pd.DataFrame(req_ls, columns=["subject", "system_prompt", "query", "kind"])
+    if self.DEDUP:
+      n_req = df_req.groupby("subject", sort=False).size()
+      df_req = df_req.drop_duplicates(["system_prompt", "query"], ignore_index=True)
+      saved = n_req - df_req.groupby("subject", sort=False).size().reindex(n_req.index, fill_value=0)
+      n_repeated = len(sentence_ls) - len(set(sentence_ls))
+      logger.info(f"dedup: {saved.sum()} of {n_req.sum()} requests are identical and sent once. "
+                  f"{n_repeated} statements repeat a former statement of the sweep, but only the identical prompts are shared "
+                  "and the ones under another stem (or in another batch) are still sent. cpa-test dedup reports them.")
+    sample_answer = {"single": "True", "batch": '{"ア": "True", "イ": "False", "ウ": "True", "エ": "False"}'}
+    df_plan = []
+    for model_name in model_ls:
+      output_tokens = dict(zip(sample_answer.keys(), calc_tokens_tiktoken(sample_answer.values(), model_name)))
+      df_plan.append(df_req.assign(model_name=model_name, output_tokens=df_req["kind"].map(output_tokens)))
+    df_plan = estimate_cost(pd.concat(df_plan, ignore_index=True))
+    if self.DEDUP:
+      df_plan["dedup_saved"] = df_plan["subject"].map(saved).astype(int)
+    logger.info(f"planned requests:\n{df_plan.to_string(index=False)}\ntotal cost: {df_plan['cost_usd'].sum():.2f} USD")
+    return df_plan
 
   async def inference(self,
             subject,
@@ -116,11 +510,11 @@ class CpaTest:
             sub_model_name:str=None,
             llama_model_path:str=None,
             )->None:
-    if is_rag is True and self.RAG_PATH is None:
-      raise ValueError("RAG path is not specified at the initialization of the class.")
-    self.df_cpa = load_qdata(self.DATA_PATH, subject)
-    self._set_agent(llama_model_path, main_model_name, sub_model_name, is_rag)
-    task_ls = []
-    for year in year_set:
-      task_ls.append(asyncio.create_task(self._infer(self.df_cpa, subject, year, main_model_name, is_rag)))
-    await asyncio.gather(*task_ls)
\ No newline at end of file
+    await self.sweep(subject_ls=[subject],
+                     year_ls={subject: year_set},
+                     model_ls=[main_model_name],
+                     is_rag=is_rag,
+                     sub_model_name=sub_model_name,
+                     llama_model_path=llama_model_path,
+                     )
+    self.agent = self.agents[main_model_name]
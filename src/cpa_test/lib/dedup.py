@@ -0,0 +1,228 @@
+from logging import getLogger
+logger = getLogger(__name__)
+
+import os
+import re
+import zlib
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from .embedding_cache import normalize_text
+from .util import load_prompts
+
+_PRIME = (1 << 31) - 1 # the hashes are taken modulo this prime, so a * x + b fits in uint64
+_PUNCTUATION = str.maketrans({"、": ",", "。": "."}) # "，" and "．" are "," and "." after NFKC
+_YEAR_PATTERN = re.compile(r"([HR])(\d+)(?:_(\d+))?")
+
+def normalize_sentence(text:str)->str:
+    """normalize_sentence function
+
+    Normalize a statement for the duplicate detection (NFKC, the Japanese punctuation and no white spaces),
+    so the statements which differ only in the width of the characters, the commas or the spaces are the same.
+    """
+    return re.sub(r"\s", "", normalize_text(str(text)).translate(_PUNCTUATION))
+
+def year_order(year:str)->tuple:
+    """year_order function
+
+    Sort key of the exam years, e.g. H31_2 < R2_1 < R3. The unknown years come last in the order of their names.
+    """
+    match = _YEAR_PATTERN.fullmatch(year)
+    if match is None:
+        return (2, 0, 0, year)
+    era, n, session = match.groups()
+    return (0 if era == "H" else 1, int(n), int(session or 0), year)
+
+def _shingles(text:str, shingle_size:int)->np.ndarray:
+    # character shingles, since the statements are not separated by spaces
+    grams = {text[k:k + shingle_size] for k in range(max(1, len(text) - shingle_size + 1))}
+    return np.array([zlib.crc32(g.encode("utf-8")) % _PRIME for g in grams], dtype=np.uint64)
+
+def minhash(texts:list, num_perm:int=128, shingle_size:int=3, seed:int=0)->np.ndarray:
+    """minhash function
+
+    This function computes the MinHash signatures of the texts over their character shingles.
+    The fraction of the equal values of two signatures estimates the Jaccard similarity of their shingles.
+
+    Args:
+        texts(list): normalized texts
+        num_perm(int): number of the hash functions
+        shingle_size(int): number of the characters of a shingle
+        seed(int): seed of the hash functions
+
+    Returns:
+        np.ndarray: signatures of shape (len(texts), num_perm)
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, _PRIME, size=(num_perm, 1), dtype=np.uint64)
+    b = rng.integers(0, _PRIME, size=(num_perm, 1), dtype=np.uint64)
+    sig = np.empty((len(texts), num_perm), dtype=np.uint64)
+    for k, text in enumerate(texts):
+        sig[k] = ((a * _shingles(text, shingle_size)[None, :] + b) % _PRIME).min(axis=1)
+    return sig
+
+def _find(parent:np.ndarray, x:int)->int:
+    while parent[x] != x:
+        parent[x] = parent[parent[x]]
+        x = parent[x]
+    return x
+
+def build_dedup_index(df_prompt:pd.DataFrame,
+                      threshold:float=0.8,
+                      num_perm:int=128,
+                      n_bands:int=32,
+                      shingle_size:int=3,
+                      seed:int=0,
+                      )->pd.DataFrame:
+    """build_dedup_index function
+
+    This function finds the exact and the near duplicates of the statements of the prompt table across the years.
+    The exact duplicates share the hash of the normalized statement.
+    The near duplicates are found by LSH: the MinHash signatures are split into n_bands bands,
+    the statements sharing a band are the candidates, and the candidates whose estimated Jaccard similarity
+    is at least threshold are joined into one cluster (union-find), so a cluster may chain the paraphrases.
+    The questions which gen_questions does not support (5 choices) are not indexed.
+
+    Args:
+        df_prompt(pd.DataFrame): prompt table of load_prompts
+        threshold(float): minimum estimated Jaccard similarity of the near duplicates
+        num_perm(int): number of the hash functions of MinHash. it must be divisible by n_bands.
+        n_bands(int): number of the bands of LSH
+        shingle_size(int): number of the characters of a shingle
+        seed(int): seed of the hash functions
+
+    Returns:
+        pd.DataFrame: subject, year, q_no, statement, sentence, answer, prompt_id (hash of the prompt sent to the model),
+            exact_id (hash of the normalized statement), cluster_id (index of the near duplicate cluster) and cluster_size
+    """
+    if num_perm % n_bands:
+        raise ValueError(f"num_perm ({num_perm}) must be divisible by n_bands ({n_bands}).")
+    df = df_prompt[df_prompt["supported"]].reset_index(drop=True)
+    texts = [normalize_sentence(s) for s in df["sentence"]]
+    exact_id = [hashlib.sha256(t.encode("utf-8")).hexdigest()[:16] for t in texts]
+    parent = np.arange(len(df))
+    sig = minhash(texts, num_perm, shingle_size, seed)
+    rows = num_perm // n_bands
+    n_candidates = 0
+    for band in range(n_bands):
+        _, bucket = np.unique(sig[:, band * rows:(band + 1) * rows], axis=0, return_inverse=True)
+        order = np.argsort(bucket.ravel(), kind="stable")
+        for members in np.split(order, np.flatnonzero(np.diff(bucket.ravel()[order])) + 1):
+            for k, x in enumerate(members[:-1]):
+                for y in members[k + 1:]:
+                    rx, ry = _find(parent, x), _find(parent, y)
+                    if rx == ry:
+                        continue
+                    n_candidates += 1
+                    if (sig[x] == sig[y]).mean() >= threshold:
+                        parent[max(rx, ry)] = min(rx, ry)
+    root = np.array([_find(parent, x) for x in range(len(df))])
+    _, cluster_id, cluster_size = np.unique(root, return_inverse=True, return_counts=True)
+    logger.info(f"dedup index: {len(df)} statements, {len(set(exact_id))} distinct, {cluster_size.size} clusters ({n_candidates} candidate pairs checked).")
+    return pd.DataFrame({"subject": df["subject"],
+                         "year": df["year"],
+                         "q_no": df["q_no"],
+                         "statement": df["statement"],
+                         "sentence": df["sentence"],
+                         "answer": df["answer"],
+                         "prompt_id": [hashlib.sha256(p.encode("utf-8")).hexdigest()[:16] for p in df["prompt"]],
+                         "exact_id": exact_id,
+                         "cluster_id": cluster_id.ravel(),
+                         "cluster_size": cluster_size[cluster_id.ravel()],
+                         })
+
+def dedup_report(df_index:pd.DataFrame)->tuple:
+    """dedup_report function
+
+    This function summarizes the duplicate clusters of build_dedup_index and the contamination between the years.
+    A statement is contaminated when the same (exact) or a similar (near) statement is asked in an earlier year.
+
+    Args:
+        df_index(pd.DataFrame): index of build_dedup_index
+
+    Returns:
+        df_clusters (pd.DataFrame): cluster_id, size, distinct (number of the distinct statements), n_years, years,
+            consistent (the answers of the cluster agree) and sentence (the first statement) of the clusters of 2 or more statements
+        df_years (pd.DataFrame): year, statements, dedup_saved (the prompts identical to a former one, i.e. the requests saved by
+            the dedup mode of CpaTest, which shares the answers of the identical prompts only), exact_earlier and near_earlier
+            (the contaminated statements), and their rates
+        df_overlap (pd.DataFrame): number of the statements of the year (row) whose cluster is asked in the other year (column)
+    """
+    years = sorted(df_index["year"].unique(), key=year_order)
+    rank = df_index["year"].map({y: k for k, y in enumerate(years)})
+    df = df_index.assign(rank=rank)
+    df_dup = df[df["cluster_size"] > 1]
+    df_clusters = df_dup.groupby("cluster_id", sort=False).agg(size=("sentence", "size"),
+                                                               distinct=("exact_id", "nunique"),
+                                                               n_years=("year", "nunique"),
+                                                               years=("year", lambda y: " ".join(sorted(set(y), key=year_order))),
+                                                               consistent=("answer", lambda a: a.nunique() == 1),
+                                                               sentence=("sentence", "first")).reset_index()
+    df_clusters = df_clusters.sort_values(["n_years", "size"], ascending=False).reset_index(drop=True)
+
+    # the earliest year of every exact statement and of every cluster
+    first_exact = df.groupby("exact_id")["rank"].transform("min")
+    first_cluster = df.groupby("cluster_id")["rank"].transform("min")
+    saved = df.sort_values("rank", kind="stable")["prompt_id"].duplicated()
+    df_years = df.assign(dedup_saved=saved,
+                         exact_earlier=first_exact < df["rank"],
+                         near_earlier=first_cluster < df["rank"]).groupby("year", sort=False).agg(
+        statements=("sentence", "size"),
+        dedup_saved=("dedup_saved", "sum"),
+        exact_earlier=("exact_earlier", "sum"),
+        near_earlier=("near_earlier", "sum"),
+    ).reindex(years).reset_index()
+    df_years["exact_earlier_rate"] = df_years["exact_earlier"] / df_years["statements"]
+    df_years["near_earlier_rate"] = df_years["near_earlier"] / df_years["statements"]
+
+    pairs = df[["year", "cluster_id"]].merge(df[["year", "cluster_id"]].drop_duplicates(), on="cluster_id", suffixes=("", "_other"))
+    overlap = pd.crosstab(pairs["year"], pairs["year_other"]).reindex(index=years, columns=years, fill_value=0).to_numpy().copy()
+    # every statement matches itself, so the diagonal counts the duplicates within the year instead
+    np.fill_diagonal(overlap, df.groupby("year")["cluster_id"].agg(lambda c: c.duplicated(keep=False).sum()).reindex(years).to_numpy())
+    df_overlap = pd.DataFrame(overlap, index=pd.Index(years, name="year"), columns=years)
+    return df_clusters, df_years, df_overlap
+
+def output_dedup_report(data_path:str,
+                        subject_ls:list | set | tuple,
+                        pre_question:str,
+                        post_question:str,
+                        output_path:str,
+                        threshold:float=0.8,
+                        cache_dir:str=None,
+                        )->dict:
+    """output_dedup_report function
+
+    This function builds the dedup index of every subject over the prompts of load_prompts
+    and dumps the index, the clusters, the years and the overlap of the years to output_path.
+
+    Args:
+        data_path(str): path to the folder where the cpa data is stored
+        subject_ls(list | set | tuple): subjects (like audit, co_act,...)
+        pre_question(str): prompt which is given before the question
+        post_question(str): prompt which is given after the question
+        output_path(str): folder of the report
+        threshold(float): minimum estimated Jaccard similarity of the near duplicates
+        cache_dir(str): folder where the prompt tables are cached
+
+    Returns:
+        dict: tables of dedup_report keyed by subject
+    """
+    os.makedirs(output_path, exist_ok=True)
+    report = {}
+    for subject in subject_ls:
+        df_index = build_dedup_index(load_prompts(data_path, subject, pre_question, post_question, cache_dir=cache_dir), threshold=threshold)
+        df_clusters, df_years, df_overlap = dedup_report(df_index)
+        df_index.to_csv(f"{output_path}/dedup_index_{subject}.csv", index=False)
+        df_clusters.to_csv(f"{output_path}/dedup_clusters_{subject}.csv", index=False)
+        df_years.to_csv(f"{output_path}/dedup_years_{subject}.csv", index=False)
+        df_overlap.to_csv(f"{output_path}/dedup_overlap_{subject}.csv")
+        n = len(df_index)
+        logger.info(f"duplicates of {subject}: {int(df_years['dedup_saved'].sum())} of {n} prompts are identical to a former one "
+                    "(only these are saved by the dedup mode), "
+                    f"{int(df_years['exact_earlier'].sum())} statements are asked in an earlier year and "
+                    f"{int(df_years['near_earlier'].sum())} are similar to one. "
+                    f"{int((~df_clusters['consistent']).sum())} clusters have different answers.\n{df_years.to_string(index=False)}")
+        report[subject] = {"clusters": df_clusters, "years": df_years, "overlap": df_overlap}
+    return report
@@ -0,0 +1,125 @@
+from logging import getLogger
+logger = getLogger(__name__)
+
+import os
+import re
+import json
+import hashlib
+import unicodedata
+
+import numpy as np
+
+VECTORS_FILE = "vectors.f32"
+KEYS_FILE = "keys.txt"
+META_FILE = "meta.json"
+KEY_LENGTH = 64 # sha256 hex digest
+
+def normalize_text(text:str)->str:
+    """normalize_text function
+
+    Normalize a chunk text for the cache key (NFKC and collapsed white spaces),
+    so the chunks which differ only in the width of the characters or the line breaks share the vector.
+    """
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip()
+
+class EmbeddingCache:
+    """EmbeddingCache
+
+    This class is an append-only cache of the chunk embeddings of one embedding model.
+    The key is the hash of the embedding model and the normalized text.
+    The vectors are appended to one raw float32 file, which is memory-mapped for the lookups,
+    so the vectors are read without loading the whole cache into memory,
+    and the keys are appended to an index file in the same order as the rows.
+
+    Attributes:
+        PATH(str): folder of the cache of the model
+        MODEL(str): name of the embedding model
+        dim(int): number of dimensions. None until the first vector is stored.
+        rows(dict): row of each key
+        hits(int): number of hits
+        misses(int): number of misses
+    """
+    def __init__(self,
+                 path:str, # folder of the caches
+                 model:str, # name of the embedding model
+                 ):
+        self.MODEL = model
+        self.PATH = f"{path}/{hashlib.sha1(model.encode('utf-8')).hexdigest()[:16]}"
+        os.makedirs(self.PATH, exist_ok=True)
+        self.dim = None
+        self.rows = {}
+        self.hits = 0
+        self.misses = 0
+        self._vectors = None
+        if os.path.exists(f"{self.PATH}/{META_FILE}"):
+            with open(f"{self.PATH}/{META_FILE}", encoding="UTF-8") as f:
+                self.dim = json.load(f)["dim"]
+            self._load()
+
+    def __len__(self)->int:
+        return len(self.rows)
+
+    def _load(self)->None:
+        keys_file, vectors_file = f"{self.PATH}/{KEYS_FILE}", f"{self.PATH}/{VECTORS_FILE}"
+        if not (os.path.exists(keys_file) and os.path.exists(vectors_file)):
+            return
+        # the rows written completely both in the vectors and the keys are valid (the last append may be cut off)
+        n = min(os.path.getsize(keys_file) // (KEY_LENGTH + 1), os.path.getsize(vectors_file) // (4 * self.dim))
+        with open(keys_file, "rb") as f:
+            keys = f.read(n * (KEY_LENGTH + 1)).decode("ascii").split("\n")
+        self.rows = {k: i for i, k in enumerate(keys[:n])}
+        self._vectors = np.memmap(vectors_file, dtype=np.float32, mode="r", shape=(n, self.dim)) if n else None
+
+    def make_key(self, text:str)->str:
+        return hashlib.sha256(f"{self.MODEL}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def _append(self, keys:list, vectors:np.ndarray)->None:
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            with open(f"{self.PATH}/{META_FILE}", "w", encoding="UTF-8") as f:
+                json.dump({"model": self.MODEL, "dim": self.dim}, f)
+        n = len(self.rows)
+        for file_name, data, row_bytes in [
+            (VECTORS_FILE, np.ascontiguousarray(vectors, dtype=np.float32).tobytes(), 4 * self.dim),
+            (KEYS_FILE, "".join(f"{k}\n" for k in keys).encode("ascii"), KEY_LENGTH + 1),
+        ]:
+            with open(f"{self.PATH}/{file_name}", "ab") as f:
+                f.truncate(n * row_bytes) # drop the rest of an interrupted append
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        self._load()
+
+    def embed(self, texts:list, embeddings, batch_size:int=1000)->np.ndarray:
+        """embed function
+
+        This function returns the vectors of the texts.
+        Only the texts which are not cached are sent to the embedding function in batches, and they are cached.
+
+        Args:
+            texts(list): texts to embed
+            embeddings: embedding function (embed_documents)
+            batch_size(int): number of texts embedded in one request
+
+        Returns:
+            np.ndarray: (number of texts, dim) float32 matrix
+        """
+        keys = [self.make_key(t) for t in texts]
+        new = {}
+        for k, t in zip(keys, texts):
+            if k not in self.rows and k not in new:
+                new[k] = t
+        self.misses += len(new)
+        self.hits += len(texts) - len(new)
+        new_keys = list(new)
+        for i in range(0, len(new_keys), batch_size):
+            batch = new_keys[i:i + batch_size]
+            self._append(batch, np.asarray(embeddings.embed_documents([new[k] for k in batch]), dtype=np.float32))
+        if not texts:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        return self._vectors[[self.rows[k] for k in keys]]
+
+    def stats(self)->dict:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0,
+                "vectors": len(self.rows)}
@@ -1,8 +1,158 @@
 from logging import getLogger
 logger = getLogger(__name__)
 
+import numpy as np
 import pandas as pd
-from sklearn.metrics import confusion_matrix, accuracy_score, precision_recall_fscore_support
+
+LABELS = ["False", "True"]
+METRICS_COLUMNS = ["TN", "FP", "FN", "TP", "accuracy", "precision", "recall", "f1-score", "support"]
+
+def load_results(RESULT_PATH:str,
+                 subject_ls:list | set | tuple,
+                 year_set:list | set | tuple | dict,
+                 model_ls:list | set | tuple,
+                 is_rag_ls:list | set | tuple,
+                 )->pd.DataFrame:
+    """load_results
+
+    This function loads the result csv files into one long table.
+
+    Args:
+        RESULT_PATH (str): path of result
+        subject_ls (list | set | tuple): subjects (like audit, co_act,...)
+        year_set (list | set | tuple | dict): years. a dict gives the years of each subject.
+        model_ls (list | set | tuple): model names
+        is_rag_ls (list | set | tuple): using RAG or not
+
+    Returns:
+        pd.DataFrame: subject, is_rag, model_name, year, result, answer, status ("ok" or "error:<error class>")
+            and confidence (NaN except the scoring mode) of every statement
+    """
+    df_ls = []
+    for subject in subject_ls:
+        years = year_set[subject] if isinstance(year_set, dict) else year_set
+        for is_rag in is_rag_ls:
+            for model_name in model_ls:
+                for year in years:
+                    df_res = pd.read_csv(f"{RESULT_PATH}/csv/{subject}_{year}_{model_name}_rag_{is_rag}.csv")
+                    df_ls.append(pd.DataFrame({"subject": subject,
+                                               "is_rag": is_rag,
+                                               "model_name": model_name,
+                                               "year": year,
+                                               "result": df_res["result"].astype(str),
+                                               "answer": df_res["answer"].astype(str),
+                                               # the results before the status column are all answered
+                                               "status": df_res["status"].astype(str) if "status" in df_res else "ok",
+                                               "confidence": df_res["confidence"].astype(float) if "confidence" in df_res else np.nan,
+                                               }))
+    return pd.concat(df_ls, ignore_index=True)
+
+def summarize(df_res:pd.DataFrame, by:list=["model_name", "year"])->pd.DataFrame:
+    """summarize
+
+    This function calculates the metrics of every group of the long table at once.
+    The rows which are not answered in True or False are removed as in get_metrics.
+    The removed rows (the failed requests and the invalid answers) are counted and warned per group.
+    The confusion matrices of all the groups are counted by one bincount.
+
+    Args:
+        df_res (pd.DataFrame): long table of load_results
+        by (list): columns to group by (ex. ["model_name", "year"], ["subject", "model_name"]). [] means overall.
+
+    Returns:
+        pd.DataFrame: the columns of by and TN, FP, FN, TP, accuracy, precision, recall, f1-score and support
+    """
+    by = list(by)
+    if by:
+        group_id = df_res.groupby(by, sort=False).ngroup().to_numpy()
+        df_key = df_res[by].drop_duplicates().reset_index(drop=True)
+    else:
+        group_id = np.zeros(len(df_res), dtype=np.int64)
+        df_key = pd.DataFrame(index=[0])
+    n_group = len(df_key)
+    valid = df_res["result"].isin(LABELS).to_numpy()
+    failed = (df_res["status"] != "ok").to_numpy() if "status" in df_res else np.zeros(len(df_res), dtype=bool)
+    n_failed = np.bincount(group_id[failed], minlength=n_group)
+    n_invalid = np.bincount(group_id[~valid & ~failed], minlength=n_group)
+    for g in np.flatnonzero(n_failed + n_invalid):
+        key = ", ".join(f"{k}={v}" for k, v in df_key.iloc[g].items()) or "all"
+        logger.warning(f"{key}: {n_failed[g]} failed requests and {n_invalid[g]} invalid answers are removed from the metrics.")
+    # 0:TN, 1:FP, 2:FN, 3:TP
+    code = 2 * (df_res["answer"].to_numpy() == "True") + (df_res["result"].to_numpy() == "True")
+    tn, fp, fn, tp = np.bincount(group_id[valid] * 4 + code[valid], minlength=n_group * 4).reshape(n_group, 4).T
+    sup = tn + fp + fn + tp
+    with np.errstate(divide="ignore", invalid="ignore"):
+        acc = (tp + tn) / sup
+        pre = np.where(tp + fp > 0, tp / (tp + fp), 0.0)
+        rec = np.where(tp + fn > 0, tp / (tp + fn), 0.0)
+        f1 = np.where(2 * tp + fp + fn > 0, 2 * tp / (2 * tp + fp + fn), 0.0)
+    df_metrics = pd.DataFrame({"TN": tn, "FP": fp, "FN": fn, "TP": tp,
+                               "accuracy": acc, "precision": pre, "recall": rec, "f1-score": f1,
+                               "support": sup})
+    return pd.concat([df_key, df_metrics], axis=1)
+
+def _scored(df_res:pd.DataFrame)->pd.DataFrame:
+    # the answered rows with a confidence, and the probability of True
+    df = df_res[df_res["result"].isin(LABELS) & df_res["confidence"].notna()]
+    return df.assign(p_true=np.where(df["result"] == "True", df["confidence"], 1 - df["confidence"]))
+
+def calibration(df_res:pd.DataFrame, by:list=["model_name"], n_bins:int=10)->tuple:
+    """calibration
+
+    This function measures how well the confidences of the scoring mode match the accuracy.
+    The rows without a confidence (the other modes, the failed requests) are ignored.
+
+    Args:
+        df_res (pd.DataFrame): long table of load_results
+        by (list): columns to group by
+        n_bins (int): number of the equal-width bins of the confidence
+
+    Returns:
+        df_calib (pd.DataFrame): the columns of by and support, accuracy, mean confidence,
+            ECE (expected calibration error), MCE (maximum calibration error) and Brier score of the probability of True
+        df_bins (pd.DataFrame): the columns of by and the bins with their count, mean confidence and accuracy (reliability diagram)
+    """
+    by = list(by)
+    df = _scored(df_res)
+    df = df.assign(correct=(df["result"] == df["answer"]).astype(float),
+                   sq_error=(df["p_true"] - (df["answer"] == "True")) ** 2,
+                   bin=np.minimum((df["confidence"] * n_bins).astype(int), n_bins - 1))
+    df_bins = df.groupby(by + ["bin"], sort=False).agg(count=("correct", "size"),
+                                                       confidence=("confidence", "mean"),
+                                                       accuracy=("correct", "mean")).reset_index()
+    df_bins = df_bins.assign(bin_lower=df_bins["bin"] / n_bins, bin_upper=(df_bins["bin"] + 1) / n_bins,
+                             gap=(df_bins["accuracy"] - df_bins["confidence"]).abs())
+    df_bins = df_bins.sort_values(by + ["bin"]).reset_index(drop=True)
+    df_calib = df.groupby(by, sort=False).agg(support=("correct", "size"),
+                                              accuracy=("correct", "mean"),
+                                              confidence=("confidence", "mean"),
+                                              brier=("sq_error", "mean")).reset_index()
+    weighted = df_bins.assign(w_gap=df_bins["gap"] * df_bins["count"]).groupby(by, sort=False)
+    df_calib = df_calib.merge(weighted["w_gap"].sum().rename("ece").reset_index(), on=by)
+    df_calib = df_calib.merge(weighted["gap"].max().rename("mce").reset_index(), on=by)
+    df_calib["ece"] /= df_calib["support"]
+    return df_calib, df_bins[by + ["bin_lower", "bin_upper", "count", "confidence", "accuracy"]]
+
+def threshold_sweep(df_res:pd.DataFrame, by:list=["model_name"], thresholds:list=None)->pd.DataFrame:
+    """threshold_sweep
+
+    This function relabels the statements of the scoring mode as True when the probability of True is
+    at least the threshold, and calculates the metrics of every threshold as in summarize.
+
+    Args:
+        df_res (pd.DataFrame): long table of load_results
+        by (list): columns to group by
+        thresholds (list): thresholds of the probability of True. 0.05, 0.10, ..., 0.95 if None.
+
+    Returns:
+        pd.DataFrame: the columns of by, threshold, and TN, FP, FN, TP, accuracy, precision, recall, f1-score and support
+    """
+    thresholds = np.round(np.arange(0.05, 1.0, 0.05), 2) if thresholds is None else np.asarray(thresholds)
+    df = _scored(df_res)
+    df_ls = [df.assign(threshold=t, result=np.where(df["p_true"] >= t, "True", "False")) for t in thresholds]
+    if not df_ls:
+        return pd.DataFrame(columns=[*by, "threshold", *METRICS_COLUMNS])
+    return summarize(pd.concat(df_ls, ignore_index=True), by=[*by, "threshold"])
 
 def get_metrics(RESULT_PATH:str,
                 subject:str,
@@ -27,24 +177,9 @@ def get_metrics(RESULT_PATH:str,
     Returns:
         set: metrics_dic
     """
-    df_res = pd.read_csv(f"{RESULT_PATH}/csv/{subject}_{year}_{model_name}_rag_{is_rag}.csv")
-    df_res["result"] = df_res["result"].astype(str)
-    df_res["answer"] = df_res["answer"].astype(str)
-    df_res = df_res[df_res["result"].isin(["True", "False"])] # remove the rows which are not answered in True or False
-    acc = accuracy_score(df_res["answer"], df_res["result"])
-    tn, fp, fn, tp = confusion_matrix(df_res["answer"],
-                          df_res["result"],
-                          labels=["False", "True"]
-                          ).flatten()
-    pre, rec, f1, _= precision_recall_fscore_support(df_res["answer"],
-                                           df_res["result"],
-                                           beta=1,
-                                           labels=["False", "True"],
-                                           pos_label="True",
-                                           average="binary")
-    sup = len(df_res)
-    metrics_dic = {"TN":tn, "FP":fp, "FN":fn, "TP":tp, "accuracy":acc, "precision":pre, "recall":rec, "f1-score":f1, "support":sup}
-    return metrics_dic
+    df_res = load_results(RESULT_PATH, [subject], [year], [model_name], [is_rag])
+    metrics_dic = summarize(df_res, by=[]).to_dict("records")[0]
+    return {k: metrics_dic[k] for k in METRICS_COLUMNS}
 
 def output_metrics(result_path: str,
                     subject:str,
@@ -56,6 +191,7 @@ def output_metrics(result_path: str,
 
     This function outputs the metrics of the model
     and dump it to the result path.
+    The calibration, the reliability bins and the threshold sweep are dumped as well when the results have confidences (the scoring mode).
 
     Args:
         result_path (str): path of result
@@ -63,11 +199,14 @@ def output_metrics(result_path: str,
         model_ls (list | set | tuple): model lists included in the output
         is_rag (bool): using RAG or not
     """
-
-    metrics_list = [
-        {"model_name": model_name, "year":year, **get_metrics(result_path, subject, year, model_name, is_rag)}
-        for model_name in model_ls for year in year_set
-    ]
-    eval_df = pd.DataFrame(metrics_list).reindex(columns=["model_name", "year", "TN", "FP", "FN", "TP", "accuracy", "precision", "recall", "f1-score", "support"])
+    df_res = load_results(result_path, [subject], year_set, model_ls, [is_rag])
+    eval_df = summarize(df_res, by=["model_name", "year"])
+    eval_df = eval_df.reindex(columns=["model_name", "year", *METRICS_COLUMNS])
     eval_df.to_csv(f"{result_path}/summary/summary_{subject}_rag_{is_rag}.csv")
-    return eval_df
\ No newline at end of file
+    if df_res["confidence"].notna().any():
+        df_calib, df_bins = calibration(df_res)
+        df_calib.to_csv(f"{result_path}/summary/calibration_{subject}_rag_{is_rag}.csv", index=False)
+        df_bins.to_csv(f"{result_path}/summary/reliability_{subject}_rag_{is_rag}.csv", index=False)
+        threshold_sweep(df_res).to_csv(f"{result_path}/summary/threshold_{subject}_rag_{is_rag}.csv", index=False)
+        logger.info(f"calibration of {subject}:\n{df_calib.to_string(index=False)}")
+    return eval_df
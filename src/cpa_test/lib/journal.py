@@ -0,0 +1,85 @@
+from logging import getLogger
+logger = getLogger(__name__)
+
+import os
+import json
+import hashlib
+
+class ResultJournal:
+  """ResultJournal
+
+  This class is an append-only journal of the answered statements of one (subject, year, model, rag).
+  Every record is flushed to the disk as soon as it is appended, so an interrupted run can resume from it.
+
+  Attributes:
+      PATH(str): path to the journal file (JSON lines)
+      records(dict): recorded answers keyed by (question index, statement index)
+  """
+  def __init__(self, path:str):
+    self.PATH = path
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    self.records = self._load()
+    self._file = open(path, "a", encoding="UTF-8")
+
+  def _load(self)->dict:
+    records = {}
+    if not os.path.exists(self.PATH):
+      return records
+    end = 0 # end of the last complete line
+    with open(self.PATH, "rb") as f:
+      for line in f:
+        if not line.endswith(b"\n"): # the last line is cut off by a crash
+          break
+        end += len(line)
+        try:
+          rec = json.loads(line)
+        except json.JSONDecodeError:
+          logger.warning(f"skipped a broken line in {self.PATH}.")
+          continue
+        records[(rec["q"], rec["s"])] = rec
+    if end < os.path.getsize(self.PATH):
+      # cut the broken tail off, so the next record is not appended to it
+      logger.warning(f"dropped the incomplete last line of {self.PATH}.")
+      os.truncate(self.PATH, end)
+    if records:
+      logger.info(f"resume {len(records)} statements from {self.PATH}.")
+    return records
+
+  @staticmethod
+  def _digest(query:str)->str:
+    return hashlib.sha1(query.encode("utf-8")).hexdigest()
+
+  def get(self, q_idx:int, s_idx:int, query:str)->dict:
+    """get function
+
+    Return the recorded answer of the statement.
+    The record is ignored if it was answered to a different query (e.g. the prompt was changed).
+
+    Args:
+        q_idx(int): question index in the year
+        s_idx(int): statement index in the question
+        query(str): query text
+
+    Returns:
+        record(dict): the record or None if not recorded
+    """
+    rec = self.records.get((q_idx, s_idx))
+    if rec is None or rec["query"] != self._digest(query):
+      return None
+    return rec
+
+  def append(self, q_idx:int, s_idx:int, query:str, result:str, answer, confidence:float=None)->None:
+    rec = {"q": q_idx, "s": s_idx, "query": self._digest(query), "result": result, "answer": answer}
+    if confidence is not None: # the scoring mode
+      rec["confidence"] = confidence
+    self._file.write(json.dumps(rec, ensure_ascii=False) + "\n")
+    self._file.flush()
+    os.fsync(self._file.fileno())
+    self.records[(q_idx, s_idx)] = rec
+
+  def close(self)->None:
+    self._file.close()
+
+  def remove(self)->None:
+    self.close()
+    os.remove(self.PATH)
@@ -0,0 +1,181 @@
+from logging import getLogger
+logger = getLogger(__name__)
+
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+_llama = None # the model loaded in this worker process
+_chat_format = None # chat format of the model loaded in this worker process
+_grammars = {} # parsed grammars of this worker process keyed by the GBNF text
+# prompt formatters of llama_cpp.llama_chat_format used by the scoring
+_CHAT_FORMATTERS = {"llama-2": "format_llama2", "llama-3": "format_llama3"}
+# the scoring rewinds Llama.n_tokens and reads Llama.input_ids and the logits of the context,
+# which are internals of llama_cpp checked with these versions
+_SCORING_VERSIONS = ("0.2.", "0.3.")
+
+def _state_bytes(llama)->int:
+  # upper bound of one state saved by Llama.save_state: the f16 keys and values of the full context
+  # in every layer (without grouped-query attention) and the logits of one batch
+  import llama_cpp
+  return 2 * llama_cpp.llama_n_layer(llama.model) * llama.n_ctx() * llama.n_embd() * 2 + llama.n_batch * llama.n_vocab() * 4
+
+def _init_worker(model_file:str, n_threads:int, n_ctx:int, chat_format:str, seed:int, prefix_cache_states:int)->None:
+  global _llama, _chat_format
+  from llama_cpp import Llama, LlamaRAMCache
+  _chat_format = chat_format
+  _llama = Llama(
+            model_path=model_file,
+            chat_format=chat_format,
+            n_threads=n_threads,
+            n_ctx=n_ctx,
+            seed=seed,
+            verbose=False
+  )
+  if prefix_cache_states > 0:
+    # the evaluated states are looked up by the longest common token prefix,
+    # so the statements of a question restore the state of the system prompt and the stem
+    # and only the differing statement is evaluated.
+    # the capacity is sized from n_ctx, so a stored state is not evicted at once by its own size.
+    capacity = prefix_cache_states * _state_bytes(_llama)
+    logger.info(f"prompt state cache of {capacity / (1 << 20):.0f} MiB ({prefix_cache_states} states of n_ctx {n_ctx}).")
+    _llama.set_cache(LlamaRAMCache(capacity_bytes=capacity))
+
+def _create_chat_completion(messages:list, kwargs:dict)->dict:
+  if isinstance(kwargs.get("grammar"), str):
+    # a grammar is sent as the GBNF text, since the parsed one can not be pickled
+    from llama_cpp import LlamaGrammar
+    text = kwargs["grammar"]
+    if text not in _grammars:
+      _grammars[text] = LlamaGrammar.from_string(text, verbose=False)
+    kwargs = {**kwargs, "grammar": _grammars[text]}
+  return _llama.create_chat_completion(messages=messages, **kwargs)
+
+def _tokenize_prompt(text:str, add_bos:bool)->list:
+  tokens = _llama.tokenize(text.encode("utf-8"), add_bos=add_bos, special=True)
+  bos = _llama.token_bos()
+  if len(tokens) > 1 and tokens[0] == tokens[1] == bos: # the formatter has put "<s>" at the head of the prompt
+    tokens = tokens[1:]
+  return tokens
+
+def _score_labels(messages_ls:list, labels:list)->list:
+  # the prompts are evaluated one after another by Llama.eval in this worker,
+  # and the evaluated prefix of the former prompt is reused by rewinding Llama.n_tokens (llama_cpp internals).
+  import llama_cpp
+  from llama_cpp import llama_chat_format
+
+  if not llama_cpp.__version__.startswith(_SCORING_VERSIONS):
+    raise NotImplementedError(f"The scoring is not tested with llama_cpp {llama_cpp.__version__}. ({', '.join(v + 'x' for v in _SCORING_VERSIONS)} are supported.)")
+  if _chat_format not in _CHAT_FORMATTERS:
+    raise NotImplementedError(f"The scoring does not support the chat format {_chat_format}.")
+  formatter = getattr(llama_chat_format, _CHAT_FORMATTERS[_chat_format])
+  res = []
+  for messages in messages_ls:
+    result = formatter(messages=messages)
+    # tokenized as create_chat_completion does, with a single BOS
+    seqs = [_tokenize_prompt(f"{result.prompt} {label}", add_bos=not result.added_special) for label in labels]
+    # the labels are compared at their first differing token, so the prompt is evaluated only once
+    n = 0
+    while all(n < len(seq) for seq in seqs) and len(set(seq[n] for seq in seqs)) == 1:
+      n += 1
+    context = seqs[0][:n]
+    # reuse the evaluated prefix of the former prompt (the system prompt and the question stem).
+    # at least the last token is evaluated again to get its logits.
+    evaluated = _llama.input_ids[:_llama.n_tokens].tolist()
+    prefix = 0
+    while prefix < min(len(evaluated), len(context) - 1) and evaluated[prefix] == context[prefix]:
+      prefix += 1
+    _llama.n_tokens = prefix
+    _llama.eval(context[prefix:])
+    logits = np.ctypeslib.as_array(llama_cpp.llama_get_logits(_llama.ctx), shape=(_llama.n_vocab(),)).astype(np.float64)
+    logprobs = logits - (logits.max() + np.log(np.exp(logits - logits.max()).sum()))
+    res.append({"logprobs": {label: float(logprobs[seq[n]]) for label, seq in zip(labels, seqs)},
+                "prompt_tokens": len(context),
+                "evaluated_tokens": len(context) - prefix})
+  return res
+
+class LlamaPool:
+  """LlamaPool
+
+  This class is a pool of worker processes which serve one local model.
+  Each worker loads the model once when it starts, and the requests are sent to the workers
+  through a process pool executor, so the blocking inference does not stall the event loop.
+  Llama.generate already reuses the evaluated prefix of the former prompt of the worker.
+  With PREFIX_CACHE_STATES, each worker also keeps the evaluated prompt states, so a prompt which shares a prefix
+  (the system prompt and the question stem) with an older one only evaluates the rest.
+  It is off by default, since every state is saved after each completion and takes the memory of the full context.
+  The workers are started on the first request and the model is released by close.
+
+  Attributes:
+      MODEL_FILE(str): path to the gguf file
+      N_INSTANCES(int): number of worker processes, i.e. number of loaded copies of the model
+      N_THREADS(int): number of threads used by each worker. llama_cpp decides it if None.
+      N_CTX(int): context size
+      CHAT_FORMAT(str): chat format of llama_cpp
+      SEED(int): seed of the model
+      PREFIX_CACHE_STATES(int): number of the prompt states of n_ctx kept by each worker. The cache is disabled if 0.
+  """
+  def __init__(self,
+               model_file:str, # path to the gguf file
+               n_instances:int=1, # number of worker processes
+               n_threads:int=None, # number of threads used by each worker
+               n_ctx:int=512, # context size
+               chat_format:str="llama-2", # chat format of llama_cpp
+               seed:int=0, # seed of the model
+               prefix_cache_states:int=0, # number of the prompt states kept by each worker
+               ):
+    if n_instances < 1:
+      raise ValueError(f"n_instances must be positive. {n_instances}")
+    self.MODEL_FILE = model_file
+    self.N_INSTANCES = n_instances
+    self.N_THREADS = n_threads
+    self.N_CTX = n_ctx
+    self.CHAT_FORMAT = chat_format
+    self.SEED = seed
+    self.PREFIX_CACHE_STATES = prefix_cache_states
+    self._executor = None
+
+  def _get_executor(self)->ProcessPoolExecutor:
+    if self._executor is None:
+      logger.info(f"load {self.MODEL_FILE} into {self.N_INSTANCES} worker(s)...")
+      self._executor = ProcessPoolExecutor(
+        max_workers=self.N_INSTANCES,
+        mp_context=multiprocessing.get_context("spawn"), # do not fork the running event loop
+        initializer=_init_worker,
+        initargs=(self.MODEL_FILE, self.N_THREADS, self.N_CTX, self.CHAT_FORMAT, self.SEED, self.PREFIX_CACHE_STATES),
+      )
+    return self._executor
+
+  async def create_chat_completion(self, messages:list, **kwargs)->dict:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(self._get_executor(), _create_chat_completion, messages, kwargs)
+
+  async def score_labels(self, messages_ls:list, labels:list)->list:
+    """score_labels function
+
+    Evaluate each prompt once without decoding and return the log-probabilities of the labels as its continuation.
+    The prompts are sent to one worker together, so the prompts sharing a prefix (the statements of a question)
+    evaluate the shared prefix only once.
+
+    Args:
+        messages_ls(list): chat messages of each prompt
+        labels(list): labels to compare (e.g. ["True", "False"])
+
+    Returns:
+        list: {"logprobs": log-probability of each label, "prompt_tokens": tokens of the prompt,
+            "evaluated_tokens": tokens actually evaluated} of each prompt
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(self._get_executor(), _score_labels, messages_ls, labels)
+
+  def close(self)->None:
+    """close function
+
+    Stop the workers and release the loaded models.
+    """
+    if self._executor is not None:
+      self._executor.shutdown(wait=True)
+      self._executor = None
+      logger.info(f"released {self.MODEL_FILE}.")
@@ -1,93 +1,213 @@
 from logging import getLogger
 logger = getLogger(__name__)
 import os
+import json
+import shutil
+import time
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .chunker import CHUNKER_VERSION, chunk_pdf
+from .embedding_cache import EmbeddingCache
+from .vector_index import INDEX_DIR, META_FILE, VectorIndex, embedding_name, get_embeddings
+
+MANIFEST_NAME = "manifest.json"
+
+def _file_sha256(path:str)->str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def _load_manifest(path:str)->dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="UTF-8") as f:
+        return json.load(f)
+
+def _dump_manifest(manifest:dict, path:str)->None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="UTF-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+def _load_doc(doc_path:str)->tuple:
+    with open(f"{doc_path}.json", encoding="UTF-8") as f:
+        chunks = [tuple(c) for c in json.load(f)]
+    return chunks, np.load(f"{doc_path}.npy", mmap_mode="r")
+
+def _dump_doc(doc_path:str, chunks:list, vectors:np.ndarray)->None:
+    with open(f"{doc_path}.json", "w", encoding="UTF-8") as f:
+        json.dump(chunks, f, ensure_ascii=False)
+    np.save(f"{doc_path}.npy", vectors)
 
 def mk_chromadb(PDF_PATH:str="./reports",
                 chunk_size:int=1000,
                 chunk_overlap:int=0,
-                separators:list=["第", "."]
-                ):
+                min_chunk_size:int=None,
+                persist_path:str="./vectorstore_agents",
+                n_workers:int=None,
+                embedding_batch_size:int=1000,
+                embeddings=None,
+                embedding_cache_path:str="./cache/embeddings",
+                )->VectorIndex:
     """mk_chromadb function
 
-    This function generates a Chroma database from the PDF files in the PDF_PATH directory.
+    This function generates one retrieval index over the chunks of all the PDF files in the PDF_PATH directory.
+    The content hash of every PDF file, the chunking parameters and the embedding are recorded in a manifest,
+    and the unchanged files are skipped, so only the added or modified files are split and embedded again.
+    The PDF files are streamed page by page and split at the articles and the paragraphs (chunker.iter_chunks)
+    in a process pool, and the chunks of all the files are embedded together in batched requests.
+    The chunks and the vectors of each file are kept in persist_path/docs,
+    and they are joined into the index in persist_path/index.
 
     Args:
         PDF_PATH(str): path to the PDF files.
+        chunk_size(int): maximum number of characters of a chunk.
+        chunk_overlap(int): number of characters of the previous chunk put at the head of a chunk.
+        min_chunk_size(int): minimum size of a chunk closed at an article. chunk_size // 4 if None.
+        persist_path(str): directory of the index and the manifest.
+        n_workers(int): number of processes to load the PDF files. os.cpu_count() if None.
+        embedding_batch_size(int): number of chunks embedded in one request.
+        embeddings: embedding function. OpenAIEmbeddings if None.
+        embedding_cache_path(str): directory of the embedding cache keyed by the chunk text,
+            so the unchanged chunks are not embedded again when the chunking parameters are changed. The cache is not used if None.
 
     Returns:
-        None
+        VectorIndex: the index
     """
     from tqdm import tqdm
-    from langchain.embeddings.openai import OpenAIEmbeddings
-    from langchain.vectorstores import Chroma
-    from langchain.text_splitter import RecursiveCharacterTextSplitter
-    from langchain.document_loaders import PyPDFLoader
+    if embeddings is None:
+        from langchain.embeddings.openai import OpenAIEmbeddings
+        embeddings = OpenAIEmbeddings()
+
+    doc_dir = f"{persist_path}/docs"
+    index_path = f"{persist_path}/{INDEX_DIR}"
+    os.makedirs(doc_dir, exist_ok=True)
+    manifest_path = f"{persist_path}/{MANIFEST_NAME}"
+    manifest = _load_manifest(manifest_path)
+    params = {"chunk_size": chunk_size, "chunk_overlap": chunk_overlap, "min_chunk_size": min_chunk_size, "chunker": CHUNKER_VERSION,
+              "embedding": embedding_name(embeddings)}
+
+    pdf_files = [{"name":f[:-4], "path":f"{PDF_PATH}/{f}"} for f in sorted(os.listdir(PDF_PATH)) if f.lower().endswith(".pdf")]
+    for f in pdf_files:
+        f["sha256"] = _file_sha256(f["path"])
+    # drop the removed files
+    removed_ls = set(manifest).difference(f["name"] for f in pdf_files)
+    for name in removed_ls:
+        for ext in [".json", ".npy"]:
+            if os.path.exists(f"{doc_dir}/{name}{ext}"):
+                os.remove(f"{doc_dir}/{name}{ext}")
+        del manifest[name]
+        logger.info(f"removed {name} from {persist_path}.")
+    todo_ls = [f for f in pdf_files
+               if manifest.get(f["name"]) != {"sha256": f["sha256"], **params}
+               or not os.path.exists(f"{doc_dir}/{f['name']}.npy")]
+    logger.info(f"{len(pdf_files) - len(todo_ls)} of {len(pdf_files)} PDF files are up to date. build {len(todo_ls)} files.")
+
+    if todo_ls or removed_ls:
+        # the index is stale until it is built again
+        if os.path.exists(f"{index_path}/{META_FILE}"):
+            os.remove(f"{index_path}/{META_FILE}")
+    if todo_ls:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            started_at = time.perf_counter()
+            futures = [executor.submit(chunk_pdf, f["path"], chunk_size, chunk_overlap, min_chunk_size) for f in todo_ls]
+            chunks_ls, stats_ls = zip(*[future.result() for future in tqdm(futures, total=len(futures), desc="split")])
+            wall = time.perf_counter() - started_at
+        n_pages = sum(st["pages"] for st in stats_ls)
+        n_chunks = [st["chunks"] for st in stats_ls]
+        logger.info(f"split {n_pages} pages of {len(todo_ls)} files into {sum(n_chunks)} chunks: "
+                    f"{n_pages / wall:.1f} pages/s, {sum(n_chunks) / len(n_chunks):.1f} chunks/doc (min {min(n_chunks)}, max {max(n_chunks)}).")
+
+        texts = [text for chunks in chunks_ls for text, _ in chunks]
+        if embedding_cache_path is None:
+            vectors = {}
+            uniq_texts = list(dict.fromkeys(texts))
+            for i in tqdm(range(0, len(uniq_texts), embedding_batch_size), desc="embed"):
+                batch = uniq_texts[i:i + embedding_batch_size]
+                vectors.update(zip(batch, embeddings.embed_documents(batch)))
+            matrix = np.asarray([vectors[text] for text in texts], dtype=np.float32)
+        else:
+            cache = EmbeddingCache(embedding_cache_path, params["embedding"])
+            matrix = cache.embed(texts, embeddings, batch_size=embedding_batch_size)
+            stats = cache.stats()
+            logger.info(f"embedding cache: {stats['hits']} hits, {stats['misses']} misses (hit rate {stats['hit_rate']:.1%}).")
+
+        start = 0
+        for f, chunks in zip(todo_ls, chunks_ls):
+            _dump_doc(f"{doc_dir}/{f['name']}", chunks, matrix[start:start + len(chunks)])
+            start += len(chunks)
+            # record the file as soon as it is dumped, so an interrupted build resumes from the next file
+            manifest[f["name"]] = {"sha256": f["sha256"], **params}
+            _dump_manifest(manifest, manifest_path)
+
+    if not todo_ls and not removed_ls and os.path.exists(f"{index_path}/{META_FILE}"):
+        return VectorIndex.load(index_path)
+    _dump_manifest(manifest, manifest_path)
+    docs = [(f["name"], *_load_doc(f"{doc_dir}/{f['name']}")) for f in pdf_files]
+    return VectorIndex.build(index_path, docs, params["embedding"])
+
+def load_retriever(persist_path:str="./vectorstore_agents", k:int=4, sources:list=None):
+    """load_retriever function
+
+    This function loads the index of mk_chromadb
+    and returns a function which retrieves the top-k chunks of a query as one text with their source, page and article.
+    The retrieval does not call LLM.
 
-    pdf_files = [{"name":f[:-4], "path":f"{PDF_PATH}/{f}"} for f in os.listdir(PDF_PATH)]
+    Args:
+        persist_path(str): directory of the index (mk_chromadb).
+        k(int): number of chunks.
+        sources(list): documents to search in. all the documents if None.
 
+    Returns:
+        retrieve(callable): function from a query to the reference text.
+    """
+    index = VectorIndex.load(f"{persist_path}/{INDEX_DIR}")
+    embeddings = get_embeddings(index.EMBEDDING)
 
-    embeddings = OpenAIEmbeddings()
+    def retrieve(query:str)->str:
+        return format_chunks(index.search(query, embeddings, k=k, sources=sources))
+    return retrieve
 
-    for f in tqdm(pdf_files, total=len(pdf_files)):
-        loader = PyPDFLoader(f["path"])
-        pages = loader.load()
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap,
-            #separators=[" ", ",", "\n"] # [todo] optimize the separators for Japanese
-            separators=separators
-        )
-        texts = text_splitter.split_documents(pages)
-        db_tmp = Chroma.from_documents(texts, embeddings, persist_directory=f"./vectorstore_agents/{f['name']}")
-        db_tmp.persist()
-
-def load_chromadb(PDF_PATH:str, model_name:str, max_tokens:int):
+def load_chromadb(persist_path:str="./vectorstore_agents", k:int=4):
     """load_chromadb function
 
-    This function loads the Chroma database from the vectorstore_agents directory.
+    This function wraps the retriever of load_retriever in one langchain tool.
 
     Args:
-        PDF_PATH(str): path to the PDF files.
-        model_name(str): model name.
-        max_tokens(int): maximum number of tokens.
+        persist_path(str): directory of the index (mk_chromadb).
+        k(int): number of chunks returned by the tool.
 
     Returns:
-        dbs(list): list of Chroma databases.
+        tools(list): list of the tool.
     """
-    from tqdm import tqdm
-    from langchain.embeddings.openai import OpenAIEmbeddings
-    from langchain.vectorstores import Chroma
     from langchain.agents import Tool
-    from langchain.chat_models import ChatOpenAI
-    from langchain.chains import RetrievalQA
-
-
-    PDF_PATH = f"./reports"
-    pdf_files = [{"name":f[:-4], "path":f"{PDF_PATH}/{f}"} for f in os.listdir(PDF_PATH)]
-
 
+    return [
+        Tool(
+            name="search_reports",
+            description="監査基準、監査基準報告書、会社法などの条文や報告書を検索できます。",
+            func=load_retriever(persist_path, k=k)
+        )
+    ]
 
-    embeddings = OpenAIEmbeddings()
+def format_chunks(chunks:list)->str:
+    """format_chunks function
 
+    Format the retrieved chunks with their source, page and article for a prompt.
+    """
     # number in filename must be the full-width
     num_converter = str.maketrans({"0":"０", "1":"１", "2":"２", "3":"３", "4":"４", "5":"５", "6":"６", "7":"７", "8":"８", "9":"９"})
-    llm = ChatOpenAI(
-        temperature=0,
-        model=model_name
-        ,max_tokens=max_tokens
-    )
-
-    tools = []
-    for i, f in tqdm(enumerate(pdf_files), total=len(pdf_files)):
-        db_tmp=Chroma(persist_directory=f"./vectorstore_agents/{f['name']}",
-                      embedding_function=embeddings
-                      )
-        file_name = f["name"].translate(num_converter)
-        tools.append(
-                Tool(
-                    name=i, # [note] maybe file_name?
-                    description=f"{file_name}について使用できます。",
-                    func=RetrievalQA.from_chain_type(llm=llm, retriever=db_tmp.as_retriever())
-                )
-        )
-    return tools
\ No newline at end of file
+    ref_ls = []
+    for c in chunks:
+        header = c["source"].translate(num_converter)
+        if c.get("article"):
+            header += f" {c['article']}"
+        if c.get("page") is not None:
+            header += f" (p.{c['page'] + 1})"
+        ref_ls.append(f"[{header}]\n{c['text']}")
+    return "\n\n".join(ref_ls)
@@ -0,0 +1,54 @@
+from logging import getLogger
+logger = getLogger(__name__)
+
+import pandas as pd
+
+from .util import calc_tokens_tiktoken, get_encoding
+
+# USD per 1M tokens (input, output)
+MODEL_PRICES = {
+    "gpt-3.5-turbo-0125": (0.5, 1.5),
+    "gpt-4-0613": (30.0, 60.0),
+    "gpt-4-turbo-2024-04-09": (10.0, 30.0),
+    "gpt-4o-2024-05-13": (5.0, 15.0),
+}
+
+# tokens added by the chat format (openai-cookbook: "How to count tokens with tiktoken")
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+def estimate_cost(df_req:pd.DataFrame, prices:dict=MODEL_PRICES)->pd.DataFrame:
+    """estimate_cost function
+
+    This function counts the input tokens of the planned requests in bulk and estimates their cost.
+    Every distinct text is tokenized once per encoding with batched calls,
+    so the models sharing an encoding and the requests sharing a system prompt do not tokenize it again.
+    The models without the price (ex. local models) cost 0.
+
+    Args:
+        df_req(pd.DataFrame): planned requests. its columns must contain subject, model_name, system_prompt, query and output_tokens.
+        prices(dict): USD per 1M (input, output) tokens keyed by model name
+
+    Returns:
+        pd.DataFrame: requests, input_tokens, output_tokens and cost_usd per subject and model
+    """
+    df_req = df_req.copy()
+    df_req["input_tokens"] = 0
+    count_dic = {} # number of tokens of each text keyed by encoding name
+    for model_name, idx in df_req.groupby("model_name").groups.items():
+        df_m = df_req.loc[idx]
+        counts = count_dic.setdefault(get_encoding(model_name).name, {})
+        new_ls = list(set(df_m["system_prompt"]).union(df_m["query"]).difference(counts))
+        counts.update(zip(new_ls, calc_tokens_tiktoken(new_ls, model_name)))
+        df_req.loc[idx, "input_tokens"] = (
+            df_m["system_prompt"].map(counts) + df_m["query"].map(counts) + 2 * TOKENS_PER_MESSAGE + TOKENS_PER_REPLY
+        )
+    df_plan = df_req.groupby(["subject", "model_name"], sort=False).agg(
+        requests=("query", "size"),
+        input_tokens=("input_tokens", "sum"),
+        output_tokens=("output_tokens", "sum"),
+    ).reset_index()
+    price_in = df_plan["model_name"].map(lambda m: prices.get(m, (0.0, 0.0))[0])
+    price_out = df_plan["model_name"].map(lambda m: prices.get(m, (0.0, 0.0))[1])
+    df_plan["cost_usd"] = (df_plan["input_tokens"] * price_in + df_plan["output_tokens"] * price_out) / 1e6
+    return df_plan
@@ -0,0 +1,166 @@
+from logging import getLogger
+logger = getLogger(__name__)
+
+import time
+import random
+import asyncio
+
+import openai
+
+# errors which may succeed when the same request is sent again
+RETRYABLE_ERRORS = (
+  openai.error.RateLimitError,
+  openai.error.Timeout,
+  openai.error.APIConnectionError,
+  openai.error.ServiceUnavailableError,
+  openai.error.TryAgain,
+  asyncio.TimeoutError,
+)
+
+class TokenBucket:
+  """TokenBucket
+
+  This class is a token bucket which is refilled at a constant rate per minute.
+  The waiters are served in the order of arrival, so a large request is not starved by small ones.
+
+  Attributes:
+      RATE(float): refilled amount per minute
+      CAPACITY(float): maximum amount in the bucket
+      tokens(float): current amount in the bucket. it can be negative after the actual usage is charged.
+  """
+  def __init__(self,
+               rate:float, # refilled amount per minute
+               capacity:float=None, # maximum amount in the bucket. the rate per minute if None.
+               ):
+    if rate <= 0:
+      raise ValueError(f"rate must be positive. {rate}")
+    self.RATE = rate
+    self.CAPACITY = rate if capacity is None else capacity
+    self.tokens = self.CAPACITY
+    self._updated_at = time.monotonic()
+    self._lock = None
+
+  def _refill(self)->None:
+    now = time.monotonic()
+    self.tokens = min(self.CAPACITY, self.tokens + (now - self._updated_at) * self.RATE / 60)
+    self._updated_at = now
+
+  async def acquire(self, amount:float=1)->float:
+    """acquire function
+
+    Wait until the amount is available and take it.
+
+    Args:
+        amount(float): amount to take. It is capped by the capacity.
+
+    Returns:
+        float: seconds waited
+    """
+    amount = min(amount, self.CAPACITY)
+    if self._lock is None:
+      self._lock = asyncio.Lock()
+    started_at = time.monotonic()
+    async with self._lock:
+      self._refill()
+      while self.tokens < amount:
+        await asyncio.sleep((amount - self.tokens) * 60 / self.RATE)
+        self._refill()
+      self.tokens -= amount
+    return time.monotonic() - started_at
+
+  def charge(self, amount:float)->None:
+    """charge function
+
+    Take the amount without waiting (e.g. the difference between the actual and the estimated tokens).
+    A negative amount gives it back.
+    """
+    self._refill()
+    self.tokens = min(self.CAPACITY, self.tokens - amount)
+
+class RateLimiter:
+  """RateLimiter
+
+  This class keeps the requests of one model under its requests per minute (RPM) and tokens per minute (TPM).
+  A request takes 1 from the RPM bucket and its estimated tokens from the TPM bucket before it is sent,
+  and the difference from the actual usage is charged after the response.
+
+  Attributes:
+      RPM(int): requests per minute. not limited if None.
+      TPM(int): tokens per minute. not limited if None.
+  """
+  def __init__(self,
+               rpm:int=None, # requests per minute
+               tpm:int=None, # tokens per minute
+               ):
+    self.RPM = rpm
+    self.TPM = tpm
+    self._requests = None if rpm is None else TokenBucket(rpm)
+    self._tokens = None if tpm is None else TokenBucket(tpm)
+
+  async def acquire(self, tokens:int)->float:
+    waited = 0.0
+    if self._requests is not None:
+      waited += await self._requests.acquire(1)
+    if self._tokens is not None:
+      waited += await self._tokens.acquire(tokens)
+    return waited
+
+  def reconcile(self, estimated:int, actual:int)->None:
+    if self._tokens is not None:
+      self._tokens.charge(actual - estimated)
+
+def retry_after(e:Exception)->float:
+  """retry_after function
+
+  Seconds given by the Retry-After header of the error. None if not given.
+  """
+  headers = getattr(e, "headers", None) or {}
+  for key in ("retry-after-ms", "Retry-After-Ms"):
+    if key in headers:
+      try:
+        return float(headers[key]) / 1000
+      except (TypeError, ValueError):
+        pass
+  for key in ("retry-after", "Retry-After"):
+    if key in headers:
+      try:
+        return float(headers[key])
+      except (TypeError, ValueError):
+        pass
+  return None
+
+def is_retryable(e:Exception)->bool:
+  if isinstance(e, RETRYABLE_ERRORS):
+    return True
+  # 5xx errors are retried, and the other errors (4xx) are not
+  return isinstance(e, openai.error.APIError) and (getattr(e, "http_status", None) or 0) >= 500
+
+async def call_with_retry(func, *args, max_retries:int=6, base_delay:float=1.0, max_delay:float=60.0, **kwargs):
+  """call_with_retry function
+
+  Await func(*args, **kwargs), and retry it on the retryable errors with exponential backoff and full jitter.
+  The delay given by the Retry-After header of the error is respected.
+  The other errors and the error after max_retries retries are raised.
+
+  Args:
+      func: coroutine function
+      max_retries(int): maximum number of retries
+      base_delay(float): seconds of the first backoff
+      max_delay(float): maximum seconds of a backoff
+
+  Returns:
+      the return value of func and the number of retries
+  """
+  for attempt in range(max_retries + 1):
+    try:
+      return await func(*args, **kwargs), attempt
+    except Exception as e:
+      if attempt == max_retries or not is_retryable(e):
+        e.retries = attempt # reported by the telemetry
+        raise
+      delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+      after = retry_after(e)
+      if after is not None:
+        delay = max(delay, after)
+      logger.warning(f"{type(e).__name__}: {e}. retry in {delay:.1f}s ({attempt + 1}/{max_retries}).")
+      await asyncio.sleep(delay)
@@ -0,0 +1,48 @@
+from logging import getLogger
+logger = getLogger(__name__)
+
+import asyncio
+
+class Scheduler:
+  """Scheduler
+
+  This class drains the work items of every model concurrently on one event loop,
+  while keeping the number of in-flight requests of each model under its own limit.
+
+  Attributes:
+      CONCURRENCY(dict): in-flight limit keyed by model name
+      DEFAULT_CONCURRENCY(int): in-flight limit of the models which are not in CONCURRENCY
+  """
+  def __init__(self,
+               concurrency:dict=None, # in-flight limit keyed by model name
+               default_concurrency:int=8, # in-flight limit of the other models
+               ):
+    self.CONCURRENCY = dict(concurrency or {})
+    self.DEFAULT_CONCURRENCY = default_concurrency
+    self._semaphores = {}
+
+  def limit(self, model_name:str)->int:
+    return self.CONCURRENCY.get(model_name, self.DEFAULT_CONCURRENCY)
+
+  def _semaphore(self, model_name:str)->asyncio.Semaphore:
+    if model_name not in self._semaphores:
+      limit = self.limit(model_name)
+      if limit < 1:
+        raise ValueError(f"concurrency of {model_name} must be positive. {limit}")
+      self._semaphores[model_name] = asyncio.Semaphore(limit)
+    return self._semaphores[model_name]
+
+  async def submit(self, model_name:str, func, *args, **kwargs):
+    """submit function
+
+    Await func(*args, **kwargs) as soon as the model has a free slot.
+
+    Args:
+        model_name(str): model name whose limit is applied
+        func: coroutine function to be awaited
+
+    Returns:
+        the return value of func
+    """
+    async with self._semaphore(model_name):
+      return await func(*args, **kwargs)
@@ -0,0 +1,313 @@
+from logging import getLogger
+logger = getLogger(__name__)
+
+import os
+import csv
+import json
+import time
+import socket
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+QUEUE_DIR = "queue"
+
+def load_sweep_config(path:str)->dict:
+  """load_sweep_config function
+
+  Load the experiment matrix from a TOML or JSON file.
+
+  The keys are:
+      subjects(list): subjects (like audit, co_act,...)
+      models(list): main model names
+      years(dict): years keyed by subject. all the supported years of the data if a subject is omitted.
+      rag(list): RAG settings to run, e.g. [false, true]. [false] if omitted.
+      data_path, result_path, rag_path, llama_model_path(str): folders
+      cache_path(str): sqlite file of the response cache. no cache if omitted.
+      replay(bool): answer only from the response cache
+      cpa_test(dict): the other arguments of CpaTest (system_prompt, batch, concurrency, rate_limits, llama_config,...)
+
+  Args:
+      path(str): path to the config file (.toml or .json)
+
+  Returns:
+      dict: config with the defaults filled
+  """
+  if path.endswith(".toml"):
+    try:
+      import tomllib # python 3.11 or later
+    except ModuleNotFoundError:
+      import tomli as tomllib
+
+    with open(path, "rb") as f:
+      config = tomllib.load(f)
+  else:
+    with open(path, encoding="UTF-8") as f:
+      config = json.load(f)
+  for key in ["subjects", "models"]:
+    if not config.get(key):
+      raise ValueError(f"{key} is not specified in {path}.")
+  return {"years": {}, "rag": [False], "data_path": "./data", "result_path": "./result", "rag_path": "./vectorstore_agents",
+          "llama_model_path": "./models", "cache_path": None, "replay": False, "cpa_test": {}, **config}
+
+def _build_cpa_test(config:dict, run_name:str=None):
+  from .cache import ResponseCache
+  from .cpa_test import CpaTest
+  from .telemetry import TelemetrySink
+
+  cache = None if config["cache_path"] is None else ResponseCache(config["cache_path"], replay=config["replay"])
+  return CpaTest(data_path=config["data_path"],
+                 result_path=config["result_path"],
+                 rag_path=config["rag_path"],
+                 cache=cache,
+                 telemetry=TelemetrySink(f"{config['result_path']}/telemetry", run_name=run_name),
+                 **config["cpa_test"],
+                 )
+
+def expand_units(config:dict, cpa)->list:
+  """expand_units function
+
+  Expand the matrix into the work units (subject, year, model, is_rag).
+  The years of a subject which is not in config["years"] are all the supported years of the data.
+  The units are ordered by rag and model, so a worker claims the units of one model together.
+  """
+  year_dic = {}
+  for subject in config["subjects"]:
+    if subject in config["years"]:
+      year_dic[subject] = list(config["years"][subject])
+    else:
+      df_prompt = cpa._load_prompts(subject)
+      supported = df_prompt.groupby("year", sort=False)["supported"].all()
+      year_dic[subject] = list(supported[supported].index)
+  return [(subject, year, model_name, is_rag)
+          for is_rag in config["rag"] for model_name in config["models"]
+          for subject in config["subjects"] for year in year_dic[subject]]
+
+class WorkQueue:
+  """WorkQueue
+
+  This class is a work queue of the units of a sweep on a (shared) file system.
+  A unit is done when its result csv exists without failed statements and its journal is removed
+  (CpaTest removes it after the csv is written, and keeps it when any statement failed, so the next run asks them again).
+  A worker claims a unit by creating its claim file exclusively (O_CREAT | O_EXCL), which is atomic on local disks and NFS,
+  and keeps the claim alive by touching the file. A claim which is not touched for LEASE seconds is regarded as
+  abandoned by a dead worker and can be taken over; the new worker resumes the unit from its journal.
+
+  Attributes:
+      RESULT_PATH(str): folder of the results shared by the workers
+      QUEUE_PATH(str): folder of the claim files
+      WORKER_ID(str): name of this worker
+      LEASE(float): seconds after which an untouched claim is abandoned
+  """
+  def __init__(self,
+               result_path:str, # folder of the results shared by the workers
+               worker_id:str=None, # name of this worker. host and pid if None.
+               lease:float=600.0, # seconds after which an untouched claim is abandoned
+               ):
+    self.RESULT_PATH = result_path
+    self.QUEUE_PATH = f"{result_path}/{QUEUE_DIR}"
+    self.WORKER_ID = f"{socket.gethostname()}-{os.getpid()}" if worker_id is None else worker_id
+    self.LEASE = lease
+    os.makedirs(self.QUEUE_PATH, exist_ok=True)
+    for d in ["csv", "summary"]:
+      os.makedirs(f"{result_path}/{d}", exist_ok=True)
+
+  def _claim_path(self, name:str)->str:
+    return f"{self.QUEUE_PATH}/{name}.claim"
+
+  def n_failed(self, name:str)->int:
+    """n_failed function
+
+    Number of the statements of the unit recorded with an error status. 0 if the unit has no result csv.
+    """
+    try:
+      with open(f"{self.RESULT_PATH}/csv/{name}.csv", encoding="UTF-8", newline="") as f:
+        return sum(row.get("status", "ok") not in ("ok", None) for row in csv.DictReader(f))
+    except FileNotFoundError:
+      return 0
+
+  def is_done(self, name:str)->bool:
+    return (os.path.exists(f"{self.RESULT_PATH}/csv/{name}.csv") and not os.path.exists(f"{self.RESULT_PATH}/journal/{name}.jsonl")
+            and self.n_failed(name) == 0)
+
+  def _is_stale(self, path:str)->bool:
+    try:
+      return time.time() - os.path.getmtime(path) > self.LEASE
+    except FileNotFoundError:
+      return False
+
+  def claim(self, name:str)->bool:
+    """claim function
+
+    Claim the unit for this worker. False if it is claimed by a live worker.
+    """
+    path = self._claim_path(name)
+    if self._is_stale(path):
+      # move the stale claim aside first, so only one of the workers which found it takes it over
+      aside = f"{path}.{self.WORKER_ID}.stale"
+      try:
+        os.rename(path, aside)
+      except FileNotFoundError:
+        return False
+      if not self._is_stale(aside): # another worker has just claimed it again
+        os.rename(aside, path)
+        return False
+      with open(aside, encoding="UTF-8") as f:
+        logger.warning(f"take over {name} abandoned by {f.read().strip()}.")
+      os.remove(aside)
+    try:
+      fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+      return False
+    with os.fdopen(fd, "w", encoding="UTF-8") as f:
+      f.write(self.WORKER_ID)
+    return True
+
+  def touch(self, names:list)->None:
+    for name in names:
+      try:
+        os.utime(self._claim_path(name))
+      except FileNotFoundError:
+        logger.warning(f"the claim of {name} is lost.")
+
+  def release(self, name:str)->None:
+    try:
+      os.remove(self._claim_path(name))
+    except FileNotFoundError:
+      pass
+
+def run_worker(config_path:str, worker_id:str=None, claim_size:int=4, lease:float=600.0, wait:bool=False)->int:
+  """run_worker function
+
+  Run the units of the sweep which are neither done nor claimed by the other workers.
+  A unit whose statements failed is not done, and it is run again (only the failed statements are asked) by the next claim,
+  but at most once by this worker, so a statement which always fails does not keep the worker busy.
+  Up to claim_size units of one (model, rag) are claimed at a time and run by one CpaTest.sweep.
+  The agents are kept open between the claims, so a local model is loaded once while the worker claims its units.
+  The claims are touched every LEASE / 4 seconds while they run.
+  Any number of workers can run this on the machines sharing result_path.
+  The retrieval index has to be built beforehand (cpa-test index) when rag is used.
+
+  Args:
+      config_path(str): path to the config file of load_sweep_config
+      worker_id(str): name of this worker. host and pid if None.
+      claim_size(int): maximum number of units claimed at a time
+      lease(float): seconds after which an untouched claim is abandoned
+      wait(bool): wait for the units claimed by the other workers instead of returning when nothing is left to claim
+
+  Returns:
+      int: number of the units run by this worker
+  """
+  config = load_sweep_config(config_path)
+  queue = WorkQueue(config["result_path"], worker_id, lease)
+  cpa = _build_cpa_test(config, run_name=queue.WORKER_ID)
+  units = expand_units(config, cpa)
+  name_dic = {u: f"{u[0]}_{u[1]}_{cpa.result_name(u[2])}_rag_{str(u[3])}" for u in units}
+  n_done = sum(queue.is_done(n) for n in name_dic.values())
+  logger.info(f"worker {queue.WORKER_ID}: {len(units)} units, {n_done} of them are already done.")
+
+  async def _heartbeat(names:list):
+    while True:
+      await asyncio.sleep(lease / 4)
+      queue.touch(names)
+
+  async def _run(claimed:list):
+    subject_ls = list(dict.fromkeys(u[0] for u in claimed))
+    year_ls = {s: [u[1] for u in claimed if u[0] == s] for s in subject_ls}
+    heartbeat = asyncio.ensure_future(_heartbeat([name_dic[u] for u in claimed]))
+    try:
+      await cpa.sweep(subject_ls=subject_ls, year_ls=year_ls, model_ls=[claimed[0][2]], is_rag=claimed[0][3],
+                      llama_model_path=config["llama_model_path"], keep_agents=True)
+    finally:
+      heartbeat.cancel()
+
+  n_run = 0
+  attempted = set() # units run by this worker
+  try:
+    while True:
+      claimed = []
+      for u in units:
+        if len(claimed) >= claim_size:
+          break
+        if u in attempted or (claimed and u[2:] != claimed[0][2:]): # one (model, rag) per claim
+          continue
+        if not queue.is_done(name_dic[u]) and queue.claim(name_dic[u]):
+          if queue.is_done(name_dic[u]): # finished by another worker just before the claim
+            queue.release(name_dic[u])
+            continue
+          claimed.append(u)
+      if not claimed:
+        pending = [n for u, n in name_dic.items() if u not in attempted and not queue.is_done(n)]
+        if not pending or not wait:
+          failed = [n for u, n in name_dic.items() if u in attempted and not queue.is_done(n)]
+          if failed:
+            logger.warning(f"worker {queue.WORKER_ID}: {len(failed)} units have failed statements. run the sweep again to retry them: {failed}")
+          logger.info(f"worker {queue.WORKER_ID}: ran {n_run} units. {len(pending)} units are left to the other workers.")
+          return n_run
+        time.sleep(min(30.0, lease / 4)) # the claims of the other workers are done or abandoned meanwhile
+        continue
+      logger.info(f"worker {queue.WORKER_ID} claimed {[name_dic[u] for u in claimed]}.")
+      attempted.update(claimed)
+      try:
+        asyncio.run(_run(claimed))
+      finally:
+        for u in claimed:
+          queue.release(name_dic[u])
+      n_run += len(claimed)
+  finally:
+    cpa.close() # release the local model kept between the claims
+
+def merge_results(config_path:str, comparison:bool=True)->None:
+  """merge_results function
+
+  Summarize the results of all the units of the sweep with output_metrics (and output_comparison)
+  once every unit is done. The units with failed statements are not done, so partial results are not summarized.
+
+  Args:
+      config_path(str): path to the config file of load_sweep_config
+      comparison(bool): run output_comparison as well
+  """
+  from .compare import output_comparison
+  from .eval import output_metrics
+
+  config = load_sweep_config(config_path)
+  queue = WorkQueue(config["result_path"])
+  cpa = _build_cpa_test(config)
+  units = expand_units(config, cpa)
+  name_dic = {u: f"{u[0]}_{u[1]}_{cpa.result_name(u[2])}_rag_{str(u[3])}" for u in units}
+  failed = [u for u in units if queue.n_failed(name_dic[u])]
+  if failed:
+    raise RuntimeError(f"{len(failed)} units have failed statements. run the sweep again to retry them, e.g. {failed[:5]}")
+  missing = [u for u in units if not queue.is_done(name_dic[u])]
+  if missing:
+    raise RuntimeError(f"{len(missing)} units are not done yet, e.g. {missing[:5]}")
+  model_ls = [cpa.result_name(m) for m in config["models"]]
+  for is_rag in config["rag"]:
+    for subject in config["subjects"]:
+      year_set = list(dict.fromkeys(u[1] for u in units if u[0] == subject))
+      output_metrics(result_path=config["result_path"], subject=subject, year_set=year_set, model_ls=model_ls, is_rag=is_rag)
+      if comparison:
+        output_comparison(result_path=config["result_path"], subject=subject, year_set=year_set, model_ls=model_ls, is_rag=is_rag)
+
+def run_sweep(config_path:str, n_workers:int=1, merge:bool=True, **worker_config)->None:
+  """run_sweep function
+
+  Run the sweep with n_workers worker processes on this machine and merge the results.
+  The other machines can join the same sweep by run_worker (cpa-test sweep) with the same config.
+
+  Args:
+      config_path(str): path to the config file of load_sweep_config
+      n_workers(int): number of the worker processes
+      merge(bool): merge the results when every unit is done
+      worker_config: the other arguments of run_worker (claim_size, lease)
+  """
+  if n_workers <= 1:
+    run_worker(config_path, wait=merge, **worker_config)
+  else:
+    worker_id = worker_config.pop("worker_id", None)
+    with ProcessPoolExecutor(n_workers) as executor:
+      futures = [executor.submit(run_worker, config_path, wait=merge, **worker_config,
+                                 worker_id=None if worker_id is None else f"{worker_id}-{i}")
+                 for i in range(n_workers)]
+      logger.info(f"units run by the workers: {[f.result() for f in futures]}")
+  if merge:
+    merge_results(config_path)
@@ -0,0 +1,193 @@
+from logging import getLogger
+logger = getLogger(__name__)
+
+import os
+import glob
+import json
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+# upper bounds of the latency histogram in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf"))
+
+RECORD_FIELDS = ["subject", "model", "year", "q_no", "statement", "rag", "start", "end", "latency", "queue_wait",
+                 "prompt_tokens", "completion_tokens", "cache_hit", "retries", "error"]
+
+class TelemetrySink:
+  """TelemetrySink
+
+  This class is a buffered sink of the structured records of the requests.
+  The records are appended to a JSON lines file per run when the buffer is full or flush is called,
+  and the aggregated metrics are rewritten to a Prometheus textfile (node_exporter textfile collector format)
+  at most every PROM_INTERVAL seconds.
+
+  Attributes:
+      PATH(str): path to the JSON lines file
+      PROM_PATH(str): path to the Prometheus textfile
+      RUN_NAME(str): name of the run (e.g. the worker of a sharded sweep). the timestamp if None.
+      BUFFER_SIZE(int): number of the records buffered before they are written
+      PROM_INTERVAL(float): minimum seconds between the rewrites of the textfile
+      metrics(dict): aggregated metrics keyed by model
+  """
+  def __init__(self,
+               dir_path:str="./result/telemetry", # folder of the records and the textfile
+               buffer_size:int=256, # number of the records buffered before they are written
+               prom_interval:float=10.0, # minimum seconds between the rewrites of the textfile
+               run_name:str=None, # name of the run. the workers sharing a folder need their own names.
+               ):
+    os.makedirs(dir_path, exist_ok=True)
+    self.RUN_NAME = run_name
+    if run_name is None:
+      self.PATH = f"{dir_path}/requests_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl"
+      self.PROM_PATH = f"{dir_path}/cpa_test.prom"
+    else:
+      self.PATH = f"{dir_path}/requests_{run_name}.jsonl"
+      self.PROM_PATH = f"{dir_path}/cpa_test_{run_name}.prom"
+    self.BUFFER_SIZE = buffer_size
+    self.PROM_INTERVAL = prom_interval
+    self.metrics = {}
+    self._buffer = []
+    self._prom_written_at = 0.0
+
+  def emit(self, record:dict)->None:
+    """emit function
+
+    Buffer one record of a request. The keys are RECORD_FIELDS.
+    """
+    self._buffer.append(record)
+    self._aggregate(record)
+    if len(self._buffer) >= self.BUFFER_SIZE:
+      self._write_records()
+    if time.monotonic() - self._prom_written_at >= self.PROM_INTERVAL:
+      self._write_prom()
+
+  def _aggregate(self, record:dict)->None:
+    m = self.metrics.setdefault(record["model"], {
+      "requests": 0, "errors": 0, "cache_hits": 0, "retries": 0, "prompt_tokens": 0, "completion_tokens": 0,
+      "latency_sum": 0.0, "queue_wait_sum": 0.0, "latency_buckets": [0] * len(LATENCY_BUCKETS),
+    })
+    m["requests"] += 1
+    m["errors"] += record["error"] is not None
+    m["cache_hits"] += bool(record["cache_hit"])
+    m["retries"] += record["retries"]
+    m["prompt_tokens"] += record["prompt_tokens"]
+    m["completion_tokens"] += record["completion_tokens"]
+    m["latency_sum"] += record["latency"]
+    m["queue_wait_sum"] += record["queue_wait"]
+    m["latency_buckets"][int(np.searchsorted(LATENCY_BUCKETS, record["latency"]))] += 1
+
+  def _write_records(self)->None:
+    if not self._buffer:
+      return
+    with open(self.PATH, "a", encoding="UTF-8") as f:
+      f.write("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in self._buffer))
+    self._buffer = []
+
+  def _write_prom(self)->None:
+    lines = []
+    def _metric(name:str, kind:str, help_text:str, samples:list):
+      lines.append(f"# HELP {name} {help_text}")
+      lines.append(f"# TYPE {name} {kind}")
+      lines.extend(f"{name}{{{labels}}} {value}" for labels, value in samples)
+    items = sorted(self.metrics.items())
+    worker = "" if self.RUN_NAME is None else f',worker="{self.RUN_NAME}"' # the series of the workers are told apart
+    labels = {k: f'model="{k}"{worker}' for k, _ in items}
+    _metric("cpa_requests_total", "counter", "Requests by model.", [(labels[k], m["requests"]) for k, m in items])
+    _metric("cpa_request_errors_total", "counter", "Requests failed after the retries.", [(labels[k], m["errors"]) for k, m in items])
+    _metric("cpa_cache_hits_total", "counter", "Requests answered by the response cache.", [(labels[k], m["cache_hits"]) for k, m in items])
+    _metric("cpa_retries_total", "counter", "Retries of the requests.", [(labels[k], m["retries"]) for k, m in items])
+    _metric("cpa_tokens_total", "counter", "Tokens of the requests.",
+            [(f'{labels[k]},kind="{kind}"', m[f"{kind}_tokens"]) for k, m in items for kind in ["prompt", "completion"]])
+    _metric("cpa_queue_wait_seconds_sum", "counter", "Seconds waited for a free slot of the model.", [(labels[k], m["queue_wait_sum"]) for k, m in items])
+    samples = []
+    for k, m in items:
+      cum = np.cumsum(m["latency_buckets"])
+      samples.extend((f'{labels[k]},le="{"+Inf" if np.isinf(le) else le}"', int(c)) for le, c in zip(LATENCY_BUCKETS, cum))
+    _metric("cpa_request_latency_seconds_bucket", "histogram", "Latency of the requests.", samples)
+    lines.extend(f'cpa_request_latency_seconds_sum{{{labels[k]}}} {m["latency_sum"]}' for k, m in items)
+    lines.extend(f'cpa_request_latency_seconds_count{{{labels[k]}}} {m["requests"]}' for k, m in items)
+    tmp_path = f"{self.PROM_PATH}.tmp"
+    with open(tmp_path, "w", encoding="UTF-8") as f:
+      f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, self.PROM_PATH) # the collector never reads a half-written file
+    self._prom_written_at = time.monotonic()
+
+  def flush(self)->None:
+    """flush function
+
+    Write the buffered records and rewrite the textfile.
+    """
+    self._write_records()
+    self._write_prom()
+
+def load_telemetry(path:str)->pd.DataFrame:
+  """load_telemetry function
+
+  Load the records of a JSON lines file, or of all the files in a folder.
+  """
+  files = sorted(glob.glob(f"{path}/requests_*.jsonl")) if os.path.isdir(path) else [path]
+  records = []
+  for file in files:
+    with open(file, encoding="UTF-8") as f:
+      records.extend(json.loads(line) for line in f if line.strip())
+  return pd.DataFrame(records, columns=RECORD_FIELDS)
+
+def summarize_telemetry(path:str)->pd.DataFrame:
+  """summarize_telemetry function
+
+  This function summarizes the records per model.
+  The latency percentiles and the token throughput only count the requests sent to the models (not the cache hits).
+
+  Args:
+      path(str): JSON lines file or folder of TelemetrySink
+
+  Returns:
+      pd.DataFrame: requests, errors, cache hit rate, retries, latency p50/p95/p99, mean queue wait,
+          tokens and tokens per second of each model
+  """
+  df = load_telemetry(path)
+  row_ls = []
+  for model, df_m in df.groupby("model", sort=False):
+    df_sent = df_m[~df_m["cache_hit"].astype(bool)]
+    span = df_sent["end"].max() - df_sent["start"].min() if len(df_sent) else 0.0
+    tokens = int(df_sent["prompt_tokens"].sum() + df_sent["completion_tokens"].sum())
+    p50, p95, p99 = np.percentile(df_sent["latency"], [50, 95, 99]) if len(df_sent) else (np.nan,) * 3
+    row_ls.append({"model": model,
+                   "requests": len(df_m),
+                   "errors": int(df_m["error"].notna().sum()),
+                   "cache_hit_rate": float(df_m["cache_hit"].astype(bool).mean()),
+                   "retries": int(df_m["retries"].sum()),
+                   "latency_p50": p50, "latency_p95": p95, "latency_p99": p99,
+                   "queue_wait_mean": float(df_m["queue_wait"].mean()),
+                   "tokens": tokens,
+                   "tokens_per_sec": tokens / span if span > 0 else np.nan})
+  return pd.DataFrame(row_ls)
+
+def print_telemetry_summary(path:str, width:int=40)->pd.DataFrame:
+  """print_telemetry_summary function
+
+  Print the summary of summarize_telemetry and a latency histogram of each model.
+
+  Args:
+      path(str): JSON lines file or folder of TelemetrySink
+      width(int): width of the longest bar of the histograms
+
+  Returns:
+      pd.DataFrame: the summary
+  """
+  df_sum = summarize_telemetry(path)
+  print(df_sum.to_string(index=False, float_format=lambda x: f"{x:.3f}"))
+  df = load_telemetry(path)
+  for model, df_m in df.groupby("model", sort=False):
+    latency = df_m.loc[~df_m["cache_hit"].astype(bool), "latency"].to_numpy()
+    counts = np.bincount(np.searchsorted(LATENCY_BUCKETS, latency), minlength=len(LATENCY_BUCKETS))
+    print(f"\n{model} latency ({len(latency)} requests)")
+    lower = 0.0
+    for le, c in zip(LATENCY_BUCKETS, counts):
+      bar = "#" * int(round(width * c / counts.max())) if counts.max() else ""
+      print(f"  {lower:>6g}-{le:<6g}s {c:>7d} {bar}")
+      lower = le
+  return df_sum
@@ -1,6 +1,12 @@
 from logging import getLogger
 logger = getLogger(__name__)
 
+import os
+import re
+import json
+import pickle
+import hashlib
+from functools import lru_cache
 import tiktoken
 import numpy as np
 import pandas as pd
@@ -58,6 +64,120 @@ def gen_questions(**kwargs):
   for s, a in zip(["ア", "イ", "ウ", "エ"], a_ls):
     yield f"{q_dic['question']}\n{q_dic[s]}\n", a
 
+STATEMENT_LABELS = ["ア", "イ", "ウ", "エ"]
+
+def gen_batch_question(**kwargs):
+  """gen_batch_question function
+
+    Generate a question given in the dictionary format into one string prompt which contains all the 4 sentences.
+    The model is asked to judge every sentence at once.
+
+    Args:
+        kwargs(Dict): question dictionary. its key must contain question and answer.
+
+    Returns:
+        question(str): prompt with the header and the 4 labeled sentences.
+        answers(list[bool]): answers of the sentences in the order of ア, イ, ウ and エ.
+  """
+  q_dic = kwargs
+  q_a = list(gen_questions(**q_dic)) # validates the question and converts the answer
+  sentences = []
+  for s in STATEMENT_LABELS:
+    sentence = str(q_dic[s]).strip()
+    if not sentence.startswith(s): # some sentences already start with its label like "ア．"
+      sentence = f"{s}．{sentence}"
+    sentences.append(sentence)
+  question = q_dic["question"] + "\n" + "\n".join(sentences) + "\n"
+  return question, [a for _, a in q_a]
+
+ANSWER_LABELS = ["True", "False"]
+# the leading word of an answer, after the quotes and the brackets
+_LEADING_LABEL_PATTERN = re.compile(r"^[\s\"'“”「『【(*]*(true(?![a-z])|false(?![a-z])|正しい|誤り|誤っている|〇|○|×|✕)", flags=re.IGNORECASE)
+# the English labels in the answer. \b does not separate "True" from the following Japanese characters.
+_ENGLISH_LABEL_PATTERN = re.compile(r"(?<![a-z])(true|false)(?![a-z])", flags=re.IGNORECASE)
+# a label which is negated (e.g. "Trueではありません", "正しいとは言えない") is not an answer
+_NEGATION_PATTERN = re.compile(r"[\s\"'”」』】]*(?:では|じゃ|とは|でな|not\b)", flags=re.IGNORECASE)
+_PRE_NEGATION_PATTERN = re.compile(r"\bnot\s+[\"'“]?$", flags=re.IGNORECASE)
+_LABEL_DIC = {"true": "True", "正しい": "True", "〇": "True", "○": "True",
+              "false": "False", "誤り": "False", "誤っている": "False", "×": "False", "✕": "False"}
+
+def normalize_label(text:str)->str:
+  """normalize_label function
+
+    Normalize the answer of a statement to "True" or "False".
+    The label at the head of the answer is taken (e.g. ' "True".', 'False\n理由は...', '〇', '誤り'),
+    or the only English label in it (e.g. 'The answer is True.').
+    The answer is not normalized when the label is negated (e.g. 'Trueではありません')
+    or when the other English label follows (e.g. 'True\n理由: ...False').
+
+    Args:
+        text(str): answer of the model
+
+    Returns:
+        label(str): "True" or "False". None if the answer does not contain exactly one label.
+  """
+  found = set()
+  for m in _ENGLISH_LABEL_PATTERN.finditer(text):
+    if _NEGATION_PATTERN.match(text, m.end()) or _PRE_NEGATION_PATTERN.search(text, 0, m.start()):
+      return None
+    found.add(m.group(1).capitalize())
+  match = _LEADING_LABEL_PATTERN.match(text)
+  if match:
+    if _NEGATION_PATTERN.match(text, match.end()):
+      return None
+    label = _LABEL_DIC[match.group(1).lower()]
+    return label if found <= {label} else None
+  return found.pop() if len(found) == 1 else None
+
+def parse_batch_answer(text:str)->list[str]:
+  """parse_batch_answer function
+
+    Parse the answer to the prompt of gen_batch_question into the answers of the 4 sentences.
+    The answer is expected to be {"ア": "True", "イ": "False", ...}, but lines like "ア: True" are also accepted.
+
+    Args:
+        text(str): answer of the model
+
+    Returns:
+        labels(list[str]): "True" or "False" in the order of ア, イ, ウ and エ. None if the answer is malformed.
+  """
+  labels = {}
+  match = re.search(r"\{.*\}", text, flags=re.DOTALL)
+  if match:
+    try:
+      obj = json.loads(match.group(0))
+      if isinstance(obj, dict):
+        labels = {k.strip(): str(v).strip() for k, v in obj.items()}
+    except json.JSONDecodeError:
+      pass
+  if not labels:
+    labels = dict(re.findall(r"([アイウエ])\s*[\.．:：、]?\s*[\"”“]?(True|False)", text))
+  res = []
+  for s in STATEMENT_LABELS:
+    v = normalize_label(labels.get(s, ""))
+    if v is None:
+      return None
+    res.append(v)
+  return res
+
+@lru_cache(maxsize=None)
+def get_encoding(model_name:str):
+    """get_encoding function
+
+    This function returns the tiktoken encoding of the model. The encodings are cached.
+    cl100k_base is used for the models unknown to tiktoken (ex. local models) as an approximation.
+
+    Args:
+        model_name(str): model name
+
+    Returns:
+        encoding(tiktoken.Encoding): encoding
+    """
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
 def calc_token_tiktoken(chat, model_name):
     """calc_token_tiktoken function
 
@@ -70,19 +190,145 @@ def calc_token_tiktoken(chat, model_name):
     Returns:
         num_tokens(int): number of tokens
     """
-    encoding = tiktoken.encoding_for_model(model_name)
+    encoding = get_encoding(model_name)
     num_tokens = len(encoding.encode(chat))
     return num_tokens
 
+def calc_tokens_tiktoken(chats:list, model_name:str, num_threads:int=8)->list[int]:
+    """calc_tokens_tiktoken function
+
+    This function calculates the number of tokens of each chat in bulk.
+
+    Args:
+        chats(list): chats
+        model_name(str): model name
+        num_threads(int): number of threads used by tiktoken
+
+    Returns:
+        num_tokens(list[int]): number of tokens of each chat
+    """
+    encoding = get_encoding(model_name)
+    return [len(t) for t in encoding.encode_ordinary_batch(list(chats), num_threads=num_threads)]
+
+QDATA_FILES = {"audit": "CPA_AUDIT.csv", "co_act": "CPA_CO_ACT.csv"}
+PROMPT_TABLE_COLUMNS = ["subject", "year", "q_idx", "q_no", "s_idx", "statement", "sentence", "prompt", "batch_prompt", "retrieval_query", "answer", "supported"]
+
 def load_qdata(DATA_PATH:str, subject:str)->pd.DataFrame:
+    if subject not in QDATA_FILES:
+       raise ValueError("subject must be audit or co_act")
+    df_cpa = pd.read_csv(f"{DATA_PATH}/{QDATA_FILES[subject]}")
+    df_cpa = df_cpa.rename(columns={1:"1", 2:"2", 3:"3", 4:"4", 5:"5", 6:"6"})
     if subject=="audit":
-      df_cpa = pd.read_csv(f"{DATA_PATH}/CPA_AUDIT.csv")
-      df_cpa = df_cpa.rename(columns={1:"1", 2:"2", 3:"3", 4:"4", 5:"5", 6:"6"})
       df_cpa = df_cpa[df_cpa["abnormal_flg"]==0]
-    elif subject=="co_act":
-      df_cpa = pd.read_csv(f"{DATA_PATH}/CPA_CO_ACT.csv")
-      df_cpa = df_cpa.rename(columns={1:"1", 2:"2", 3:"3", 4:"4", 5:"5", 6:"6"})
-      # no abnormal flg
-    else:
-       raise ValueError("subject must be audit or co_act")
+    # co_act has no abnormal flg
     return df_cpa
+
+def _strip_label(sentence, label:str)->str:
+    # "ア．商人は..." -> "商人は..."
+    return re.sub(rf"^{label}\s*[\.．、]?\s*", "", str(sentence).strip())
+
+def compile_prompts(df_cpa:pd.DataFrame, subject:str, pre_question:str, post_question:str)->pd.DataFrame:
+    """compile_prompts function
+
+    This function compiles the questions into a flat prompt table which has one row per statement.
+    The questions which gen_questions does not support (5 choices) are kept with supported=False,
+    so that the inference of their year fails as before.
+
+    Args:
+        df_cpa(pd.DataFrame): questions loaded by load_qdata
+        subject(str): subject (like audit, co_act,...)
+        pre_question(str): prompt which is given before the question
+        post_question(str): prompt which is given after the question
+
+    Returns:
+        pd.DataFrame: subject, year, q_idx (index in the year), q_no, s_idx, statement, sentence (without its label), prompt, batch_prompt, retrieval_query
+            (the question and its statements, shared by the statements in RAG), answer and supported
+    """
+    rows = []
+    for year, df_year in df_cpa.groupby("key", sort=False):
+      for q_idx, q_dic in enumerate(df_year.to_dict("records")):
+        base = {"subject": subject, "year": year, "q_idx": q_idx, "q_no": q_dic["q_no"]}
+        try:
+          q_a = list(gen_questions(**q_dic))
+          batch_q, _ = gen_batch_question(**q_dic)
+        except NotImplementedError:
+          rows.extend({**base, "s_idx": j, "statement": s, "sentence": _strip_label(q_dic[s], s), "prompt": None, "batch_prompt": None, "retrieval_query": None, "answer": None, "supported": False}
+                      for j, s in enumerate(STATEMENT_LABELS))
+          continue
+        rows.extend({**base, "s_idx": j, "statement": s, "sentence": _strip_label(q_dic[s], s),
+                     "prompt": pre_question + q + post_question,
+                     "batch_prompt": pre_question + batch_q + post_question,
+                     "retrieval_query": batch_q,
+                     "answer": a, "supported": True}
+                    for j, (s, (q, a)) in enumerate(zip(STATEMENT_LABELS, q_a)))
+    return pd.DataFrame(rows, columns=PROMPT_TABLE_COLUMNS)
+
+_PROMPT_TABLES = {} # prompt tables loaded in this process
+PROMPT_CACHE_VERSION = 2 # format of the cached entry. the caches of the other versions are rebuilt
+
+def load_prompts(DATA_PATH:str, subject:str, pre_question:str, post_question:str, cache_dir:str=None)->pd.DataFrame:
+    """load_prompts function
+
+    This function returns the prompt table of compile_prompts.
+    The table is cached in the process and in cache_dir, and it is rebuilt only when the source csv is changed.
+    The source is checked by its mtime first, and by its sha256 only when the mtime is changed.
+    A cache file which cannot be read or has another format version is rebuilt.
+
+    Args:
+        DATA_PATH(str): path to the folder where the cpa data is stored
+        subject(str): subject (like audit, co_act,...)
+        pre_question(str): prompt which is given before the question
+        post_question(str): prompt which is given after the question
+        cache_dir(str): folder where the table is cached. The table is not cached on the disk if None.
+
+    Returns:
+        pd.DataFrame: prompt table
+    """
+    if subject not in QDATA_FILES:
+       raise ValueError("subject must be audit or co_act")
+    src = f"{DATA_PATH}/{QDATA_FILES[subject]}"
+    mtime = os.path.getmtime(src)
+    prompt_hash = hashlib.sha256(json.dumps([pre_question, post_question, PROMPT_TABLE_COLUMNS], ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+    mem_key = (os.path.abspath(src), prompt_hash)
+    if mem_key in _PROMPT_TABLES and _PROMPT_TABLES[mem_key]["mtime"] == mtime:
+      return _PROMPT_TABLES[mem_key]["table"]
+
+    cache_file = None if cache_dir is None else f"{cache_dir}/prompts_{subject}_{prompt_hash}.pkl"
+    entry = None
+    if cache_file is not None and os.path.exists(cache_file):
+      try:
+        with open(cache_file, "rb") as f:
+          entry = pickle.load(f)
+      except Exception as e: # truncated or written by another version of pandas
+        logger.warning(f"{cache_file} cannot be read ({e!r}). rebuild the prompt table.")
+      if not isinstance(entry, dict) or entry.get("version") != PROMPT_CACHE_VERSION:
+        entry = None
+    if entry is not None and entry["mtime"] != mtime:
+      src_hash = _file_sha256(src)
+      if entry["sha256"] == src_hash: # touched but not changed
+        entry["mtime"] = mtime
+        _dump_pickle(entry, cache_file)
+      else:
+        logger.info(f"{src} is changed. rebuild the prompt table.")
+        entry = None
+    if entry is None:
+      table = compile_prompts(load_qdata(DATA_PATH, subject), subject, pre_question, post_question)
+      entry = {"version": PROMPT_CACHE_VERSION, "mtime": mtime, "sha256": _file_sha256(src), "table": table}
+      if cache_file is not None:
+        _dump_pickle(entry, cache_file)
+    _PROMPT_TABLES[mem_key] = entry
+    return entry["table"]
+
+def _file_sha256(path:str)->str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+      for block in iter(lambda: f.read(1 << 20), b""):
+        h.update(block)
+    return h.hexdigest()
+
+def _dump_pickle(obj, path:str)->None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+      pickle.dump(obj, f)
+    os.replace(tmp, path) # atomic, so a reader never sees a half-written table
@@ -0,0 +1,235 @@
+from logging import getLogger
+logger = getLogger(__name__)
+
+import os
+import json
+import time
+import zlib
+
+import numpy as np
+
+INDEX_DIR = "index"
+EMBEDDINGS_FILE = "embeddings.npy"
+META_FILE = "meta.json"
+
+class HashingEmbedding:
+    """HashingEmbedding
+
+    This class is a deterministic local embedding function.
+    The character n-grams of a text are hashed into a fixed number of dimensions with signs (feature hashing),
+    and the vector is normalized. It needs no network and no model, so it is used for tests and benchmarks.
+    It has the same interface as the langchain embeddings (embed_documents and embed_query).
+
+    Attributes:
+        DIM(int): number of dimensions
+        NGRAMS(tuple): lengths of the character n-grams
+        model(str): name of the embedding recorded in the index
+    """
+    def __init__(self,
+                 dim:int=256, # number of dimensions
+                 ngrams:tuple=(1, 2, 3), # lengths of the character n-grams
+                 ):
+        self.DIM = dim
+        self.NGRAMS = tuple(ngrams)
+        self.model = f"hashing-{dim}-{'_'.join(map(str, self.NGRAMS))}"
+
+    def _embed(self, text:str)->np.ndarray:
+        vec = np.zeros(self.DIM, dtype=np.float32)
+        for n in self.NGRAMS:
+            for i in range(len(text) - n + 1):
+                h = zlib.crc32(text[i:i + n].encode("utf-8"))
+                vec[h % self.DIM] += 1.0 if (h >> 31) & 1 else -1.0
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm > 0 else vec
+
+    def embed_documents(self, texts:list)->list:
+        return [self._embed(t).tolist() for t in texts]
+
+    def embed_query(self, text:str)->list:
+        return self._embed(text).tolist()
+
+def embedding_name(embeddings)->str:
+    """embedding_name function
+
+    Name of the embedding function which is recorded in the index and the manifest.
+    """
+    return getattr(embeddings, "model", None) or type(embeddings).__name__
+
+def get_embeddings(name:str):
+    """get_embeddings function
+
+    Embedding function of the name recorded in the index.
+    """
+    if name.startswith("hashing-"):
+        _, dim, ngrams = name.split("-")
+        return HashingEmbedding(dim=int(dim), ngrams=tuple(int(n) for n in ngrams.split("_")))
+    from langchain.embeddings.openai import OpenAIEmbeddings
+    return OpenAIEmbeddings(model=name)
+
+class VectorIndex:
+    """VectorIndex
+
+    This class is one in-process retrieval index over the chunks of all the documents.
+    The normalized embeddings are stored in one float32 matrix, which is memory-mapped when it is loaded,
+    and the chunks of a document are stored in consecutive rows,
+    so a search filtered by documents only reads the rows of the documents.
+
+    Attributes:
+        PATH(str): folder of the index
+        EMBEDDING(str): name of the embedding function
+        embeddings(np.ndarray): (number of chunks, dim) float32 matrix
+        texts(list): text of each chunk
+        metadatas(list): source, page and article of each chunk
+        doc_ranges(dict): (start, end) rows of each document
+    """
+    def __init__(self, path:str, embeddings:np.ndarray, texts:list, metadatas:list, doc_ranges:dict, embedding:str):
+        self.PATH = path
+        self.EMBEDDING = embedding
+        self.embeddings = embeddings
+        self.texts = texts
+        self.metadatas = metadatas
+        self.doc_ranges = doc_ranges
+
+    def __len__(self)->int:
+        return len(self.texts)
+
+    @classmethod
+    def build(cls, path:str, docs:list, embedding:str)->"VectorIndex":
+        """build function
+
+        This function writes the chunks and their vectors of every document into one index.
+
+        Args:
+            path(str): folder of the index
+            docs(list): (source, chunks, vectors) of each document. chunks are (text, metadata) pairs.
+            embedding(str): name of the embedding function
+
+        Returns:
+            VectorIndex: the built index
+        """
+        os.makedirs(path, exist_ok=True)
+        n = sum(len(chunks) for _, chunks, _ in docs)
+        dim = next((np.shape(vectors)[1] for _, _, vectors in docs if len(vectors)), 0)
+        tmp_file = f"{path}/{EMBEDDINGS_FILE}.tmp"
+        matrix = np.lib.format.open_memmap(tmp_file, mode="w+", dtype=np.float32, shape=(n, dim))
+        texts, metadatas, doc_ranges = [], [], {}
+        start = 0
+        for source, chunks, vectors in docs:
+            vectors = np.asarray(vectors, dtype=np.float32).reshape(len(chunks), dim)
+            norm = np.linalg.norm(vectors, axis=1, keepdims=True)
+            matrix[start:start + len(chunks)] = vectors / np.where(norm > 0, norm, 1.0)
+            texts.extend(text for text, _ in chunks)
+            metadatas.extend({**metadata, "source": source} for _, metadata in chunks)
+            doc_ranges[source] = (start, start + len(chunks))
+            start += len(chunks)
+        matrix.flush()
+        del matrix
+        os.replace(tmp_file, f"{path}/{EMBEDDINGS_FILE}")
+        meta = {"embedding": embedding, "texts": texts, "metadatas": metadatas, "doc_ranges": doc_ranges}
+        with open(f"{path}/{META_FILE}.tmp", "w", encoding="UTF-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(f"{path}/{META_FILE}.tmp", f"{path}/{META_FILE}")
+        logger.info(f"built the index of {n} chunks from {len(docs)} documents in {path}.")
+        return cls.load(path)
+
+    @classmethod
+    def load(cls, path:str)->"VectorIndex":
+        with open(f"{path}/{META_FILE}", encoding="UTF-8") as f:
+            meta = json.load(f)
+        embeddings = np.load(f"{path}/{EMBEDDINGS_FILE}", mmap_mode="r")
+        doc_ranges = {k: tuple(v) for k, v in meta["doc_ranges"].items()}
+        return cls(path, embeddings, meta["texts"], meta["metadatas"], doc_ranges, meta["embedding"])
+
+    def search_by_vector(self, vector, k:int=4, sources:list=None)->list:
+        """search_by_vector function
+
+        Top-k chunks by the cosine similarity.
+
+        Args:
+            vector(list | np.ndarray): query vector
+            k(int): number of chunks
+            sources(list): documents to search in. all the documents if None.
+
+        Returns:
+            list: (row, score) of the top-k chunks in descending order of the score
+        """
+        q = np.asarray(vector, dtype=np.float32)
+        q = q / (np.linalg.norm(q) or 1.0)
+        if sources is None:
+            rows = None
+            scores = self.embeddings @ q
+        else:
+            ranges = [self.doc_ranges[s] for s in sources if s in self.doc_ranges]
+            rows = np.concatenate([np.arange(s, e) for s, e in ranges]) if ranges else np.zeros(0, dtype=np.int64)
+            scores = np.concatenate([self.embeddings[s:e] @ q for s, e in ranges]) if ranges else np.zeros(0, dtype=np.float32)
+        k = min(k, len(scores))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(int(top_i if rows is None else rows[top_i]), float(scores[top_i])) for top_i in top]
+
+    def search(self, query:str, embeddings, k:int=4, sources:list=None)->list:
+        """search function
+
+        Top-k chunks of the query.
+
+        Args:
+            query(str): query text
+            embeddings: embedding function of the index
+            k(int): number of chunks
+            sources(list): documents to search in. all the documents if None.
+
+        Returns:
+            list: dicts of text, score, source, page and article of the top-k chunks
+        """
+        hits = self.search_by_vector(embeddings.embed_query(query), k=k, sources=sources)
+        return [{"text": self.texts[row], "score": score, **self.metadatas[row]} for row, score in hits]
+
+def benchmark_retrieval(index:VectorIndex, embeddings, n_queries:int=200, k:int=4, query_ratio:float=0.5, seed:int=0)->dict:
+    """benchmark_retrieval function
+
+    This function measures the latency and the recall of the index.
+    A query is the middle part of a randomly chosen chunk, and it is a hit if the chunk is in the top-k.
+    The search filtered by the source document of the chunk is measured as well.
+    Use HashingEmbedding to run it without network.
+
+    Args:
+        index(VectorIndex): index to measure
+        embeddings: embedding function of the index
+        n_queries(int): number of queries
+        k(int): number of chunks of a search
+        query_ratio(float): length of a query relative to its chunk
+        seed(int): seed of choosing the chunks
+
+    Returns:
+        dict: number of chunks, recall@k, and p50/p95 latency in ms of the embedding, search and filtered search
+    """
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(index), size=min(n_queries, len(index)), replace=False)
+    embed_ms, search_ms, filtered_ms = [], [], []
+    hit, filtered_hit = 0, 0
+    for row in rows:
+        text = index.texts[row]
+        width = max(1, int(len(text) * query_ratio))
+        start = (len(text) - width) // 2
+        t0 = time.perf_counter()
+        vector = embeddings.embed_query(text[start:start + width])
+        t1 = time.perf_counter()
+        hits = index.search_by_vector(vector, k=k)
+        t2 = time.perf_counter()
+        filtered_hits = index.search_by_vector(vector, k=k, sources=[index.metadatas[row]["source"]])
+        t3 = time.perf_counter()
+        embed_ms.append(1000 * (t1 - t0))
+        search_ms.append(1000 * (t2 - t1))
+        filtered_ms.append(1000 * (t3 - t2))
+        hit += any(r == row for r, _ in hits)
+        filtered_hit += any(r == row for r, _ in filtered_hits)
+    p = lambda x, q: float(np.percentile(x, q))
+    result = {"chunks": len(index), "queries": len(rows), "k": k,
+              "recall": hit / len(rows), "filtered_recall": filtered_hit / len(rows),
+              "embed_ms_p50": p(embed_ms, 50), "embed_ms_p95": p(embed_ms, 95),
+              "search_ms_p50": p(search_ms, 50), "search_ms_p95": p(search_ms, 95),
+              "filtered_search_ms_p50": p(filtered_ms, 50), "filtered_search_ms_p95": p(filtered_ms, 95)}
+    logger.info(f"retrieval benchmark: {result}")
+    return result
@@ -1,56 +1,236 @@
-from . import check_openai_api_key, openai_auth
-from . import mk_chromadb
-from . import CpaTest
-from . import output_metrics
-from . import get_logger
-
-import asyncio
-
-def main():
-    year_ls = {"co_act": ["H28_1", "H28_2", "H29_1", "H29_2", "H30_1", "H30_2", "H31_1", "H31_2", "R2_1", "R2_2", "R3"],
-               "audit": ["H31_1", "H31_2", "R2_1", "R2_2", "R3", "R4_1", "R4_2", "R5_1", "R5_2"],
-               }
-    model_ls = ["gpt-3.5-turbo-0125", "gpt-4-0613", "gpt-4-turbo-2024-04-09", "gpt-4o-2024-05-13"]
+import argparse
+
+# the subcommands import the modules they use inside, so e.g. "cpa-test eval" does not load openai or llama_cpp
+YEAR_LS = {"co_act": ["H28_1", "H28_2", "H29_1", "H29_2", "H30_1", "H30_2", "H31_1", "H31_2", "R2_1", "R2_2", "R3"],
+           "audit": ["H31_1", "H31_2", "R2_1", "R2_2", "R3", "R4_1", "R4_2", "R5_1", "R5_2"],
+           }
+MODEL_LS = ["gpt-3.5-turbo-0125", "gpt-4-0613", "gpt-4-turbo-2024-04-09", "gpt-4o-2024-05-13"]
+SUBJECT_LS = ["co_act"]
+SYSTEM_PROMPT = "与えた文章が正しいか誤っているか判別し、正しければ”True”、誤っていたら”False”を出力しなさい。それ以外には何も含めないことを厳守してください。"
+PRE_QUESTION = "問題:"
+POST_QUESTION = "回答:"
+
+def _year_ls(args)->dict:
+    return {subject: list(args.year) if args.year else YEAR_LS[subject] for subject in args.subject}
+
+def _result_names(args)->list:
+    # the same names as CpaTest.result_name
+    if args.scoring:
+        return [m + "_score" for m in args.model]
+    return [m + ("_batch" if args.batch else "") + ("_constrained" if args.constrained else "") for m in args.model]
+
+def _cpa_test(args, **kwargs):
+    from .lib.cpa_test import CpaTest
+
+    return CpaTest(data_path=args.data_path,
+                   result_path=args.result_path,
+                   rag_path=args.rag_path,
+                   system_prompt=SYSTEM_PROMPT,
+                   pre_question=PRE_QUESTION,
+                   post_question=POST_QUESTION,
+                   prompt_cache_path="./cache/prompts",
+                   batch=args.batch,
+                   constrained=args.constrained,
+                   scoring=args.scoring,
+                   dedup=args.dedup,
+                   **kwargs,
+                   )
+
+def run(args)->None:
+    import asyncio
+    from .lib.authentication import check_openai_api_key, openai_auth
+    from .lib.cache import ResponseCache
+    from .lib.compare import output_comparison
+    from .lib.eval import output_metrics
+    from .lib.pdf2chroma import mk_chromadb
+
     model_path = "./models"
-    subject_ls = ["co_act"]
-    is_rag_ls = [False]
+    llama_config = {} # n_instances and n_threads per local model (ex. {"ELYZA-japanese-Llama-2-7b-instruct": {"n_instances": 2, "n_threads": 8}})
+    concurrency = {"gpt-3.5-turbo-0125": 16, "gpt-4-0613": 8, "gpt-4-turbo-2024-04-09": 8, "gpt-4o-2024-05-13": 16}
+    rate_limits = {} # rpm and tpm of the account keyed by model name, e.g. {"gpt-4o-2024-05-13": {"rpm": 500, "tpm": 30000}}
+    cache_path = "./cache/responses.sqlite"
+    year_ls = _year_ls(args)
+    is_rag_ls = [False, True] if args.rag == "both" else [args.rag == "on"]
 
-    logger = get_logger(dir_path="./log")
-    logger.info("Start CPA audit test... (ver.0.1.0)")
-    for m in model_ls:
+    for m in args.model:
         if m.startswith("gpt") or True in is_rag_ls:
             openai_auth()
             check_openai_api_key()
             if True in is_rag_ls:
-                mk_chromadb()
-                pass
+                mk_chromadb(persist_path=args.rag_path)
             break
 
-    cpa = CpaTest(data_path="./data",
-                  result_path="./result",
-                  system_prompt="与えた文章が正しいか誤っているか判別し、正しければ”True”、誤っていたら”False”を出力しなさい。それ以外には何も含めないことを厳守してください。",
-                  pre_question="問題:",
-                  post_question="回答:",
-                  )
+    cpa = _cpa_test(args,
+                    concurrency=concurrency,
+                    rate_limits=rate_limits,
+                    llama_config=llama_config,
+                    cache=ResponseCache(cache_path, replay=args.replay),
+                    )
 
+    cpa.plan(subject_ls=args.subject, year_ls=year_ls, model_ls=args.model) # logs the estimated tokens and cost before sending anything
     for is_rag in is_rag_ls:
-        for subject in subject_ls:
-            for main_model_name in model_ls:
-                task = asyncio.run(
-                    cpa.inference(subject=subject,
-                                year_set=year_ls[subject],
-                                llama_model_path=model_path,
-                                main_model_name=main_model_name,
-                                is_rag=is_rag,
-                                )
+        asyncio.run(
+            cpa.sweep(subject_ls=args.subject,
+                      year_ls=year_ls,
+                      model_ls=args.model,
+                      llama_model_path=model_path,
+                      is_rag=is_rag,
+                      )
+        )
+        for subject in args.subject:
+            output_metrics(result_path=args.result_path,
+                subject=subject,
+                year_set=year_ls[subject],
+                model_ls=[cpa.result_name(m) for m in args.model],
+                is_rag=is_rag,
                 )
-            output_metrics(result_path="./result",
+            output_comparison(result_path=args.result_path,
                 subject=subject,
                 year_set=year_ls[subject],
-                model_ls=model_ls,
+                model_ls=[cpa.result_name(m) for m in args.model],
                 is_rag=is_rag,
                 )
-    logger.info(f"Finished CPA test.")
+
+def evaluate(args)->None:
+    from .lib.compare import output_comparison
+    from .lib.eval import output_metrics
+
+    year_ls = _year_ls(args)
+    is_rag_ls = [False, True] if args.rag == "both" else [args.rag == "on"]
+    for is_rag in is_rag_ls:
+        for subject in args.subject:
+            output_metrics(result_path=args.result_path, subject=subject, year_set=year_ls[subject],
+                           model_ls=_result_names(args), is_rag=is_rag)
+            if not args.no_comparison:
+                output_comparison(result_path=args.result_path, subject=subject, year_set=year_ls[subject],
+                                  model_ls=_result_names(args), is_rag=is_rag)
+
+def index(args)->None:
+    from .lib.pdf2chroma import mk_chromadb
+
+    vector_index = mk_chromadb(PDF_PATH=args.pdf_path,
+                               chunk_size=args.chunk_size,
+                               chunk_overlap=args.chunk_overlap,
+                               persist_path=args.rag_path,
+                               n_workers=args.n_workers,
+                               )
+    if args.benchmark:
+        from .lib.vector_index import benchmark_retrieval, get_embeddings
+
+        result = benchmark_retrieval(vector_index, get_embeddings(vector_index.EMBEDDING), n_queries=args.benchmark_queries, k=args.k)
+        for key, value in result.items():
+            print(f"{key:<24}{value:.3f}" if isinstance(value, float) else f"{key:<24}{value}")
+
+def plan(args)->None:
+    _cpa_test(args).plan(subject_ls=args.subject, year_ls=_year_ls(args), model_ls=args.model)
+
+def sweep(args)->None:
+    from .lib.sweep import load_sweep_config, run_sweep
+
+    config = load_sweep_config(args.config)
+    if any(m.startswith("gpt") for m in config["models"]):
+        from .lib.authentication import check_openai_api_key, openai_auth
+
+        openai_auth() # the key is passed to the worker processes by the environment variable
+        check_openai_api_key()
+    run_sweep(args.config, n_workers=args.workers, merge=not args.no_merge,
+              worker_id=args.worker_id, claim_size=args.claim_size, lease=args.lease)
+
+def merge(args)->None:
+    from .lib.sweep import merge_results
+
+    merge_results(args.config, comparison=not args.no_comparison)
+
+def dedup(args)->None:
+    from .lib.dedup import output_dedup_report
+
+    output_dedup_report(data_path=args.data_path, subject_ls=args.subject, pre_question=PRE_QUESTION, post_question=POST_QUESTION,
+                        output_path=f"{args.result_path}/summary", threshold=args.threshold, cache_dir="./cache/prompts")
+
+def bench(args)->None:
+    from .lib.benchmark import run_benchmark
+
+    run_benchmark(data_path=args.data_path, subject_ls=args.subject, model_name=args.model[0],
+                  concurrency=args.concurrency, latency_ms=args.latency_ms,
+                  error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate)
+
+def telemetry(args)->None:
+    from .lib.telemetry import print_telemetry_summary
+
+    print_telemetry_summary(args.path or f"{args.result_path}/telemetry")
+
+def build_parser()->argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="cpa-test", description="CPA audit test of LLMs. Runs the sweep if no command is given.")
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--data-path", default="./data", help="folder of the cpa data")
+    common.add_argument("--result-path", default="./result", help="folder of the results")
+    common.add_argument("--rag-path", default="./vectorstore_agents", help="folder of the index of the reports")
+    common.add_argument("--subject", nargs="+", default=SUBJECT_LS, help="subjects (like audit, co_act)")
+    common.add_argument("--year", nargs="+", default=None, help="years of every subject. all the years of the subject if omitted.")
+    common.add_argument("--model", nargs="+", default=MODEL_LS, help="main model names")
+    common.add_argument("--rag", choices=["off", "on", "both"], default="off", help="use the reports as the references")
+    common.add_argument("--batch", action="store_true", help="ask all the 4 statements of a question in one request")
+    common.add_argument("--constrained", action="store_true", help="constrain the answers to True or False")
+    common.add_argument("--scoring", action="store_true", help="label by the log-probabilities of True and False (local models only)")
+    common.add_argument("--dedup", action="store_true",
+                        help="send an identical request once in a sweep and share its answer. with the response cache it only saves "
+                             "the concurrent duplicates. a statement repeated under another stem or paraphrased is still sent.")
+
+    sub = parser.add_subparsers(dest="command")
+    p = sub.add_parser("run", parents=[common], help="answer the questions and evaluate them")
+    p.add_argument("--replay", action="store_true", help="answer only from the response cache and fail on a miss")
+    p.set_defaults(func=run)
+    p = sub.add_parser("eval", parents=[common], help="recompute the summaries from the result csv files")
+    p.add_argument("--no-comparison", action="store_true", help="skip the paired comparison of the models")
+    p.set_defaults(func=evaluate)
+    p = sub.add_parser("index", parents=[common], help="build the index of the reports")
+    p.add_argument("--pdf-path", default="./reports", help="folder of the PDF files")
+    p.add_argument("--chunk-size", type=int, default=1000, help="maximum number of characters of a chunk")
+    p.add_argument("--chunk-overlap", type=int, default=0, help="number of characters of the previous chunk put at the head of a chunk")
+    p.add_argument("--n-workers", type=int, default=None, help="number of the processes splitting the PDF files")
+    p.add_argument("--benchmark", action="store_true", help="measure the recall@k and the latency of the retrieval after the build")
+    p.add_argument("--benchmark-queries", type=int, default=200, help="number of the queries of the benchmark")
+    p.add_argument("-k", type=int, default=4, help="number of the chunks of a search in the benchmark")
+    p.set_defaults(func=index)
+    p = sub.add_parser("plan", parents=[common], help="estimate the tokens and the cost without sending anything")
+    p.set_defaults(func=plan)
+    p = sub.add_parser("sweep", help="run the units of the experiment matrix of a config file. several machines can share it.")
+    p.add_argument("config", help="TOML or JSON file of the matrix")
+    p.add_argument("--workers", type=int, default=1, help="number of the worker processes on this machine")
+    p.add_argument("--worker-id", default=None, help="name of the worker. host and pid if omitted.")
+    p.add_argument("--claim-size", type=int, default=4, help="maximum number of units claimed at a time")
+    p.add_argument("--lease", type=float, default=600.0, help="seconds after which the claim of a dead worker is taken over")
+    p.add_argument("--no-merge", action="store_true", help="return when nothing is left to claim instead of waiting and merging")
+    p.set_defaults(func=sweep)
+    p = sub.add_parser("merge", help="summarize the results of a finished sweep")
+    p.add_argument("config", help="TOML or JSON file of the matrix")
+    p.add_argument("--no-comparison", action="store_true", help="skip the paired comparison of the models")
+    p.set_defaults(func=merge)
+    p = sub.add_parser("dedup", parents=[common], help="report the exact and the near duplicate statements across the years. --dedup saves only the identical prompts of them.")
+    p.add_argument("--threshold", type=float, default=0.8, help="minimum estimated Jaccard similarity of the near duplicates")
+    p.set_defaults(func=dedup)
+    p = sub.add_parser("bench", parents=[common], help="measure the throughput against a local mock server")
+    p.add_argument("--concurrency", type=int, default=16, help="maximum number of in-flight requests")
+    p.add_argument("--latency-ms", type=float, default=200, help="median latency of the mock server")
+    p.add_argument("--error-rate", type=float, default=0.0, help="rate of the server errors")
+    p.add_argument("--rate-limit-rate", type=float, default=0.0, help="rate of the rate limit errors")
+    p.set_defaults(func=bench)
+    p = sub.add_parser("telemetry", parents=[common], help="summarize the telemetry of the requests")
+    p.add_argument("path", nargs="?", default=None, help="JSON lines file or folder. result_path/telemetry if omitted.")
+    p.set_defaults(func=telemetry)
+    return parser
+
+def main(argv:list=None):
+    from .lib.logger import get_logger
+
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command is None:
+        args = parser.parse_args(["run"])
+    logger = get_logger(dir_path="./log")
+    logger.info(f"Start CPA audit test {args.command}... (ver.0.1.0)")
+    args.func(args)
+    logger.info(f"Finished CPA test {args.command}.")
 
 if __name__=="__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,71 @@
+import asyncio
+import os
+
+import openai
+import pytest
+import tiktoken
+
+from cpa_test.lib import util
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), "..", "data")
+
+class FakeChatCompletion:
+    """FakeChatCompletion
+
+    Replacement of openai.ChatCompletion.acreate which answers without the network.
+    answer(query) gives the content of the answer (or raises), and every request is recorded.
+    An answer takes delay seconds, so the requests of a sweep can be in flight together.
+    """
+    def __init__(self):
+        self.requests = []
+        self.answer = lambda query: "True"
+        self.delay = 0.0
+
+    async def acreate(self, model:str, messages:list, **kwargs)->dict:
+        self.requests.append({"model": model, "messages": messages, **kwargs})
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        content = self.answer(messages[-1]["content"])
+        return {"choices": [{"message": {"content": content}}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 1, "total_tokens": 11}}
+
+    @property
+    def queries(self)->list:
+        return [r["messages"][-1]["content"] for r in self.requests]
+
+@pytest.fixture
+def fake_openai(monkeypatch):
+    fake = FakeChatCompletion()
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", fake.acreate)
+    return fake
+
+@pytest.fixture
+def result_path(tmp_path):
+    path = tmp_path / "result"
+    for d in ["csv", "summary"]:
+        (path / d).mkdir(parents=True)
+    return str(path)
+
+class FakeEncoding:
+    """FakeEncoding
+
+    Replacement of the tiktoken encodings, which are downloaded on the first use.
+    Every character is one token, and the labels are single tokens.
+    """
+    name = "fake"
+    LABEL_TOKENS = {"True": 2575, "False": 4139}
+
+    def encode(self, text:str, **kwargs)->list:
+        return [self.LABEL_TOKENS[text]] if text in self.LABEL_TOKENS else [ord(c) for c in text]
+
+    def encode_ordinary_batch(self, texts:list, **kwargs)->list:
+        return [self.encode(t) for t in texts]
+
+@pytest.fixture
+def fake_encoding(monkeypatch):
+    encoding = FakeEncoding()
+    monkeypatch.setattr(tiktoken, "encoding_for_model", lambda model_name: encoding)
+    monkeypatch.setattr(tiktoken, "get_encoding", lambda name: encoding)
+    util.get_encoding.cache_clear()
+    yield encoding
+    util.get_encoding.cache_clear()
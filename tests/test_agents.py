@@ -0,0 +1,187 @@
+import asyncio
+import re
+import threading
+
+import numpy as np
+import pytest
+
+from cpa_test.lib import agents
+from cpa_test.lib.agents import BATCH_GRAMMAR, BATCH_MAX_TOKENS, LABEL_GRAMMAR, BaseAgent, Completion, GPTAgent, LlamaAgent, RagAgent
+from cpa_test.lib.cache import ResponseCache
+from cpa_test.lib.util import parse_batch_answer
+
+class EchoAgent(BaseAgent):
+    queries:list=None
+
+    def __init__(self):
+        super().__init__()
+        self.agent_type = "echo"
+        self.main_model_name = "echo"
+        self.queries = []
+
+    async def _run(self, query:str, system_prompt:str, constraint:str=None)->Completion:
+        self.queries.append(query)
+        return Completion(content="True")
+
+class Retriever:
+    def __init__(self, fail:int=0):
+        self.queries = []
+        self.fail = fail
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, query:str)->str:
+        self.queries.append(query)
+        self.release.wait(5)
+        if len(self.queries) <= self.fail:
+            raise ConnectionError("retrieval failed")
+        return f"資料({query})"
+
+def test_retrieval_is_shared_by_the_statements():
+    retriever = Retriever()
+    agent = RagAgent(EchoAgent(), retriever)
+    async def _main():
+        return await asyncio.gather(*[agent.complete(f"記述{n}", retrieval_query="問題1") for n in range(4)],
+                                    agent.complete("記述4", retrieval_query="問題2"))
+    completions = asyncio.run(_main())
+    assert [c.content for c in completions] == ["True"] * 5
+    assert sorted(retriever.queries) == ["問題1", "問題2"]
+    assert agent.generator.queries[0] == "参考資料:\n資料(問題1)\n\n記述0"
+    assert agent.latency_stats()["retrieval"]["count"] == 2
+    assert agent.latency_stats()["generation"]["count"] == 5
+
+def test_cancelled_statement_does_not_cancel_the_shared_retrieval():
+    retriever = Retriever()
+    retriever.release.clear()
+    agent = RagAgent(EchoAgent(), retriever)
+    async def _main():
+        cancelled = asyncio.create_task(agent.complete("記述0", retrieval_query="問題1"))
+        other = asyncio.create_task(agent.complete("記述1", retrieval_query="問題1"))
+        while not retriever.queries:
+            await asyncio.sleep(0.01)
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        retriever.release.set()
+        return await other
+    assert asyncio.run(_main()).content == "True"
+    assert retriever.queries == ["問題1"]
+    assert agent.generator.queries == ["参考資料:\n資料(問題1)\n\n記述1"]
+
+def test_failed_retrieval_is_retried():
+    retriever = Retriever(fail=1)
+    agent = RagAgent(EchoAgent(), retriever)
+    async def _main():
+        with pytest.raises(ConnectionError):
+            await agent.complete("記述0", retrieval_query="問題1")
+        return await agent.complete("記述0", retrieval_query="問題1")
+    assert asyncio.run(_main()).content == "True"
+    assert retriever.queries == ["問題1", "問題1"]
+
+def _gbnf_regex(grammar:str)->re.Pattern:
+    # the subset of GBNF used by the grammars: string literals, rule references, alternatives and "?"
+    rules = dict(line.split(" ::= ", 1) for line in grammar.splitlines())
+    def _expr(name:str)->str:
+        alternatives, seq = [], ""
+        for literal, ref, op in re.findall(r'"((?:\\.|[^"\\])*)"|([a-z]+)|([|?])', rules[name]):
+            if op == "|":
+                alternatives.append(seq)
+                seq = ""
+            elif op == "?":
+                seq += "?"
+            elif ref:
+                seq += f"(?:{_expr(ref)})"
+            else:
+                seq += "(?:" + re.escape(literal.replace('\\"', '"')) + ")"
+        return "|".join(alternatives + [seq])
+    return re.compile(_expr("root"))
+
+@pytest.mark.parametrize("text, accepted", [
+    ("True", True),
+    ("False", True),
+    ("true", False),
+    ("True.", False),
+    ("", False),
+])
+def test_label_grammar(text, accepted):
+    assert bool(_gbnf_regex(LABEL_GRAMMAR).fullmatch(text)) == accepted
+
+@pytest.mark.parametrize("text, accepted", [
+    ('{"ア": "True", "イ": "False", "ウ": "True", "エ": "False"}', True),
+    ('{"ア":"False","イ":"False","ウ":"False","エ":"True"}', True),
+    ('{"ア": "True", "イ": "False", "ウ": "True"}', False), # エ is missing
+    ('{"イ": "True", "ア": "False", "ウ": "True", "エ": "False"}', False),
+    ('{"ア": "true", "イ": "False", "ウ": "True", "エ": "False"}', False),
+    ('{"ア": "True", "イ": "False", "ウ": "True", "エ": "False"} ', False),
+])
+def test_batch_grammar(text, accepted):
+    assert bool(_gbnf_regex(BATCH_GRAMMAR).fullmatch(text)) == accepted
+    if accepted: # every answer the grammar accepts is parsed
+        assert parse_batch_answer(text) is not None
+
+def test_decoding_params_of_single_token_labels(fake_encoding):
+    agent = GPTAgent("gpt-4", "指示")
+    assert agent._decoding_params("label") == {"max_tokens": 1, "logit_bias": {"2575": 100, "4139": 100}}
+    assert agent._decoding_params("batch") == {"max_tokens": BATCH_MAX_TOKENS}
+    assert agent._decoding_params(None) == {}
+
+def test_decoding_params_of_multi_token_labels(fake_encoding, monkeypatch):
+    monkeypatch.setattr(fake_encoding, "LABEL_TOKENS", {})
+    assert GPTAgent("gpt-4", "指示")._decoding_params("label") == {"max_tokens": len("False")}
+
+def test_constrained_request(fake_encoding, fake_openai):
+    agent = GPTAgent("gpt-4", "指示")
+    assert asyncio.run(agent.run("記述", constraint="label")) == "True"
+    assert fake_openai.requests[0]["logit_bias"] == {"2575": 100, "4139": 100}
+    assert fake_openai.requests[0]["max_tokens"] == 1
+    with pytest.raises(ValueError):
+        asyncio.run(agent.run("記述", constraint="json"))
+
+class FakePool:
+    def __init__(self, **kwargs):
+        self.N_INSTANCES = kwargs.get("n_instances", 1)
+        self.calls = []
+        self.logprobs = {}
+
+    async def score_labels(self, messages_ls:list, labels:list)->list:
+        self.calls.append([messages[-1]["content"] for messages in messages_ls])
+        return [{"logprobs": self.logprobs[messages[-1]["content"]], "prompt_tokens": 20, "evaluated_tokens": 5}
+                for messages in messages_ls]
+
+    def close(self)->None:
+        pass
+
+@pytest.fixture
+def llama_agent(monkeypatch, tmp_path):
+    monkeypatch.setattr(agents, "LlamaPool", FakePool)
+    return LlamaAgent("./models", "llama", "指示", cache=ResponseCache(str(tmp_path / "responses.sqlite")))
+
+def test_score_normalizes_the_label_probabilities(llama_agent):
+    llama_agent.agent.logprobs = {"記述0": {"True": -0.5, "False": -2.0},
+                                  "記述1": {"True": -30.0, "False": -31.0}, # unlikely continuations of both labels
+                                  "記述2": {"True": -3.0, "False": -1.0}}
+    completions = asyncio.run(llama_agent.score(["記述0", "記述1", "記述2"]))
+    assert [c.content for c in completions] == ["True", "True", "False"]
+    assert completions[0].confidence == pytest.approx(1 / (1 + np.exp(-1.5)))
+    assert completions[1].confidence == pytest.approx(1 / (1 + np.exp(-1.0)))
+    assert completions[2].confidence == pytest.approx(1 / (1 + np.exp(-2.0)))
+    assert all(0.5 <= c.confidence <= 1 and c.prompt_tokens == 20 and c.completion_tokens == 0 for c in completions)
+    assert llama_agent.agent.calls == [["記述0", "記述1", "記述2"]] # scored together in one worker
+
+def test_scores_are_cached(llama_agent):
+    llama_agent.agent.logprobs = {"記述0": {"True": -0.5, "False": -2.0}, "記述1": {"True": -3.0, "False": -1.0}}
+    first = asyncio.run(llama_agent.score(["記述0"]))
+    completions = asyncio.run(llama_agent.score(["記述0", "記述1"]))
+    assert llama_agent.agent.calls == [["記述0"], ["記述1"]]
+    assert completions[0].cached and not completions[1].cached
+    assert completions[0].confidence == first[0].confidence and completions[0].content == "True"
+    # a scored statement is not an answer of the decoding mode
+    assert llama_agent.cache.get(llama_agent.cache.make_key("llama", "指示", "記述0", 0, 0)) is None
+
+def test_generated_answer_is_replayed_from_the_cache(fake_openai, tmp_path):
+    agent = GPTAgent("gpt-4", "指示", cache=ResponseCache(str(tmp_path / "responses.sqlite")))
+    first = asyncio.run(agent.complete("記述"))
+    assert first.confidence is None and not first.cached
+    replayed = asyncio.run(agent.complete("記述"))
+    assert replayed.cached and replayed.content == first.content and replayed.confidence is None
+    assert len(fake_openai.requests) == 1
@@ -0,0 +1,81 @@
+import itertools
+
+import pytest
+
+from cpa_test.lib import cache as cache_module
+from cpa_test.lib.cache import CacheMissError, ResponseCache
+
+def test_make_key_is_stable():
+    key = ResponseCache.make_key("gpt-4", "system", "query", 0.0, 0, max_tokens=10, grammar="root")
+    assert key == ResponseCache.make_key("gpt-4", "system", "query", 0.0, 0, grammar="root", max_tokens=10)
+    assert len(key) == 64
+
+@pytest.mark.parametrize("changed", [{"model_name": "gpt-3.5"}, {"system_prompt": "other"}, {"query": "other"},
+                                     {"temperature": 0.5}, {"seed": 1}])
+def test_make_key_changes_with_the_request(changed):
+    request = {"model_name": "gpt-4", "system_prompt": "system", "query": "query", "temperature": 0.0, "seed": 0}
+    assert ResponseCache.make_key(**request) != ResponseCache.make_key(**{**request, **changed})
+
+def test_make_key_changes_with_the_params():
+    key = ResponseCache.make_key("gpt-4", "system", "query", 0.0, 0)
+    assert key != ResponseCache.make_key("gpt-4", "system", "query", 0.0, 0, max_tokens=10)
+
+def test_get_put_and_reopen(tmp_path):
+    path = str(tmp_path / "responses.sqlite")
+    cache = ResponseCache(path)
+    assert cache.get("a") is None
+    cache.put("a", {"content": "True"})
+    assert cache.get("a") == {"content": "True"}
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+    cache.close()
+    cache = ResponseCache(path)
+    assert cache.get("a") == {"content": "True"}
+    cache.close()
+
+def test_lru_eviction(tmp_path, monkeypatch):
+    clock = itertools.count()
+    monkeypatch.setattr(cache_module.time, "time", lambda: float(next(clock)))
+    payload = {"content": "x" * 100}
+    cache = ResponseCache(str(tmp_path / "responses.sqlite"))
+    cache.put("a", payload)
+    size = cache.stats()["bytes"]
+    cache.MAX_BYTES = 2 * size
+    cache.put("b", payload)
+    assert cache.get("a") == payload # "b" is the least recently used now
+    cache.put("c", payload)
+    assert cache.stats()["bytes"] == 2 * size
+    assert cache.get("b") is None
+    assert cache.get("a") == payload
+    assert cache.get("c") == payload
+    cache.close()
+
+def test_replay(tmp_path):
+    path = str(tmp_path / "responses.sqlite")
+    with pytest.raises(FileNotFoundError):
+        ResponseCache(path, replay=True)
+    cache = ResponseCache(path)
+    cache.put("a", {"content": "True"})
+    cache.close()
+    cache = ResponseCache(path, replay=True)
+    assert cache.get("a") == {"content": "True"}
+    cache.put("b", {"content": "False"}) # ignored
+    with pytest.raises(CacheMissError):
+        cache.get("b")
+    cache.close()
+
+def test_size_is_shared_by_the_processes(tmp_path):
+    # the workers of a sweep open the same file, and the eviction keeps the file under the limit
+    path = str(tmp_path / "responses.sqlite")
+    payload = {"content": "x" * 100}
+    cache_a = ResponseCache(path)
+    cache_a.put("a", payload)
+    size = cache_a.stats()["bytes"]
+    cache_a.MAX_BYTES = 3 * size
+    cache_b = ResponseCache(path, max_bytes=3 * size)
+    for k in range(4):
+        cache_a.put(f"a{k}", payload)
+        cache_b.put(f"b{k}", payload)
+    assert cache_a.stats()["bytes"] <= 3 * size
+    assert cache_b.stats()["bytes"] <= 3 * size
+    cache_a.close()
+    cache_b.close()
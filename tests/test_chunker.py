@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from cpa_test.lib.chunker import iter_chunks
+
+def _pages(seed:int=0, n_pages:int=20)->list:
+    # articles, numbered paragraphs, long sentences and tables without "。"
+    rng = np.random.default_rng(seed)
+    pages = []
+    for page in range(n_pages):
+        lines = []
+        for k in range(int(rng.integers(3, 8))):
+            kind = rng.integers(0, 4)
+            if kind == 0:
+                lines.append(f"第{page * 10 + k + 1}条　" + "あ" * int(rng.integers(10, 200)) + "。")
+            elif kind == 1:
+                lines.append(f"{k + 1}．" + "い" * int(rng.integers(10, 400)) + "。" + "う" * int(rng.integers(0, 300)) + "。")
+            elif kind == 2:
+                lines.extend("表" * int(rng.integers(5, 60)) for _ in range(int(rng.integers(1, 30))))
+            else:
+                lines.append("え" * int(rng.integers(100, 1500)))
+        lines.append(f"- {page + 1} -") # page number
+        pages.append((page, "\n".join(lines)))
+    return pages
+
+@pytest.mark.parametrize("chunk_size", [100, 300, 1000])
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_chunks_are_not_longer_than_chunk_size(chunk_size, seed):
+    chunks = list(iter_chunks(_pages(seed), chunk_size=chunk_size))
+    assert chunks
+    assert max(len(text) for text, _ in chunks) <= chunk_size
+    assert all(text for text, _ in chunks)
+
+def test_overlap_is_put_at_the_head():
+    chunks = list(iter_chunks(_pages(3), chunk_size=200, chunk_overlap=20))
+    assert max(len(text) for text, _ in chunks) <= 200 + 20
+    for (prev, _), (text, _) in zip(chunks, chunks[1:]):
+        assert text.startswith(prev[-20:])
+
+def test_no_text_is_lost():
+    pages = _pages(4)
+    chunks = list(iter_chunks(pages, chunk_size=250))
+    expected = "".join(line for _, text in pages for line in text.splitlines() if not line.startswith("- "))
+    assert "".join(text.replace("\n", "") for text, _ in chunks) == expected
+
+def test_metadata():
+    pages = [(0, "第一条　この法律は、会社の設立について定める。\n第二条　" + "あ" * 50 + "。"),
+             (1, "第三条　" + "い" * 50 + "。")]
+    chunks = list(iter_chunks(pages, chunk_size=60, min_chunk_size=0))
+    assert [meta for _, meta in chunks] == [{"page": 0, "article": "第一条"},
+                                           {"page": 0, "article": "第二条"},
+                                           {"page": 1, "article": "第三条"}]
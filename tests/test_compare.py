@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from cpa_test.lib.compare import compare_models, mcnemar_exact
+
+@pytest.mark.parametrize("b, c, p", [
+    (0, 0, 1.0),
+    (5, 5, 1.0),
+    (0, 5, 2 / 32),
+    (1, 9, 2 * 11 / 1024),
+    (2, 10, 2 * (1 + 12 + 66) / 4096),
+    (12, 4, 2 * (1 + 16 + 120 + 560 + 1820) / 65536),
+])
+def test_mcnemar_exact(b, c, p):
+    assert mcnemar_exact(b, c) == pytest.approx(p)
+    assert mcnemar_exact(c, b) == pytest.approx(p)
+
+def test_mcnemar_exact_matches_scipy():
+    stats = pytest.importorskip("scipy.stats")
+    for b, c in [(3, 17), (40, 25), (7, 8)]:
+        assert mcnemar_exact(b, c) == pytest.approx(stats.binomtest(b, b + c, 0.5).pvalue)
+
+def _results(answer:list, results:dict)->pd.DataFrame:
+    return pd.concat([pd.DataFrame({"model_name": m, "result": r, "answer": answer}) for m, r in results.items()], ignore_index=True)
+
+def test_compare_models_removes_the_invalid_answers_from_both_models():
+    answer = ["True", "False"] * 10
+    m1 = list(answer)
+    m2 = [("False" if a == "True" else "True") if k < 4 else a for k, a in enumerate(answer)]
+    m1[0] = "nan" # invalid for m1, wrong for m2
+    df_ci, df_pair = compare_models(_results(answer, {"m1": m1, "m2": m2}), ["m1", "m2"], n_boot=200)
+    ci = df_ci.set_index("model_name")
+    assert ci.loc["m1", "support"] == 19 and ci.loc["m1", "invalid"] == 1
+    assert ci.loc["m1", "accuracy"] == 1.0
+    assert ci.loc["m2", "accuracy"] == pytest.approx(16 / 20)
+    pair = df_pair.iloc[0]
+    assert (pair["support"], pair["invalid_1"], pair["invalid_2"]) == (19, 1, 0)
+    # the statement invalid for m1 is removed from both, so m2 gets 3 wrong of 19
+    assert pair["accuracy_diff"] == pytest.approx(1.0 - 16 / 19)
+    assert (pair["only_1_correct"], pair["only_2_correct"]) == (3, 0)
+    assert pair["mcnemar_p"] == pytest.approx(mcnemar_exact(3, 0))
+    assert pair["accuracy_diff_low"] <= pair["accuracy_diff"] <= pair["accuracy_diff_high"]
+
+def test_compare_models_is_reproducible():
+    rng = np.random.default_rng(0)
+    answer = list(rng.choice(["True", "False"], size=50))
+    results = {m: list(rng.choice(["True", "False"], size=50)) for m in ["a", "b", "c"]}
+    df_res = _results(answer, results)
+    df_ci_1, df_pair_1 = compare_models(df_res, ["a", "b", "c"], n_boot=300, seed=1)
+    df_ci_2, df_pair_2 = compare_models(df_res, ["a", "b", "c"], n_boot=300, seed=1)
+    pd.testing.assert_frame_equal(df_ci_1, df_ci_2)
+    pd.testing.assert_frame_equal(df_pair_1, df_pair_2)
+    assert len(df_pair_1) == 3
+
+def test_compare_models_needs_aligned_results():
+    df_res = _results(["True", "False"], {"a": ["True", "False"]})
+    df_res = pd.concat([df_res, pd.DataFrame({"model_name": "b", "result": ["True"], "answer": ["True"]})], ignore_index=True)
+    with pytest.raises(ValueError):
+        compare_models(df_res, ["a", "b"], n_boot=10)
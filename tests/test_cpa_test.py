@@ -0,0 +1,152 @@
+import asyncio
+import os
+
+import openai
+import pandas as pd
+import pytest
+
+from cpa_test.lib.cache import ResponseCache
+from cpa_test.lib.cpa_test import CpaTest
+from cpa_test.lib.journal import ResultJournal
+from cpa_test.lib.telemetry import TelemetrySink, load_telemetry
+
+from conftest import DATA_PATH
+
+class Interrupted(BaseException):
+    pass
+
+def _run(cpa:CpaTest, years:list=["R3"], model_ls:list=["gpt-4"], subject:str="audit")->None:
+    asyncio.run(cpa.sweep([subject], {subject: years}, model_ls, False))
+
+def _csv(result_path:str, name:str="audit_R3_gpt-4_rag_False")->pd.DataFrame:
+    return pd.read_csv(f"{result_path}/csv/{name}.csv", dtype=str)
+
+def test_sweep_writes_the_results(fake_openai, result_path):
+    _run(CpaTest(DATA_PATH, result_path))
+    df = _csv(result_path)
+    assert len(df) == len(fake_openai.requests) == 80
+    assert (df["result"] == "True").all() and (df["status"] == "ok").all()
+    assert not os.path.exists(f"{result_path}/journal/audit_R3_gpt-4_rag_False.jsonl")
+
+def test_interrupted_year_resumes_from_the_journal(fake_openai, result_path):
+    def _answer(query):
+        if len(fake_openai.requests) > 30:
+            raise Interrupted()
+        return "False"
+    fake_openai.answer = _answer
+    with pytest.raises(Interrupted):
+        _run(CpaTest(DATA_PATH, result_path))
+    journal_path = f"{result_path}/journal/audit_R3_gpt-4_rag_False.jsonl"
+    journal = ResultJournal(journal_path)
+    n_answered = len(journal.records)
+    journal.close()
+    assert 0 < n_answered < 80
+
+    fake_openai.requests.clear()
+    fake_openai.answer = lambda query: "True"
+    _run(CpaTest(DATA_PATH, result_path))
+    assert len(fake_openai.requests) == 80 - n_answered
+    df = _csv(result_path)
+    assert (df["result"] == "False").sum() == n_answered
+    assert (df["status"] == "ok").all()
+    assert not os.path.exists(journal_path)
+
+def test_unsupported_year_leaves_no_journal(fake_openai, result_path):
+    with pytest.raises(NotImplementedError):
+        _run(CpaTest(DATA_PATH, result_path), years=["H25_1"])
+    assert not os.path.exists(f"{result_path}/journal/audit_H25_1_gpt-4_rag_False.jsonl")
+
+def test_batch_answers(fake_openai, result_path):
+    cpa = CpaTest(DATA_PATH, result_path, batch=True)
+    fake_openai.answer = lambda query: '{"ア": "True", "イ": "False", "ウ": "True", "エ": "False"}'
+    _run(cpa)
+    assert len(fake_openai.requests) == 20
+    assert all(r["messages"][0]["content"] == cpa.BATCH_SYSTEM_PROMPT for r in fake_openai.requests)
+    df = _csv(result_path, "audit_R3_gpt-4_batch_rag_False")
+    assert df["result"].tolist() == ["True", "False", "True", "False"] * 20
+
+def test_malformed_batch_answer_falls_back_to_single_requests(fake_openai, result_path):
+    cpa = CpaTest(DATA_PATH, result_path, batch=True)
+    def _answer(query):
+        if fake_openai.requests[-1]["messages"][0]["content"] == cpa.BATCH_SYSTEM_PROMPT:
+            return "ア: True, イ: ?" # malformed
+        return "False"
+    fake_openai.answer = _answer
+    _run(cpa)
+    assert len(fake_openai.requests) == 20 + 80
+    df = _csv(result_path, "audit_R3_gpt-4_batch_rag_False")
+    assert (df["result"] == "False").all() and (df["status"] == "ok").all()
+
+def test_failed_statements_are_recorded_with_the_error_status(fake_openai, result_path):
+    def _answer(query):
+        if len(fake_openai.requests) <= 3:
+            raise openai.error.InvalidRequestError("context length exceeded", "messages")
+        return "True"
+    fake_openai.answer = _answer
+    _run(CpaTest(DATA_PATH, result_path))
+    assert len(fake_openai.requests) == 80 # not retried
+    df = _csv(result_path)
+    assert (df["status"] == "error:InvalidRequestError").sum() == 3
+    assert df.loc[df["status"] != "ok", "result"].isna().all()
+    assert (df.loc[df["status"] == "ok", "result"] == "True").all()
+
+def test_every_request_is_recorded_in_the_telemetry(fake_openai, result_path):
+    def _answer(query):
+        if len(fake_openai.requests) == 1:
+            raise openai.error.InvalidRequestError("context length exceeded", "messages")
+        return "True"
+    fake_openai.answer = _answer
+    cpa = CpaTest(DATA_PATH, result_path)
+    assert not os.path.exists(f"{result_path}/telemetry")
+    _run(cpa)
+    df = load_telemetry(f"{result_path}/telemetry")
+    assert len(df) == 80
+    assert (df["subject"] == "audit").all() and (df["model"] == "gpt-4").all() and (df["year"] == "R3").all()
+    assert sorted(df["statement"].unique()) == ["ア", "イ", "ウ", "エ"]
+    assert df["error"].tolist().count("InvalidRequestError") == 1
+    df_ok = df[df["error"].isna()]
+    assert (df_ok["prompt_tokens"] == 10).all() and (df_ok["completion_tokens"] == 1).all()
+    assert ((df["end"] >= df["start"]) & (df["queue_wait"] >= 0)).all()
+    assert os.path.exists(f"{result_path}/telemetry/cpa_test.prom")
+
+def test_given_telemetry_sink_is_used(fake_openai, result_path, tmp_path):
+    sink = TelemetrySink(str(tmp_path / "sink"), run_name="worker")
+    _run(CpaTest(DATA_PATH, result_path, telemetry=sink))
+    assert len(load_telemetry(sink.PATH)) == 80
+    assert not os.path.exists(f"{result_path}/telemetry")
+
+def test_failed_statements_are_asked_again_by_the_next_run(fake_openai, result_path):
+    def _answer(query):
+        if len(fake_openai.requests) <= 3:
+            raise openai.error.InvalidRequestError("context length exceeded", "messages")
+        return "False"
+    fake_openai.answer = _answer
+    _run(CpaTest(DATA_PATH, result_path))
+    failed = fake_openai.queries[:3]
+    journal_path = f"{result_path}/journal/audit_R3_gpt-4_rag_False.jsonl"
+    assert os.path.exists(journal_path)
+
+    fake_openai.requests.clear()
+    fake_openai.answer = lambda query: "True"
+    _run(CpaTest(DATA_PATH, result_path))
+    assert sorted(fake_openai.queries) == sorted(failed)
+    df = _csv(result_path)
+    assert (df["status"] == "ok").all()
+    assert (df["result"] == "True").sum() == 3
+    assert not os.path.exists(journal_path)
+
+@pytest.mark.parametrize("dedup, n_requests", [(False, 160), (True, 159)])
+def test_identical_requests_of_a_sweep_are_sent_once(fake_openai, result_path, tmp_path, dedup, n_requests):
+    # co_act H29_1 q8 ウ and R2_1 q7 ウ are the same prompt. they are in flight together, so the response cache misses both.
+    cache = ResponseCache(str(tmp_path / "responses.sqlite"))
+    fake_openai.delay = 0.05
+    cpa = CpaTest(DATA_PATH, result_path, dedup=dedup, cache=cache, concurrency={"gpt-4": 160})
+    _run(cpa, years=["H29_1", "R2_1"], subject="co_act")
+    assert len(fake_openai.requests) == n_requests
+    assert len(set(fake_openai.queries)) == 159
+    df_h29 = _csv(result_path, "co_act_H29_1_gpt-4_rag_False")
+    df_r2 = _csv(result_path, "co_act_R2_1_gpt-4_rag_False")
+    assert len(df_h29) == len(df_r2) == 80
+    assert (df_h29["status"] == "ok").all() and (df_r2["status"] == "ok").all()
+    df = load_telemetry(f"{result_path}/telemetry")
+    assert len(df) == 160 and df["cache_hit"].astype(bool).sum() == 160 - n_requests
@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from cpa_test.lib.dedup import build_dedup_index, dedup_report, minhash, normalize_sentence, year_order
+
+BASE = "監査人は、監査計画の策定に当たり、企業及び企業環境を理解し、重要な虚偽表示リスクを識別しなければならない。"
+PARAPHRASE = "監査人は、監査計画の策定に当たり、企業及び企業環境を理解して、重要な虚偽表示リスクを識別しなければならない。"
+OTHER = "取締役会設置会社においては、取締役は三人以上でなければならない。"
+
+def _prompt_table(rows:list)->pd.DataFrame:
+    return pd.DataFrame([{"subject": "audit", "year": year, "q_no": q_no, "statement": "ア", "sentence": sentence,
+                          "answer": answer, "prompt": f"問題: {sentence}", "supported": supported}
+                         for year, q_no, sentence, answer, supported in rows])
+
+def test_normalize_sentence():
+    assert normalize_sentence("ＡＢＣ　１２３，テスト。") == normalize_sentence("ABC 123、テスト.")
+
+def test_year_order():
+    assert sorted(["R3", "H31_2", "R2_1", "H30_1", "unknown"], key=year_order) == ["H30_1", "H31_2", "R2_1", "R3", "unknown"]
+
+def test_minhash_estimates_the_jaccard_similarity():
+    texts = [normalize_sentence(s) for s in [BASE, PARAPHRASE, OTHER]]
+    sig = minhash(texts, num_perm=256)
+    assert sig.shape == (3, 256)
+    assert (minhash(texts, num_perm=256) == sig).all()
+    grams = [{t[k:k + 3] for k in range(len(t) - 2)} for t in texts]
+    jaccard = len(grams[0] & grams[1]) / len(grams[0] | grams[1])
+    assert (sig[0] == sig[1]).mean() == pytest.approx(jaccard, abs=0.1)
+    assert (sig[0] == sig[2]).mean() < 0.1
+
+def test_build_dedup_index():
+    df_prompt = _prompt_table([("R2_1", 1, BASE, True, True),
+                               ("R3", 2, BASE.replace("、", "，"), True, True), # exact after the normalization
+                               ("R4", 3, PARAPHRASE, True, True),
+                               ("R4", 4, OTHER, False, True),
+                               ("R4", 5, BASE, True, False)]) # not supported
+    df_index = build_dedup_index(df_prompt, threshold=0.7)
+    assert len(df_index) == 4
+    assert df_index["exact_id"].nunique() == 3
+    assert df_index.loc[0, "exact_id"] == df_index.loc[1, "exact_id"]
+    cluster = df_index["cluster_id"].to_numpy()
+    assert cluster[0] == cluster[1] == cluster[2] != cluster[3]
+    assert df_index["cluster_size"].tolist() == [3, 3, 3, 1]
+
+def test_union_find_chains_the_paraphrases():
+    # every sentence differs from the next one by one character, so the first and the last ones are only chained
+    rng = np.random.default_rng(0)
+    chars = list(BASE)
+    chain = ["".join(chars)]
+    for _ in range(6):
+        k = int(rng.integers(0, len(chars)))
+        chars[k] = "あ"
+        chain.append("".join(chars))
+    df_prompt = _prompt_table([("R3", q_no, s, True, True) for q_no, s in enumerate(chain)] + [("R3", 99, OTHER, True, True)])
+    df_index = build_dedup_index(df_prompt, threshold=0.7)
+    assert df_index["cluster_id"].iloc[:-1].nunique() == 1
+    assert df_index["cluster_id"].iloc[-1] != df_index["cluster_id"].iloc[0]
+
+def test_dedup_report():
+    df_prompt = _prompt_table([("R2_1", 1, BASE, True, True),
+                               ("R3", 2, BASE, True, True),
+                               ("R3", 3, PARAPHRASE, False, True),
+                               ("R3", 4, OTHER, False, True)])
+    df_clusters, df_years, df_overlap = dedup_report(build_dedup_index(df_prompt, threshold=0.7))
+    assert len(df_clusters) == 1
+    assert df_clusters.loc[0, "size"] == 3 and df_clusters.loc[0, "distinct"] == 2
+    assert not df_clusters.loc[0, "consistent"]
+    years = df_years.set_index("year")
+    assert years.loc["R3", "dedup_saved"] == 1 # only the identical prompt is saved
+    assert years.loc["R3", "exact_earlier"] == 1
+    assert years.loc["R3", "near_earlier"] == 2
+    assert years.loc["R2_1", "near_earlier"] == 0
+    assert df_overlap.loc["R3", "R2_1"] == 2
+    assert df_overlap.loc["R3", "R3"] == 2
@@ -0,0 +1,69 @@
+import os
+
+import numpy as np
+
+from cpa_test.lib.embedding_cache import KEYS_FILE, VECTORS_FILE, EmbeddingCache
+from cpa_test.lib.vector_index import HashingEmbedding
+
+class CountingEmbedding(HashingEmbedding):
+    def __init__(self, dim:int=32):
+        super().__init__(dim=dim)
+        self.texts = []
+
+    def embed_documents(self, texts:list)->list:
+        self.texts.extend(texts)
+        return super().embed_documents(texts)
+
+TEXTS = ["第1条 監査人は、独立の立場を保持しなければならない。", "第2条 監査人は、正当な注意を払わなければならない。", "第3条 監査役は、取締役の職務の執行を監査する。"]
+
+def test_hits_and_misses(tmp_path):
+    embeddings = CountingEmbedding()
+    cache = EmbeddingCache(str(tmp_path), embeddings.model)
+    vectors = cache.embed(TEXTS[:2], embeddings)
+    assert embeddings.texts == TEXTS[:2]
+    assert cache.stats() == {"hits": 0, "misses": 2, "hit_rate": 0.0, "vectors": 2}
+
+    # a text which differs only in the width of the characters and the white spaces is a hit
+    vectors2 = cache.embed([TEXTS[1], TEXTS[0].replace("1", "１") + "\n", TEXTS[2], TEXTS[2]], embeddings, batch_size=1)
+    assert embeddings.texts == TEXTS
+    assert (vectors2[0] == vectors[1]).all() and (vectors2[1] == vectors[0]).all()
+    assert (vectors2[2] == np.asarray(embeddings.embed_query(TEXTS[2]), dtype=np.float32)).all()
+    assert cache.stats()["hits"] == 3 and cache.stats()["misses"] == 3 and len(cache) == 3
+    assert cache.embed([], embeddings).shape == (0, 32)
+
+def test_vectors_are_reloaded(tmp_path):
+    embeddings = CountingEmbedding()
+    vectors = EmbeddingCache(str(tmp_path), embeddings.model).embed(TEXTS, embeddings)
+    embeddings.texts.clear()
+    cache = EmbeddingCache(str(tmp_path), embeddings.model)
+    assert (cache.embed(TEXTS, embeddings) == vectors).all()
+    assert embeddings.texts == []
+
+def test_another_model_does_not_hit(tmp_path):
+    EmbeddingCache(str(tmp_path), "hashing-32-1_2_3").embed(TEXTS, CountingEmbedding(32))
+    embeddings = CountingEmbedding(64)
+    cache = EmbeddingCache(str(tmp_path), embeddings.model)
+    assert len(cache) == 0
+    assert cache.embed(TEXTS, embeddings).shape == (3, 64)
+    assert embeddings.texts == TEXTS
+
+def test_truncated_last_record_is_embedded_again(tmp_path):
+    embeddings = CountingEmbedding()
+    cache = EmbeddingCache(str(tmp_path), embeddings.model)
+    vectors = cache.embed(TEXTS, embeddings)
+    # the last append was cut off in the middle of the vector and the key
+    for file_name, cut in [(VECTORS_FILE, 5), (KEYS_FILE, 10)]:
+        path = f"{cache.PATH}/{file_name}"
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) - cut)
+
+    embeddings.texts.clear()
+    cache = EmbeddingCache(str(tmp_path), embeddings.model)
+    assert len(cache) == 2
+    assert (cache.embed(TEXTS, embeddings) == vectors).all()
+    assert embeddings.texts == TEXTS[2:]
+    assert os.path.getsize(f"{cache.PATH}/{VECTORS_FILE}") == 3 * 4 * 32
+
+    cache = EmbeddingCache(str(tmp_path), embeddings.model)
+    assert len(cache) == 3
+    assert (cache.embed(TEXTS, embeddings) == vectors).all()
@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from cpa_test.lib.eval import METRICS_COLUMNS, summarize
+
+def _long_table(seed:int=0, n:int=400)->pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({"model_name": rng.choice(["gpt-4", "gpt-3.5", "llama"], size=n),
+                         "year": rng.choice(["R2_1", "R3", "R4"], size=n),
+                         "result": rng.choice(["True", "False", "nan", "わかりません"], size=n, p=[0.45, 0.45, 0.05, 0.05]),
+                         "answer": rng.choice(["True", "False"], size=n),
+                         "status": rng.choice(["ok", "error:Timeout"], size=n, p=[0.95, 0.05])})
+
+def _per_group_metrics(df_res:pd.DataFrame)->dict:
+    # the metrics of one group as the former get_metrics computed them with scikit-learn
+    from sklearn.metrics import accuracy_score, confusion_matrix, precision_recall_fscore_support
+    df_res = df_res[df_res["result"].isin(["True", "False"])]
+    tn, fp, fn, tp = confusion_matrix(df_res["answer"], df_res["result"], labels=["False", "True"]).flatten()
+    pre, rec, f1, _ = precision_recall_fscore_support(df_res["answer"], df_res["result"], beta=1, labels=["False", "True"],
+                                                      pos_label="True", average="binary", zero_division=0)
+    return {"TN": tn, "FP": fp, "FN": fn, "TP": tp, "accuracy": accuracy_score(df_res["answer"], df_res["result"]),
+            "precision": pre, "recall": rec, "f1-score": f1, "support": len(df_res)}
+
+def test_summarize_equals_the_per_group_metrics():
+    pytest.importorskip("sklearn")
+    df_res = _long_table()
+    df_sum = summarize(df_res, by=["model_name", "year"])
+    assert len(df_sum) == 9
+    for row in df_sum.to_dict("records"):
+        df_g = df_res[(df_res["model_name"] == row["model_name"]) & (df_res["year"] == row["year"])]
+        expected = _per_group_metrics(df_g)
+        for col in METRICS_COLUMNS:
+            assert row[col] == pytest.approx(expected[col]), col
+
+def test_summarize_overall():
+    pytest.importorskip("sklearn")
+    df_res = _long_table(seed=1)
+    row = summarize(df_res, by=[]).to_dict("records")[0]
+    expected = _per_group_metrics(df_res)
+    for col in METRICS_COLUMNS:
+        assert row[col] == pytest.approx(expected[col]), col
+
+def test_summarize_without_true_predictions():
+    df_res = pd.DataFrame({"model_name": "gpt-4", "year": "R3", "result": ["False", "False", "x"], "answer": ["True", "False", "True"]})
+    row = summarize(df_res).to_dict("records")[0]
+    assert (row["TN"], row["FP"], row["FN"], row["TP"], row["support"]) == (1, 0, 1, 0, 2)
+    assert row["accuracy"] == 0.5
+    assert row["precision"] == row["recall"] == row["f1-score"] == 0.0
@@ -0,0 +1,38 @@
+from cpa_test.lib.journal import ResultJournal
+
+def test_resume(tmp_path):
+    path = str(tmp_path / "journal" / "audit_R2_gpt-4_rag_False.jsonl")
+    journal = ResultJournal(path)
+    journal.append(0, 0, "query 0", "True", True)
+    journal.append(0, 1, "query 1", "False", True, confidence=0.7)
+    journal.close()
+    journal = ResultJournal(path)
+    assert journal.get(0, 0, "query 0")["result"] == "True"
+    assert journal.get(0, 1, "query 1")["confidence"] == 0.7
+    assert journal.get(0, 2, "query 2") is None
+    # the record of a changed prompt is not reused
+    assert journal.get(0, 0, "changed query") is None
+    journal.close()
+
+def test_resume_after_a_truncated_line(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = ResultJournal(path)
+    journal.append(0, 0, "query 0", "True", True)
+    journal.close()
+    with open(path, "a", encoding="UTF-8") as f:
+        f.write('{"q": 0, "s": 1, "que') # cut off by a crash
+    journal = ResultJournal(path)
+    assert set(journal.records) == {(0, 0)}
+    journal.append(0, 1, "query 1", "False", False)
+    journal.close()
+    journal = ResultJournal(path)
+    assert set(journal.records) == {(0, 0), (0, 1)}
+    assert journal.get(0, 1, "query 1")["result"] == "False"
+    journal.close()
+
+def test_remove(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    journal = ResultJournal(str(path))
+    journal.append(0, 0, "query 0", "True", True)
+    journal.remove()
+    assert not path.exists()
@@ -0,0 +1,54 @@
+import sys
+import types
+
+import pytest
+
+from cpa_test.lib import llama_pool
+
+class FakeLlama:
+    def __init__(self, model_path:str, chat_format:str, n_threads:int, n_ctx:int, seed:int, verbose:bool):
+        self.model = model_path
+        self.n_batch = 512
+        self._n_ctx = n_ctx
+        self.cache = None
+
+    def n_ctx(self)->int:
+        return self._n_ctx
+
+    def n_embd(self)->int:
+        return 4096
+
+    def n_vocab(self)->int:
+        return 32000
+
+    def set_cache(self, cache)->None:
+        self.cache = cache
+
+class FakeRAMCache:
+    def __init__(self, capacity_bytes:int):
+        self.capacity_bytes = capacity_bytes
+
+@pytest.fixture
+def fake_llama_cpp(monkeypatch):
+    module = types.ModuleType("llama_cpp")
+    module.Llama = FakeLlama
+    module.LlamaRAMCache = FakeRAMCache
+    module.llama_n_layer = lambda model: 32
+    monkeypatch.setitem(sys.modules, "llama_cpp", module)
+    monkeypatch.setattr(llama_pool, "_llama", None)
+    monkeypatch.setattr(llama_pool, "_chat_format", None)
+    return module
+
+def test_prefix_cache_is_off_by_default(fake_llama_cpp):
+    pool = llama_pool.LlamaPool("model.gguf")
+    assert pool.PREFIX_CACHE_STATES == 0
+    llama_pool._init_worker("model.gguf", None, 512, "llama-2", 0, pool.PREFIX_CACHE_STATES)
+    assert llama_pool._llama.cache is None
+
+@pytest.mark.parametrize("n_ctx", [512, 4096])
+def test_prefix_cache_is_sized_from_n_ctx(fake_llama_cpp, n_ctx):
+    llama_pool._init_worker("model.gguf", None, n_ctx, "llama-2", 0, 2)
+    state_bytes = 2 * 32 * n_ctx * 4096 * 2 + 512 * 32000 * 4
+    assert llama_pool._llama.cache.capacity_bytes == 2 * state_bytes
+    # a state of the RAG context alone is beyond the former fixed capacity of 1 GiB
+    assert n_ctx < 4096 or state_bytes > 1 << 30
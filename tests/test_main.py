@@ -0,0 +1,72 @@
+import asyncio
+import os
+
+import pytest
+
+from cpa_test.lib.cpa_test import CpaTest
+from cpa_test.main import MODEL_LS, SUBJECT_LS, YEAR_LS, _result_names, _year_ls, build_parser
+
+from conftest import DATA_PATH
+
+def _call(argv:list)->None:
+    args = build_parser().parse_args(argv)
+    args.func(args)
+
+def test_no_command_runs_the_sweep():
+    parser = build_parser()
+    assert parser.parse_args([]).command is None
+    args = parser.parse_args(["run"])
+    assert args.subject == SUBJECT_LS and args.model == MODEL_LS and args.rag == "off" and not args.replay
+    assert _year_ls(args) == {subject: YEAR_LS[subject] for subject in SUBJECT_LS}
+
+@pytest.mark.parametrize("argv, names", [
+    ([], ["gpt-4", "llama"]),
+    (["--batch"], ["gpt-4_batch", "llama_batch"]),
+    (["--batch", "--constrained"], ["gpt-4_batch_constrained", "llama_batch_constrained"]),
+    (["--scoring"], ["gpt-4_score", "llama_score"]),
+])
+def test_result_names_are_those_of_cpa_test(argv, names):
+    args = build_parser().parse_args(["eval", "--model", "gpt-4", "llama", *argv])
+    assert _result_names(args) == names
+    cpa = CpaTest(DATA_PATH, "./result", batch=args.batch, constrained=args.constrained, scoring=args.scoring)
+    assert [cpa.result_name(m) for m in args.model] == names
+
+def test_years_of_the_command_line():
+    args = build_parser().parse_args(["plan", "--subject", "audit", "co_act", "--year", "R3"])
+    assert _year_ls(args) == {"audit": ["R3"], "co_act": ["R3"]}
+
+def test_plan_command(fake_encoding, fake_openai, result_path, tmp_path, monkeypatch, caplog):
+    monkeypatch.chdir(tmp_path) # the prompt tables are cached in ./cache
+    caplog.set_level("INFO")
+    _call(["plan", "--data-path", DATA_PATH, "--result-path", result_path, "--subject", "audit", "--year", "R3", "--model", "gpt-4-0613"])
+    assert "planned requests" in caplog.text and "total cost" in caplog.text
+    plan_line = next(line for line in caplog.text.splitlines() if "gpt-4-0613" in line)
+    assert plan_line.split()[:3] == ["audit", "gpt-4-0613", "80"]
+    assert fake_openai.requests == []
+    assert os.listdir(tmp_path / "cache" / "prompts")
+
+@pytest.fixture
+def swept(fake_openai, result_path):
+    fake_openai.answer = lambda query: "False" if len(fake_openai.requests) % 3 else "True"
+    asyncio.run(CpaTest(DATA_PATH, result_path).sweep(["audit"], {"audit": ["R3"]}, ["gpt-4", "gpt-3.5"], False))
+    return result_path
+
+def test_eval_command(swept):
+    _call(["eval", "--result-path", swept, "--subject", "audit", "--year", "R3", "--model", "gpt-4", "gpt-3.5"])
+    summary = os.listdir(f"{swept}/summary")
+    assert "summary_audit_rag_False.csv" in summary
+    assert "pairs_audit_rag_False.csv" in summary
+
+def test_eval_command_without_comparison(swept):
+    _call(["eval", "--result-path", swept, "--subject", "audit", "--year", "R3", "--model", "gpt-4", "--no-comparison"])
+    assert os.listdir(f"{swept}/summary") == ["summary_audit_rag_False.csv"]
+
+def test_telemetry_command(swept, capsys):
+    _call(["telemetry", "--result-path", swept])
+    out = capsys.readouterr().out
+    assert "gpt-4" in out and "gpt-3.5" in out and "latency" in out
+
+def test_dedup_command(result_path, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    _call(["dedup", "--data-path", DATA_PATH, "--result-path", result_path, "--subject", "audit"])
+    assert "dedup_clusters_audit.csv" in os.listdir(f"{result_path}/summary")
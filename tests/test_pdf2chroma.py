@@ -0,0 +1,65 @@
+import os
+import shutil
+
+import pytest
+
+from cpa_test.lib.vector_index import HashingEmbedding
+
+REPORTS_PATH = os.path.join(os.path.dirname(__file__), "..", "reports")
+
+class CountingEmbedding(HashingEmbedding):
+    def __init__(self):
+        super().__init__(dim=64)
+        self.n_texts = 0
+
+    def embed_documents(self, texts:list)->list:
+        self.n_texts += len(texts)
+        return super().embed_documents(texts)
+
+@pytest.fixture
+def pdf_path(tmp_path):
+    pytest.importorskip("pypdf")
+    pytest.importorskip("tqdm")
+    pdf_ls = sorted((f for f in os.listdir(REPORTS_PATH) if f.endswith(".pdf")), key=lambda f: os.path.getsize(os.path.join(REPORTS_PATH, f)))
+    path = tmp_path / "reports"
+    path.mkdir()
+    for f in pdf_ls[:2]:
+        shutil.copy(os.path.join(REPORTS_PATH, f), path / f)
+    return path
+
+def test_rebuild_is_a_noop(pdf_path, tmp_path):
+    from cpa_test.lib.pdf2chroma import MANIFEST_NAME, mk_chromadb
+    persist_path = str(tmp_path / "vectorstore")
+    embeddings = CountingEmbedding()
+    index = mk_chromadb(str(pdf_path), chunk_size=500, persist_path=persist_path, n_workers=1,
+                        embeddings=embeddings, embedding_cache_path=None)
+    assert len(index) > 0 and embeddings.n_texts > 0
+    with open(f"{persist_path}/{MANIFEST_NAME}", encoding="UTF-8") as f:
+        manifest = f.read()
+
+    embeddings = CountingEmbedding()
+    rebuilt = mk_chromadb(str(pdf_path), chunk_size=500, persist_path=persist_path, n_workers=1,
+                          embeddings=embeddings, embedding_cache_path=None)
+    assert embeddings.n_texts == 0
+    assert len(rebuilt) == len(index)
+    assert (rebuilt.embeddings == index.embeddings).all()
+    with open(f"{persist_path}/{MANIFEST_NAME}", encoding="UTF-8") as f:
+        assert f.read() == manifest
+
+def test_only_the_changed_files_are_rebuilt(pdf_path, tmp_path):
+    from cpa_test.lib.pdf2chroma import mk_chromadb
+    persist_path = str(tmp_path / "vectorstore")
+    mk_chromadb(str(pdf_path), chunk_size=500, persist_path=persist_path, n_workers=1,
+                embeddings=CountingEmbedding(), embedding_cache_path=None)
+    removed = sorted(os.listdir(pdf_path))[0]
+    os.remove(pdf_path / removed)
+    embeddings = CountingEmbedding()
+    index = mk_chromadb(str(pdf_path), chunk_size=500, persist_path=persist_path, n_workers=1,
+                        embeddings=embeddings, embedding_cache_path=None)
+    assert embeddings.n_texts == 0
+    assert set(index.doc_ranges) == {f[:-4] for f in os.listdir(pdf_path)}
+
+    embeddings = CountingEmbedding()
+    index = mk_chromadb(str(pdf_path), chunk_size=300, persist_path=persist_path, n_workers=1,
+                        embeddings=embeddings, embedding_cache_path=None)
+    assert embeddings.n_texts == len(index)
@@ -0,0 +1,44 @@
+import os
+
+import pandas as pd
+import pytest
+
+from cpa_test.lib.cpa_test import CpaTest
+from cpa_test.lib.plan import MODEL_PRICES, TOKENS_PER_MESSAGE, TOKENS_PER_REPLY, estimate_cost
+
+from conftest import DATA_PATH
+
+def test_estimate_cost(fake_encoding):
+    df_req = pd.DataFrame({"subject": "audit",
+                           "model_name": ["gpt-4-0613", "gpt-4-0613", "llama"],
+                           "system_prompt": "指示",
+                           "query": ["問題1", "問題22", "問題1"],
+                           "output_tokens": 1})
+    df_plan = estimate_cost(df_req).set_index("model_name")
+    overhead = 2 * TOKENS_PER_MESSAGE + TOKENS_PER_REPLY
+    assert df_plan.loc["gpt-4-0613", "requests"] == 2
+    assert df_plan.loc["gpt-4-0613", "input_tokens"] == (2 + 3 + overhead) + (2 + 4 + overhead)
+    price_in, price_out = MODEL_PRICES["gpt-4-0613"]
+    assert df_plan.loc["gpt-4-0613", "cost_usd"] == pytest.approx((df_plan.loc["gpt-4-0613", "input_tokens"] * price_in + 2 * price_out) / 1e6)
+    assert df_plan.loc["llama", "cost_usd"] == 0.0
+
+def test_plan_sends_nothing(fake_encoding, fake_openai, result_path):
+    cpa = CpaTest(DATA_PATH, result_path)
+    df_plan = cpa.plan(["audit", "co_act"], {"audit": ["R3", "R4_1"], "co_act": ["R3"]}, ["gpt-4-0613", "gpt-4o-2024-05-13"])
+    assert len(df_plan) == 4
+    assert df_plan.set_index(["subject", "model_name"])["requests"].to_dict() == {
+        ("audit", "gpt-4-0613"): 160, ("audit", "gpt-4o-2024-05-13"): 160,
+        ("co_act", "gpt-4-0613"): 80, ("co_act", "gpt-4o-2024-05-13"): 80}
+    assert (df_plan["output_tokens"] == df_plan["requests"]).all() # "True" is one token
+    assert (df_plan["cost_usd"] > 0).all()
+    assert fake_openai.requests == []
+    assert not os.path.exists(f"{result_path}/telemetry")
+
+def test_plan_of_the_batch_mode(fake_encoding, result_path):
+    df_plan = CpaTest(DATA_PATH, result_path, batch=True).plan(["audit"], {"audit": ["R3"]}, ["gpt-4-0613"])
+    assert df_plan.loc[0, "requests"] == 20
+
+def test_plan_of_the_dedup_mode(fake_encoding, result_path):
+    df_plan = CpaTest(DATA_PATH, result_path, dedup=True).plan(["audit"], {"audit": ["R3", "R3"]}, ["gpt-4-0613"])
+    assert df_plan.loc[0, "requests"] == 80
+    assert df_plan.loc[0, "dedup_saved"] == 80
@@ -0,0 +1,86 @@
+import asyncio
+import time
+
+import openai
+import pytest
+
+from cpa_test.lib import rate_limit
+from cpa_test.lib.rate_limit import TokenBucket, call_with_retry, retry_after
+
+def test_token_bucket_waits_for_the_refill():
+    async def _run():
+        bucket = TokenBucket(rate=600, capacity=1) # 10 per second
+        first = await bucket.acquire(1)
+        second = await bucket.acquire(1)
+        return first, second
+    first, second = asyncio.run(_run())
+    assert first < 0.05
+    assert 0.07 < second < 0.5
+
+def test_token_bucket_caps_the_amount_by_the_capacity():
+    async def _run():
+        bucket = TokenBucket(rate=60000, capacity=10)
+        return await bucket.acquire(1000)
+    assert asyncio.run(_run()) < 0.05
+
+def test_token_bucket_charge():
+    bucket = TokenBucket(rate=60, capacity=10)
+    bucket.charge(15)
+    assert bucket.tokens < 0
+    bucket.charge(-100) # given back up to the capacity
+    assert bucket.tokens == 10
+
+def test_token_bucket_needs_a_positive_rate():
+    with pytest.raises(ValueError):
+        TokenBucket(rate=0)
+
+@pytest.mark.parametrize("headers, seconds", [
+    ({"retry-after": "3"}, 3.0),
+    ({"Retry-After": "1.5"}, 1.5),
+    ({"retry-after-ms": "250"}, 0.25),
+    ({"retry-after-ms": "500", "retry-after": "9"}, 0.5),
+    ({"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"}, None),
+    ({}, None),
+    (None, None),
+])
+def test_retry_after(headers, seconds):
+    assert retry_after(openai.error.RateLimitError("rate limited", headers=headers)) == seconds
+
+def _flaky(errors:list):
+    calls = []
+    async def func(x):
+        calls.append(time.monotonic())
+        if errors:
+            raise errors.pop(0)
+        return x * 2
+    return func, calls
+
+def test_call_with_retry_respects_retry_after(monkeypatch):
+    delays = []
+    async def _sleep(delay):
+        delays.append(delay)
+    monkeypatch.setattr(rate_limit.asyncio, "sleep", _sleep)
+    func, calls = _flaky([openai.error.RateLimitError("rate limited", headers={"retry-after": "7"}),
+                          openai.error.ServiceUnavailableError("unavailable")])
+    result, retries = asyncio.run(call_with_retry(func, 21, base_delay=0.001, max_delay=0.01))
+    assert (result, retries) == (42, 2)
+    assert len(calls) == 3
+    assert delays[0] == 7.0
+    assert delays[1] <= 0.01
+
+def test_call_with_retry_does_not_retry_client_errors():
+    func, calls = _flaky([openai.error.InvalidRequestError("bad request", param=None, http_status=400)])
+    with pytest.raises(openai.error.InvalidRequestError) as e:
+        asyncio.run(call_with_retry(func, 1, base_delay=0.001))
+    assert len(calls) == 1
+    assert e.value.retries == 0
+
+def test_call_with_retry_gives_up(monkeypatch):
+    async def _sleep(delay):
+        pass
+    monkeypatch.setattr(rate_limit.asyncio, "sleep", _sleep)
+    func, calls = _flaky([openai.error.APIError("server error", http_status=502) for _ in range(4)])
+    with pytest.raises(openai.error.APIError) as e:
+        asyncio.run(call_with_retry(func, 1, max_retries=2))
+    assert len(calls) == 3
+    assert e.value.retries == 2
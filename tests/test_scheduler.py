@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+
+from cpa_test.lib.scheduler import Scheduler
+
+async def _drain(scheduler:Scheduler, n_dic:dict)->dict:
+    # submit n_dic[model] sleeping requests of every model at once and record the peak in-flight requests
+    in_flight = {m: 0 for m in n_dic}
+    peak = {m: 0 for m in n_dic}
+    async def _request(model_name:str):
+        in_flight[model_name] += 1
+        peak[model_name] = max(peak[model_name], in_flight[model_name])
+        await asyncio.sleep(0.01)
+        in_flight[model_name] -= 1
+        return model_name
+    results = await asyncio.gather(*[scheduler.submit(m, _request, m) for m, n in n_dic.items() for _ in range(n)])
+    assert results == [m for m, n in n_dic.items() for _ in range(n)]
+    return peak
+
+def test_in_flight_requests_are_limited_per_model():
+    scheduler = Scheduler({"gpt-4": 2, "llama": 1}, default_concurrency=5)
+    peak = asyncio.run(_drain(scheduler, {"gpt-4": 10, "llama": 6, "gpt-3.5": 20}))
+    assert peak == {"gpt-4": 2, "llama": 1, "gpt-3.5": 5}
+    assert scheduler.limit("gpt-4") == 2 and scheduler.limit("other") == 5
+
+def test_models_are_drained_side_by_side():
+    async def _run():
+        scheduler = Scheduler({"slow": 1, "fast": 1})
+        done = []
+        async def _request(model_name:str, seconds:float):
+            await asyncio.sleep(seconds)
+            done.append(model_name)
+        await asyncio.gather(scheduler.submit("slow", _request, "slow", 0.2),
+                             *[scheduler.submit("fast", _request, "fast", 0.01) for _ in range(5)])
+        return done
+    # the fast model is not blocked behind the slow one
+    assert asyncio.run(_run()) == ["fast"] * 5 + ["slow"]
+
+def test_errors_are_raised_to_the_caller():
+    async def _run():
+        scheduler = Scheduler({"gpt-4": 1})
+        async def _fail():
+            raise RuntimeError("failed")
+        with pytest.raises(RuntimeError):
+            await scheduler.submit("gpt-4", _fail)
+        # the slot is given back
+        return await asyncio.wait_for(scheduler.submit("gpt-4", asyncio.sleep, 0, "ok"), 1)
+    assert asyncio.run(_run()) == "ok"
+
+def test_limit_must_be_positive():
+    scheduler = Scheduler({"gpt-4": 0})
+    with pytest.raises(ValueError):
+        asyncio.run(scheduler.submit("gpt-4", asyncio.sleep, 0))
@@ -0,0 +1,105 @@
+import json
+import os
+import time
+
+import openai
+import pandas as pd
+import pytest
+
+from cpa_test.lib.sweep import WorkQueue, merge_results, run_worker
+
+from conftest import DATA_PATH
+
+def test_claim(tmp_path):
+    queue_a = WorkQueue(str(tmp_path), worker_id="a")
+    queue_b = WorkQueue(str(tmp_path), worker_id="b")
+    assert queue_a.claim("audit_R3_gpt-4_rag_False")
+    assert not queue_a.claim("audit_R3_gpt-4_rag_False")
+    assert not queue_b.claim("audit_R3_gpt-4_rag_False")
+    assert queue_b.claim("audit_R4_gpt-4_rag_False")
+    with open(queue_a._claim_path("audit_R3_gpt-4_rag_False"), encoding="UTF-8") as f:
+        assert f.read() == "a"
+    queue_a.release("audit_R3_gpt-4_rag_False")
+    assert queue_b.claim("audit_R3_gpt-4_rag_False")
+    queue_a.release("not_claimed")
+
+def test_stale_claim_is_taken_over(tmp_path):
+    queue_a = WorkQueue(str(tmp_path), worker_id="a", lease=60)
+    queue_b = WorkQueue(str(tmp_path), worker_id="b", lease=60)
+    assert queue_a.claim("unit")
+    path = queue_a._claim_path("unit")
+    past = time.time() - 120
+    os.utime(path, (past, past)) # the worker a is dead
+    assert queue_b.claim("unit")
+    with open(path, encoding="UTF-8") as f:
+        assert f.read() == "b"
+    assert os.listdir(queue_a.QUEUE_PATH) == ["unit.claim"]
+    assert not queue_a.claim("unit")
+
+def test_touched_claim_is_not_taken_over(tmp_path):
+    queue_a = WorkQueue(str(tmp_path), worker_id="a", lease=60)
+    queue_b = WorkQueue(str(tmp_path), worker_id="b", lease=60)
+    assert queue_a.claim("unit")
+    path = queue_a._claim_path("unit")
+    past = time.time() - 120
+    os.utime(path, (past, past))
+    queue_a.touch(["unit"])
+    assert not queue_b.claim("unit")
+
+def test_is_done(tmp_path):
+    queue = WorkQueue(str(tmp_path), worker_id="a")
+    assert not queue.is_done("unit")
+    os.makedirs(tmp_path / "journal")
+    (tmp_path / "csv" / "unit.csv").write_text("result,answer\n")
+    (tmp_path / "journal" / "unit.jsonl").write_text("")
+    assert not queue.is_done("unit") # the csv of an interrupted run
+    os.remove(tmp_path / "journal" / "unit.jsonl")
+    assert queue.is_done("unit")
+
+def test_unit_with_failed_statements_is_not_done(tmp_path):
+    queue = WorkQueue(str(tmp_path), worker_id="a")
+    (tmp_path / "csv" / "unit.csv").write_text("result,answer,status\nTrue,True,ok\n,False,error:Timeout\n")
+    assert queue.n_failed("unit") == 1
+    assert not queue.is_done("unit")
+    (tmp_path / "csv" / "unit.csv").write_text("result,answer,status\nTrue,True,ok\nFalse,False,ok\n")
+    assert queue.n_failed("unit") == 0
+    assert queue.is_done("unit")
+    assert queue.n_failed("not_run") == 0
+
+@pytest.fixture
+def config_path(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path) # the prompt tables are cached in ./cache
+    path = tmp_path / "sweep.json"
+    path.write_text(json.dumps({"subjects": ["audit"], "models": ["gpt-4"], "years": {"audit": ["R3", "R4_1"]},
+                                "data_path": DATA_PATH, "result_path": str(tmp_path / "result")}))
+    return str(path)
+
+def test_failed_unit_is_run_again(config_path, tmp_path, fake_openai):
+    failing = []
+    def _answer(query):
+        if len(failing) < 3 and len(fake_openai.requests) <= 3: # 3 statements of R3, the first unit
+            failing.append(query)
+        if query in failing:
+            raise openai.error.InvalidRequestError("context length exceeded", "messages")
+        return "True"
+    fake_openai.answer = _answer
+    # the failed unit is run once, so waiting for it does not loop forever
+    assert run_worker(config_path, worker_id="a", claim_size=1, wait=True) == 2
+    assert len(fake_openai.requests) == 160
+    queue = WorkQueue(str(tmp_path / "result"))
+    assert queue.n_failed("audit_R3_gpt-4_rag_False") == 3
+    assert not queue.is_done("audit_R3_gpt-4_rag_False")
+    assert queue.is_done("audit_R4_1_gpt-4_rag_False")
+    assert os.path.exists(tmp_path / "result" / "journal" / "audit_R3_gpt-4_rag_False.jsonl")
+    with pytest.raises(RuntimeError, match="failed statements"):
+        merge_results(config_path, comparison=False)
+
+    fake_openai.requests.clear()
+    fake_openai.answer = lambda query: "True"
+    assert run_worker(config_path, worker_id="b") == 1
+    assert sorted(fake_openai.queries) == sorted(failing) # only the failed statements are asked again
+    assert queue.is_done("audit_R3_gpt-4_rag_False")
+    df = pd.read_csv(tmp_path / "result" / "csv" / "audit_R3_gpt-4_rag_False.csv", dtype=str)
+    assert len(df) == 80 and (df["status"] == "ok").all()
+    merge_results(config_path, comparison=False)
+    assert os.path.exists(tmp_path / "result" / "summary" / "summary_audit_rag_False.csv")
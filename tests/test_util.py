@@ -0,0 +1,133 @@
+import os
+import pickle
+import shutil
+
+import pytest
+
+from cpa_test.lib import util
+from cpa_test.lib.util import normalize_label, parse_batch_answer
+
+from conftest import DATA_PATH
+
+@pytest.mark.parametrize("text", [
+    '{"ア": "True", "イ": "False", "ウ": "True", "エ": "False"}',
+    '回答:\n```json\n{"ア": "True", "イ": "False", "ウ": "True", "エ": "False"}\n```',
+    '{" ア ": " true ", "イ": "false", "ウ": "TRUE", "エ": "False"}',
+    'ア: True\nイ: False\nウ．True\nエ "False"',
+])
+def test_parse_batch_answer(text):
+    assert parse_batch_answer(text) == ["True", "False", "True", "False"]
+
+@pytest.mark.parametrize("text", [
+    "",
+    '{"ア": "True", "イ": "False", "ウ": "True"}', # エ is missing
+    '{"ア": "True", "イ": "False", "ウ": "True", "エ": "unknown"}',
+    '{"ア": "True", "イ": "False", "ウ": "True", "エ": "False"', # broken json without the line format
+])
+def test_parse_batch_answer_rejects(text):
+    assert parse_batch_answer(text) is None
+
+@pytest.mark.parametrize("text, label", [
+    ("True", "True"),
+    ("false", "False"),
+    (' "True".', "True"),
+    ("「False」", "False"),
+    ("False\n理由は...", "False"),
+    ("Trueです。", "True"),
+    ("The answer is True.", "True"),
+    ("〇", "True"),
+    ("×", "False"),
+    ("正しい", "True"),
+    ("誤り", "False"),
+    ("誤っている。", "False"),
+])
+def test_normalize_label(text, label):
+    assert normalize_label(text) == label
+
+@pytest.mark.parametrize("text", [
+    "",
+    "わかりません",
+    "Trueではありません",
+    "True とは言えない",
+    "It is not true.",
+    "This is not \"False\".",
+    "正しいとは言えない",
+    "正しいではない",
+    "True\n理由: ...なのでFalse",
+    "True or False",
+    "Truely", # not a label
+    "untrue",
+])
+def test_normalize_label_rejects(text):
+    assert normalize_label(text) is None
+
+@pytest.fixture
+def prompt_source(tmp_path, monkeypatch):
+    data_path = tmp_path / "data"
+    data_path.mkdir()
+    shutil.copy(os.path.join(DATA_PATH, "CPA_AUDIT.csv"), data_path)
+    monkeypatch.setattr(util, "_PROMPT_TABLES", {})
+    compiled = []
+    compile_prompts = util.compile_prompts
+    def _compile(*args):
+        compiled.append(args[1])
+        return compile_prompts(*args)
+    monkeypatch.setattr(util, "compile_prompts", _compile)
+    return str(data_path), str(tmp_path / "cache"), compiled
+
+def _load(data_path:str, cache_dir:str):
+    return util.load_prompts(data_path, "audit", "前", "後", cache_dir)
+
+def _new_process(monkeypatch):
+    monkeypatch.setattr(util, "_PROMPT_TABLES", {})
+
+def test_prompt_table_is_cached(prompt_source, monkeypatch):
+    data_path, cache_dir, compiled = prompt_source
+    table = _load(data_path, cache_dir)
+    assert _load(data_path, cache_dir) is table
+    _new_process(monkeypatch)
+    assert _load(data_path, cache_dir).equals(table)
+    assert compiled == ["audit"]
+    assert [f for f in os.listdir(cache_dir) if f.endswith(".tmp")] == []
+
+def test_touched_source_is_not_rebuilt(prompt_source, monkeypatch):
+    data_path, cache_dir, compiled = prompt_source
+    _load(data_path, cache_dir)
+    src = os.path.join(data_path, "CPA_AUDIT.csv")
+    os.utime(src, (os.path.getatime(src), os.path.getmtime(src) + 10))
+    _new_process(monkeypatch)
+    _load(data_path, cache_dir)
+    assert compiled == ["audit"]
+
+def test_changed_source_is_rebuilt(prompt_source, monkeypatch):
+    data_path, cache_dir, compiled = prompt_source
+    n_rows = len(_load(data_path, cache_dir))
+    src = os.path.join(data_path, "CPA_AUDIT.csv")
+    with open(src, encoding="utf-8") as f:
+        lines = f.readlines()
+    with open(src, "w", encoding="utf-8") as f:
+        f.writelines(lines[:-1])
+    os.utime(src, (os.path.getatime(src), os.path.getmtime(src) + 10))
+    _new_process(monkeypatch)
+    assert len(_load(data_path, cache_dir)) < n_rows
+    assert compiled == ["audit", "audit"]
+
+def _truncate(path:str)->None: # half-written
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) // 2)
+
+def _former_format(path:str)->None:
+    with open(path, "wb") as f:
+        pickle.dump({"mtime": 0, "sha256": "", "table": None}, f)
+
+@pytest.mark.parametrize("corrupt", [_truncate, _former_format])
+def test_unreadable_cache_is_rebuilt(prompt_source, monkeypatch, corrupt):
+    data_path, cache_dir, compiled = prompt_source
+    table = _load(data_path, cache_dir)
+    cache_file = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+    corrupt(cache_file)
+    _new_process(monkeypatch)
+    assert _load(data_path, cache_dir).equals(table)
+    assert compiled == ["audit", "audit"]
+    with open(cache_file, "rb") as f:
+        assert pickle.load(f)["version"] == util.PROMPT_CACHE_VERSION
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from cpa_test.lib import pdf2chroma
+from cpa_test.lib.vector_index import HashingEmbedding, VectorIndex, benchmark_retrieval, get_embeddings
+from cpa_test.main import build_parser
+
+DOCS = {
+    "監査基準": ["監査人は、職業的専門家としての正当な注意を払い、懐疑心を保持して監査を行わなければならない。",
+                 "監査人は、監査リスクを合理的に低い水準に抑えるために、重要な虚偽表示のリスクを評価しなければならない。",
+                 "監査人は、内部統制を含む企業及び企業環境を理解しなければならない。"],
+    "会社法": ["株式会社は、定款で定めるところにより、取締役会を置くことができる。",
+               "監査役は、取締役の職務の執行を監査する。この場合において、監査役は、監査報告を作成しなければならない。",
+               "会計監査人は、株式会社の計算書類及びその附属明細書を監査する。"],
+}
+
+@pytest.fixture
+def embeddings():
+    return HashingEmbedding(dim=512)
+
+@pytest.fixture
+def index(tmp_path, embeddings):
+    docs = [(source, [(text, {"page": n, "article": ""}) for n, text in enumerate(texts)], embeddings.embed_documents(texts))
+            for source, texts in DOCS.items()]
+    return VectorIndex.build(str(tmp_path / "index"), docs, embeddings.model)
+
+def test_embedding_is_restored_by_its_name(embeddings):
+    restored = get_embeddings(embeddings.model)
+    assert restored.model == embeddings.model
+    assert restored.embed_query("監査役") == embeddings.embed_query("監査役")
+
+def test_search(index, embeddings):
+    hits = index.search("取締役の職務の執行を監査する", embeddings, k=2)
+    assert len(hits) == 2
+    assert hits[0]["text"] == DOCS["会社法"][1]
+    assert hits[0]["source"] == "会社法" and hits[0]["page"] == 1
+    assert hits[0]["score"] >= hits[1]["score"]
+    assert len(index.search("監査", embeddings, k=10)) == len(index) == 6
+
+def test_search_in_sources(index, embeddings):
+    hits = index.search("取締役の職務の執行を監査する", embeddings, k=4, sources=["監査基準"])
+    assert len(hits) == 3
+    assert {h["source"] for h in hits} == {"監査基準"}
+    assert index.search("監査", embeddings, sources=["金融商品取引法"]) == []
+
+def test_loaded_index_is_the_built_one(index, embeddings):
+    loaded = VectorIndex.load(index.PATH)
+    assert isinstance(loaded.embeddings, np.memmap)
+    assert loaded.doc_ranges == {"監査基準": (0, 3), "会社法": (3, 6)}
+    assert loaded.search("会計監査人", embeddings) == index.search("会計監査人", embeddings)
+
+def test_benchmark_retrieval(index, embeddings):
+    result = benchmark_retrieval(index, embeddings, n_queries=100, k=1)
+    assert result["queries"] == len(index) == result["chunks"]
+    assert result["recall"] == result["filtered_recall"] == 1.0
+    for step in ["embed", "search", "filtered_search"]:
+        assert 0 <= result[f"{step}_ms_p50"] <= result[f"{step}_ms_p95"]
+
+def test_index_command_benchmarks_the_built_index(index, monkeypatch, capsys):
+    monkeypatch.setattr(pdf2chroma, "mk_chromadb", lambda **kwargs: index)
+    args = build_parser().parse_args(["index", "--benchmark", "-k", "1"])
+    args.func(args)
+    lines = dict(line.split() for line in capsys.readouterr().out.splitlines())
+    assert lines["chunks"] == "6" and lines["k"] == "1"
+    assert float(lines["recall"]) == 1.0